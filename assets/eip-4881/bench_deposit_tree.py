@@ -0,0 +1,136 @@
+"""Replay benchmark for the EIP-4881 deposit trees (deposit_snapshot.py).
+
+Drives each backend through a synthetic deposit history split into
+stages.  Every stage pushes the next batch of deposits and finalizes the
+tree half a batch behind the head, like a node following the eth1 chain
+with the finalized checkpoint lagging behind.  At the end of each stage
+it reports:
+
+  push       time per deposit of pushing the batch
+  root       get_root at the head
+  proof      get_proof of the newest deposit
+  snapshot   get_snapshot followed by from_snapshot, the restore path
+  memory     memory held by the tree (measured in a second, traced run
+             so that tracing does not distort the timings)
+
+Backends:
+
+  1. DepositTree              the object tree, one push_leaf per deposit
+  2. DepositTree bulk         the object tree fed with push_leaves
+  3. IncrementalDepositTree   the deposit contract branch arrays
+
+Every column is the best of REPEAT runs with the garbage collector
+disabled (as timeit does).  Since the object tree caches the roots it
+hashes, each root run gets a fresh deep copy of the tree at the end of
+the stage, made outside of the timing.
+The roots of all backends are compared at every stage; a backend that
+disagrees with the first one is flagged.
+
+Usage: python bench_deposit_tree.py [deposits] [stages]
+(default 2**18 deposits in 8 stages; millions of deposits take minutes
+with the object tree).
+"""
+import gc
+import random
+import sys
+import time
+import timeit
+import tracemalloc
+from copy import deepcopy
+
+from deposit_snapshot import DepositTree, IncrementalDepositTree
+from eip_4881 import Eth1Data
+
+
+def synthetic_deposits(count, seed=4881):
+    """Random deposit data roots."""
+    rng = random.Random(seed)
+    return [rng.getrandbits(256).to_bytes(32, "little") for _ in range(count)]
+
+
+def finalize(tree, deposit_count):
+    """Finalizes deposit_count deposits at a made-up execution block.  The
+    deposit root of the Eth1Data is not used by finalize."""
+    block_hash = deposit_count.to_bytes(32, "little")
+    tree.finalize(Eth1Data(bytes(32), deposit_count, block_hash), deposit_count)
+
+
+REPEAT = 5
+
+
+def best_of(function):
+    """Shortest of REPEAT timed runs of function, in seconds."""
+    return min(timeit.repeat(function, number=1, repeat=REPEAT))
+
+
+def best_of_copies(function, tree):
+    """Shortest of REPEAT timed runs of function, each one called with a
+    fresh deep copy of tree so that no run reuses the roots cached by an
+    earlier one, in seconds."""
+    times = []
+    for _ in range(REPEAT):
+        copy = deepcopy(tree)
+        gc.disable()
+        start = time.perf_counter()
+        function(copy)
+        times.append(time.perf_counter() - start)
+        gc.enable()
+    return min(times)
+
+
+def replay(tree_class, bulk, leaves, stages, traced=False):
+    """Replays the deposits and returns one row per stage: (deposits,
+    seconds per push, root, proof and snapshot seconds, KiB, root)."""
+    tree = tree_class.new()
+    size = len(leaves) // stages
+    rows = []
+    for stage in range(stages):
+        batch = leaves[stage * size:(stage + 1) * size]
+        start = time.perf_counter()
+        if bulk:
+            tree.push_leaves(batch)
+        else:
+            for leaf in batch:
+                tree.push_leaf(leaf)
+        push = (time.perf_counter() - start) / len(batch)
+        finalize(tree, tree.mix_in_length - size // 2)
+
+        root_time = best_of_copies(lambda copy: copy.get_root(), tree)
+        root = tree.get_root()
+        proof_time = best_of(lambda: tree.get_proof(tree.mix_in_length - 1))
+        snapshot_time = best_of(
+            lambda: tree_class.from_snapshot(tree.get_snapshot()))
+
+        memory = tracemalloc.get_traced_memory()[0] / 1024 if traced else 0
+        rows.append((tree.mix_in_length, push, root_time, proof_time,
+                     snapshot_time, memory, root))
+    return rows
+
+
+BACKENDS = [
+    ("DepositTree",            DepositTree,            False),
+    ("DepositTree bulk",       DepositTree,            True),
+    ("IncrementalDepositTree", IncrementalDepositTree, False),
+]
+
+if __name__ == "__main__":
+    deposits = int(sys.argv[1]) if len(sys.argv) > 1 else 2**18
+    stages = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+    leaves = synthetic_deposits(deposits)
+    reference = None
+    for name, tree_class, bulk in BACKENDS:
+        rows = replay(tree_class, bulk, leaves, stages)
+        tracemalloc.start()
+        traced = replay(tree_class, bulk, leaves, stages, traced=True)
+        tracemalloc.stop()
+        roots = [row[-1] for row in rows]
+        if reference is None:
+            reference = roots
+        for row, traced_row, expected in zip(rows, traced, reference):
+            count, push, root, proof, snapshot, _, got = row
+            flag = "" if got == expected else "  <-- ROOT MISMATCH"
+            print(f"{name:24s} {count:9d} deposits"
+                  f" {push * 1e6:8.2f} us/push {root * 1000:8.3f} ms root"
+                  f" {proof * 1000:8.3f} ms proof"
+                  f" {snapshot * 1000:8.3f} ms snapshot"
+                  f" {traced_row[5]:10.0f} KiB{flag}")
@@ -1,7 +1,8 @@
 #!/usr/bin/env python3
 from __future__ import annotations
-from typing import List, Optional, Tuple
-from dataclasses import dataclass
+import os
+from typing import BinaryIO, Dict, Iterable, List, Optional, Set, Tuple
+from dataclasses import dataclass, field
 from abc import abstractmethod
 from eip_4881 import DEPOSIT_CONTRACT_DEPTH,Hash32,sha256,to_le_bytes,zerohashes
 
@@ -38,11 +39,20 @@ class DepositTree:
     tree: MerkleTree
     mix_in_length: uint
     finalized_execution_block: Optional[Tuple[Hash32, uint64]]
+    # optional persistent copy of the finalized branch and the frontier,
+    # kept up to date by push_leaf, push_leaves and finalize and written to
+    # its file by finalize and DepositStore.flush
+    store: Optional[DepositStore] = None
+    # optional history of the subtree roots for root_at, kept up to date by
+    # push_leaf and push_leaves
+    history: Optional[DepositRootHistory] = None
     def new() -> DepositTree:
         merkle = MerkleTree.create([], DEPOSIT_CONTRACT_DEPTH)
         return DepositTree(merkle, 0, None)
     def get_snapshot(self) -> DepositTreeSnapshot:
         assert(self.finalized_execution_block is not None)
+        if self.store is not None:
+            return self.store.get_snapshot()
         finalized = []
         deposit_count = self.tree.get_finalized(finalized)
         return DepositTreeSnapshot.from_tree_parts(
@@ -54,9 +64,25 @@ class DepositTree:
         tree = MerkleTree.from_snapshot_parts(
             snapshot.finalized, snapshot.deposit_count, DEPOSIT_CONTRACT_DEPTH)
         return DepositTree(tree, snapshot.deposit_count, finalized_execution_block)
+    def from_store(store: DepositStore) -> DepositTree:
+        # restores the tree at the finalized count of the store, which is 0
+        # for a store that has never been finalized, then replays the
+        # pending leaves up to the head so that they can still be proven
+        finalized = [store.finalized_branch[level] for level in reversed(range(DEPOSIT_CONTRACT_DEPTH))
+                     if (store.finalized_count >> level) & 1 == 1]
+        tree = MerkleTree.from_snapshot_parts(
+            finalized, store.finalized_count, DEPOSIT_CONTRACT_DEPTH)
+        for leaf in store.pending:
+            tree = tree.push_leaf(leaf, DEPOSIT_CONTRACT_DEPTH)
+        assert(store.finalized_count + len(store.pending) == store.mix_in_length)
+        return DepositTree(tree, store.mix_in_length, store.finalized_execution_block, store)
     def finalize(self, eth1_data: Eth1Data, execution_block_height: uint64):
         self.finalized_execution_block = (eth1_data.block_hash, execution_block_height)
         self.tree.finalize(eth1_data.deposit_count, DEPOSIT_CONTRACT_DEPTH)
+        if self.store is not None:
+            finalized = []
+            deposit_count = self.tree.get_finalized(finalized)
+            self.store.finalize(finalized, deposit_count, self.finalized_execution_block)
     def get_proof(self, index: uint) -> Tuple[Hash32, List[Hash32]]:
         assert(self.mix_in_length > 0)
         # ensure index > finalized deposit index
@@ -64,13 +90,393 @@ class DepositTree:
         leaf, proof = self.tree.generate_proof(index, DEPOSIT_CONTRACT_DEPTH)
         proof.append(to_le_bytes(self.mix_in_length))
         return leaf, proof
+    def get_proofs(self, start: uint, count: uint) -> List[Tuple[Hash32, List[Hash32]]]:
+        # proofs of count consecutive deposits in the format of get_proof,
+        # hashing the nodes covering the range once for all of them
+        nodes = self.get_range_nodes(start, count)
+        last = start + count - 1
+        for level in range(DEPOSIT_CONTRACT_DEPTH - 1):
+            for position in range(start >> (level + 1), (last >> (level + 1)) + 1):
+                nodes[(level + 1, position)] = sha256(
+                    nodes[(level, position * 2)] + nodes[(level, position * 2 + 1)])
+        mix_in = to_le_bytes(self.mix_in_length)
+        proofs = []
+        for index in range(start, start + count):
+            proof = [nodes[(level, (index >> level) ^ 1)] for level in range(DEPOSIT_CONTRACT_DEPTH)]
+            proof.append(mix_in)
+            proofs.append((nodes[(0, index)], proof))
+        return proofs
+    def get_range_proof(self, start: uint, count: uint) -> Tuple[List[Hash32], List[Hash32]]:
+        # compact proof of count consecutive deposits: their leaves and the
+        # roots of the subtrees bordering the range, shared by all of them,
+        # ordered by level (bottom-up) and position, followed by the mix-in
+        nodes = self.get_range_nodes(start, count)
+        leaves = [nodes.pop((0, index)) for index in range(start, start + count)]
+        branch = [nodes[key] for key in sorted(nodes)]
+        branch.append(to_le_bytes(self.mix_in_length))
+        return leaves, branch
+    def get_range_nodes(self, start: uint, count: uint) -> Dict[Tuple[uint, uint], Hash32]:
+        assert(count > 0 and start + count <= self.mix_in_length)
+        # ensure start > finalized deposit index
+        assert(start > self.tree.get_finalized([]) - 1)
+        nodes = {}
+        self.tree.get_range_nodes(start, start + count, DEPOSIT_CONTRACT_DEPTH, 0, nodes)
+        return nodes
     def get_root(self) -> Hash32:
         return sha256(self.tree.get_root() + to_le_bytes(self.mix_in_length))
+    def root_at(self, deposit_count: uint) -> Hash32:
+        # deposit root when the tree held deposit_count deposits
+        assert(self.history is not None)
+        assert(self.history.deposit_count == self.mix_in_length)
+        return self.history.root_at(deposit_count)
     def push_leaf(self, leaf: Hash32):
         self.mix_in_length += 1
         self.tree = self.tree.push_leaf(leaf, DEPOSIT_CONTRACT_DEPTH)
+        if self.store is not None:
+            self.store.push_leaves([leaf])
+        if self.history is not None:
+            self.history.push_leaf(leaf)
+    def push_leaves(self, leaves: Iterable[Hash32]):
+        # splits the leaves into the largest complete subtrees allowed by the
+        # alignment of the next deposit index and inserts each one at once;
+        # the store and the history are fed with the hashes of the subtrees
+        leaves = list(leaves)
+        assert(self.mix_in_length + len(leaves) <= 2**DEPOSIT_CONTRACT_DEPTH)
+        offset = 0
+        while offset < len(leaves):
+            height = 0
+            while (height < DEPOSIT_CONTRACT_DEPTH and (self.mix_in_length >> height) & 1 == 0
+                   and 2**(height + 1) <= len(leaves) - offset):
+                height += 1
+            levels = []
+            subtree = MerkleTree.create_complete(leaves[offset:offset + 2**height], levels)
+            self.tree = self.tree.push_subtree(subtree, height, DEPOSIT_CONTRACT_DEPTH)
+            self.mix_in_length += 2**height
+            if self.store is not None:
+                self.store.push_subtree(
+                    subtree.get_root(), height, leaves[offset:offset + 2**height])
+            if self.history is not None:
+                self.history.push_subtree(levels)
+            offset += 2**height
+
+@dataclass
+class IncrementalDepositTree:
+    # Same interface as DepositTree, backed by the branch arrays of the
+    # deposit contract's incremental Merkle tree instead of an object tree.
+    # branch[level] is the root of the last complete subtree at that level
+    # which makes push_leaf and get_root O(DEPOSIT_CONTRACT_DEPTH).
+    # finalized_branch is the same array at finalized_count deposits; only
+    # the leaves pushed since then are kept for generating proofs, along
+    # with the roots of the complete subtrees above them (about one per
+    # leaf) that push_leaf hashes anyway, so a proof only hashes the
+    # incomplete subtrees ending at the head: O(DEPOSIT_CONTRACT_DEPTH).
+    branch: List[Hash32]
+    mix_in_length: uint
+    finalized_branch: List[Hash32]
+    finalized_count: uint
+    pending: List[Hash32]
+    finalized_execution_block: Optional[Tuple[Hash32, uint64]]
+    # roots of the complete subtrees that are not finalized entirely, keyed
+    # by (level, position), level > 0
+    nodes: Dict[Tuple[uint, uint], Hash32] = field(default_factory=dict)
+    def new() -> IncrementalDepositTree:
+        return IncrementalDepositTree(
+            list(zerohashes), 0, list(zerohashes), 0, [], None)
+    def get_snapshot(self) -> DepositTreeSnapshot:
+        assert(self.finalized_execution_block is not None)
+        finalized = []
+        for level in reversed(range(DEPOSIT_CONTRACT_DEPTH)):
+            if (self.finalized_count >> level) & 1 == 1:
+                finalized.append(self.finalized_branch[level])
+        return DepositTreeSnapshot.from_tree_parts(
+            finalized, self.finalized_count, self.finalized_execution_block)
+    def from_snapshot(snapshot: DepositTreeSnapshot) -> IncrementalDepositTree:
+        # decent validation check on the snapshot
+        assert(snapshot.deposit_root == snapshot.calculate_root())
+        finalized_execution_block = (snapshot.execution_block_hash, snapshot.execution_block_height)
+        branch = list(zerohashes)
+        index = 0
+        for level in reversed(range(DEPOSIT_CONTRACT_DEPTH)):
+            if (snapshot.deposit_count >> level) & 1 == 1:
+                branch[level] = snapshot.finalized[index]
+                index += 1
+        return IncrementalDepositTree(
+            branch, snapshot.deposit_count, list(branch),
+            snapshot.deposit_count, [], finalized_execution_block)
+    def finalize(self, eth1_data: Eth1Data, execution_block_height: uint64):
+        self.finalized_execution_block = (eth1_data.block_hash, execution_block_height)
+        deposits_to_finalize = eth1_data.deposit_count - self.finalized_count
+        if deposits_to_finalize <= 0:
+            return
+        for leaf in self.pending[:deposits_to_finalize]:
+            self.finalized_count += 1
+            push_to_branch(self.finalized_branch, self.finalized_count, leaf)
+        self.pending = self.pending[deposits_to_finalize:]
+        self.nodes = {(level, position): node for (level, position), node in self.nodes.items()
+                      if (position + 1) << level > self.finalized_count}
+    def get_proof(self, index: uint) -> Tuple[Hash32, List[Hash32]]:
+        assert(self.mix_in_length > 0)
+        # ensure index > finalized deposit index
+        assert(index > self.finalized_count - 1)
+        proof = []
+        for level in range(DEPOSIT_CONTRACT_DEPTH):
+            proof.append(self.get_node((index >> level) ^ 1, level))
+        proof.append(to_le_bytes(self.mix_in_length))
+        return self.pending[index - self.finalized_count], proof
+    def get_node(self, position: uint, level: uint) -> Hash32:
+        # root of the subtree at the given position and level, read from
+        # the finalized branch, the pending leaves, the complete subtrees or
+        # zero subtrees, only the incomplete subtree at the head is hashed
+        start = position << level
+        if start >= self.mix_in_length:
+            return zerohashes[level]
+        if start + 2**level <= self.finalized_count:
+            # only the last complete finalized subtree of each level can
+            # be reached from a node that is not finalized entirely
+            assert(self.finalized_count >> level == position + 1)
+            return self.finalized_branch[level]
+        if level == 0:
+            return self.pending[start - self.finalized_count]
+        if start + 2**level <= self.mix_in_length:
+            return self.nodes[(level, position)]
+        left = self.get_node(position * 2, level - 1)
+        right = self.get_node(position * 2 + 1, level - 1)
+        return sha256(left + right)
+    def get_root(self) -> Hash32:
+        size = self.mix_in_length
+        root = zerohashes[0]
+        for level in range(DEPOSIT_CONTRACT_DEPTH):
+            if (size & 1) == 1:
+                root = sha256(self.branch[level] + root)
+            else:
+                root = sha256(root + zerohashes[level])
+            size >>= 1
+        return sha256(root + to_le_bytes(self.mix_in_length))
+    def push_leaf(self, leaf: Hash32):
+        # push_to_branch keeping the roots of the completed subtrees
+        self.mix_in_length += 1
+        self.pending.append(leaf)
+        size = self.mix_in_length
+        node = leaf
+        for level in range(DEPOSIT_CONTRACT_DEPTH):
+            if (size & 1) == 1:
+                self.branch[level] = node
+                return
+            node = sha256(self.branch[level] + node)
+            size >>= 1
+            self.nodes[(level + 1, size - 1)] = node
+
+def push_to_branch(branch: List[Hash32], size: uint, leaf: Hash32, height: uint = 0) -> uint:
+    # deposit contract update of the branch array after the leaf has been
+    # appended as the size-th leaf of the tree, returns the updated level.
+    # With a height, leaf is the root of a complete subtree of 2**height
+    # leaves ending at the size-th one; the levels below it are not updated
+    # since no later push or root reads them.
+    node = leaf
+    size >>= height
+    for level in range(height, DEPOSIT_CONTRACT_DEPTH):
+        if (size & 1) == 1:
+            branch[level] = node
+            return level
+        node = sha256(branch[level] + node)
+        size >>= 1
+
+# DepositStore file layout: finalized count, deposit count and execution
+# block height (8 bytes little endian each), a flag set once the store has
+# been finalized, the execution block hash, then the finalized branch and
+# the frontier (DEPOSIT_CONTRACT_DEPTH hashes each), followed by the
+# pending leaves from the finalized count up to the deposit count. The
+# frontier, the pending leaves and the deposit count are only written by
+# flush, finalize and close; after a crash the store is back at the last
+# flushed head. Finalization drops the finalized leaves from the file.
+STORE_HEADER_SIZE = 64
+STORE_FINALIZED_OFFSET = STORE_HEADER_SIZE
+STORE_FRONTIER_OFFSET = STORE_FINALIZED_OFFSET + 32 * DEPOSIT_CONTRACT_DEPTH
+STORE_SIZE = STORE_FRONTIER_OFFSET + 32 * DEPOSIT_CONTRACT_DEPTH
+
+@dataclass
+class DepositStore:
+    # Finalized branch (as in IncrementalDepositTree, only the levels of
+    # the set bits of finalized_count are meaningful) and frontier (the
+    # branch array at the head) of a deposit tree, mirrored in a fixed-size
+    # file in which every update only rewrites the changed fields.
+    file: BinaryIO
+    finalized_branch: List[Hash32]
+    finalized_count: uint
+    finalized_execution_block: Optional[Tuple[Hash32, uint64]]
+    branch: List[Hash32]
+    mix_in_length: uint
+    # leaves pushed since finalized_count, see DepositTree.from_store
+    pending: List[Hash32] = field(default_factory=list)
+    # frontier levels changed and number of pending leaves written to the
+    # file since the last flush
+    updated: Set[uint] = field(default_factory=set)
+    written: uint = 0
+    def open(path: str) -> DepositStore:
+        if not(os.path.exists(path)) or os.path.getsize(path) == 0:
+            store = DepositStore(
+                open(path, "w+b"), list(zerohashes), 0, None, list(zerohashes), 0)
+            store.write(0, store.encode_header())
+            store.write(STORE_FINALIZED_OFFSET, b"".join(store.finalized_branch))
+            store.write(STORE_FRONTIER_OFFSET, b"".join(store.branch))
+            store.file.flush()
+            return store
+        file = open(path, "r+b")
+        data = file.read()
+        finalized_count = int.from_bytes(data[0:8], "little")
+        mix_in_length = int.from_bytes(data[8:16], "little")
+        # leaves written after the last flushed head are ignored
+        pending_count = mix_in_length - finalized_count
+        assert(len(data) >= STORE_SIZE + 32 * pending_count)
+        finalized_execution_block = None
+        if data[24] == 1:
+            finalized_execution_block = (data[32:64], int.from_bytes(data[16:24], "little"))
+        finalized_branch = [data[offset:offset + 32]
+                            for offset in range(STORE_FINALIZED_OFFSET, STORE_FRONTIER_OFFSET, 32)]
+        branch = [data[offset:offset + 32]
+                  for offset in range(STORE_FRONTIER_OFFSET, STORE_SIZE, 32)]
+        pending = [data[offset:offset + 32]
+                   for offset in range(STORE_SIZE, STORE_SIZE + 32 * pending_count, 32)]
+        return DepositStore(file, finalized_branch, finalized_count,
+                            finalized_execution_block, branch, mix_in_length,
+                            pending, written=pending_count)
+    def close(self):
+        self.flush()
+        self.file.close()
+    def encode_header(self) -> bytes:
+        block_hash, block_height = self.finalized_execution_block or (bytes(32), 0)
+        return (self.finalized_count.to_bytes(8, "little") +
+                self.mix_in_length.to_bytes(8, "little") +
+                block_height.to_bytes(8, "little") +
+                (b"\x00" if self.finalized_execution_block is None else b"\x01") +
+                bytes(7) + block_hash)
+    def write(self, offset: uint, data: bytes):
+        self.file.seek(offset)
+        self.file.write(data)
+    def flush(self):
+        # writes the frontier levels changed and the leaves pushed since the
+        # last flush, followed by the header with the deposit count
+        for level in sorted(self.updated):
+            self.write(STORE_FRONTIER_OFFSET + 32 * level, self.branch[level])
+        self.updated.clear()
+        if self.written < len(self.pending):
+            self.write(STORE_SIZE + 32 * self.written, b"".join(self.pending[self.written:]))
+            self.written = len(self.pending)
+        self.write(0, self.encode_header())
+        self.file.flush()
+    def get_snapshot(self) -> DepositTreeSnapshot:
+        assert(self.finalized_execution_block is not None)
+        finalized = []
+        for level in reversed(range(DEPOSIT_CONTRACT_DEPTH)):
+            if (self.finalized_count >> level) & 1 == 1:
+                finalized.append(self.finalized_branch[level])
+        return DepositTreeSnapshot.from_tree_parts(
+            finalized, self.finalized_count, self.finalized_execution_block)
+    def get_root(self) -> Hash32:
+        size = self.mix_in_length
+        root = zerohashes[0]
+        for level in range(DEPOSIT_CONTRACT_DEPTH):
+            if (size & 1) == 1:
+                root = sha256(self.branch[level] + root)
+            else:
+                root = sha256(root + zerohashes[level])
+            size >>= 1
+        return sha256(root + to_le_bytes(self.mix_in_length))
+    def finalize(self, finalized: List[Hash32], deposit_count: uint,
+                 execution_block: Tuple[Hash32, uint64]):
+        # finalized holds the hashes of the set bits of deposit_count from
+        # the most significant one, as in DepositTreeSnapshot
+        index = 0
+        for level in reversed(range(DEPOSIT_CONTRACT_DEPTH)):
+            if (deposit_count >> level) & 1 == 1:
+                if self.finalized_branch[level] != finalized[index]:
+                    self.finalized_branch[level] = finalized[index]
+                    self.write(STORE_FINALIZED_OFFSET + 32 * level, finalized[index])
+                index += 1
+        # the remaining pending leaves are rewritten by flush
+        del self.pending[:deposit_count - self.finalized_count]
+        self.file.truncate(STORE_SIZE)
+        self.written = 0
+        self.finalized_count = deposit_count
+        self.finalized_execution_block = execution_block
+        self.flush()
+    def push_leaves(self, leaves: List[Hash32]):
+        # only updates the frontier and the pending leaves in memory, see
+        # flush
+        for leaf in leaves:
+            self.push_subtree(leaf, 0, [leaf])
+    def push_subtree(self, root: Hash32, height: uint, leaves: List[Hash32]):
+        # pushes the 2**height leaves of a complete subtree, updating the
+        # frontier by its root
+        self.mix_in_length += 2**height
+        self.updated.add(push_to_branch(self.branch, self.mix_in_length, root, height))
+        self.pending.extend(leaves)
+
+@dataclass
+class DepositRootHistory:
+    # Roots of the complete subtrees at even positions, the only ones that
+    # ever become branch[level] in the deposit contract (when the size
+    # reaches a multiple of 2**level with bit level set). levels[level]
+    # concatenates the roots of positions 2 * offsets[level], 2 *
+    # (offsets[level] + 1), ... so the branch array at any count since
+    # first_count is read back with one lookup per level; the history
+    # takes about 32 bytes per deposit.
+    levels: List[bytearray]
+    offsets: List[uint]
+    first_count: uint
+    deposit_count: uint
+    def new() -> DepositRootHistory:
+        return DepositRootHistory(
+            [bytearray() for _ in range(DEPOSIT_CONTRACT_DEPTH)],
+            [0] * DEPOSIT_CONTRACT_DEPTH, 0, 0)
+    def from_snapshot(snapshot: DepositTreeSnapshot) -> DepositRootHistory:
+        # history starting at the snapshot, older roots are not available
+        count = snapshot.deposit_count
+        history = DepositRootHistory(
+            [bytearray() for _ in range(DEPOSIT_CONTRACT_DEPTH)],
+            [count >> (level + 1) for level in range(DEPOSIT_CONTRACT_DEPTH)],
+            count, count)
+        index = 0
+        for level in reversed(range(DEPOSIT_CONTRACT_DEPTH)):
+            if (count >> level) & 1 == 1:
+                history.levels[level] += snapshot.finalized[index]
+                index += 1
+        return history
+    def push_leaf(self, leaf: Hash32):
+        self.push_subtree([leaf])
+    def push_subtree(self, levels: List[bytes]):
+        # push_to_branch appending to the history instead of overwriting.
+        # levels are the hashes of a complete subtree level by level as
+        # collected by MerkleTree.create_complete, the roots at its even
+        # positions are appended as they are
+        height = len(levels) - 1
+        self.deposit_count += 2**height
+        for level in range(height):
+            self.levels[level] += b"".join(
+                levels[level][i:i + 32] for i in range(0, len(levels[level]), 64))
+        size = self.deposit_count >> height
+        node = levels[height]
+        for level in range(height, DEPOSIT_CONTRACT_DEPTH):
+            if (size & 1) == 1:
+                self.levels[level] += node
+                return
+            node = sha256(self.levels[level][-32:] + node)
+            size >>= 1
+    def root_at(self, deposit_count: uint) -> Hash32:
+        assert(self.first_count <= deposit_count <= self.deposit_count)
+        size = deposit_count
+        root = zerohashes[0]
+        for level in range(DEPOSIT_CONTRACT_DEPTH):
+            if (size & 1) == 1:
+                index = 32 * ((deposit_count >> (level + 1)) - self.offsets[level])
+                root = sha256(self.levels[level][index:index + 32] + root)
+            else:
+                root = sha256(root + zerohashes[level])
+            size >>= 1
+        return sha256(root + to_le_bytes(deposit_count))
 
 class MerkleTree():
+    __slots__ = ()
     @abstractmethod
     def get_root(self) -> Hash32:
         pass
@@ -81,6 +487,11 @@ class MerkleTree():
     def push_leaf(self, leaf: Hash32, level: uint) -> MerkleTree:
         pass
     @abstractmethod
+    def push_subtree(self, subtree: MerkleTree, height: uint, level: uint) -> MerkleTree:
+        # inserts a complete subtree of the given height at the next
+        # deposit index, which must be a multiple of 2**height
+        pass
+    @abstractmethod
     def finalize(self, deposits_to_finalize: uint, level: uint) -> MerkleTree:
         pass
     @abstractmethod
@@ -97,20 +508,43 @@ class MerkleTree():
         left = MerkleTree.create(leaves[0:split], depth - 1)
         right = MerkleTree.create(leaves[split:], depth - 1)
         return Node(left, right)
-    def from_snapshot_parts(finalized: List[Hash32], deposits: uint, level: uint) -> MerkleTree:
-        if not(finalized) or not(deposits):
+    def create_complete(leaves: List[Hash32], levels: Optional[List[bytes]] = None) -> MerkleTree:
+        # builds a complete subtree (len(leaves) is a power of 2) bottom-up,
+        # hashing each level from one contiguous buffer of the level below.
+        # The buffers (leaves first, root last) are appended to levels
+        if levels is None:
+            levels = []
+        nodes = [Leaf(leaf) for leaf in leaves]
+        levels.append(b"".join(leaves))
+        while len(nodes) > 1:
+            buffer = memoryview(levels[-1])
+            hashes = [sha256(buffer[i:i + 64]) for i in range(0, len(buffer), 64)]
+            parents = []
+            for i, root in enumerate(hashes):
+                node = Node(nodes[2 * i], nodes[2 * i + 1])
+                node.root = root
+                parents.append(node)
+            nodes = parents
+            levels.append(b"".join(hashes))
+        return nodes[0]
+    def from_snapshot_parts(finalized: List[Hash32], deposits: uint, level: uint,
+                            index: uint = 0) -> MerkleTree:
+        # index is the position in finalized of the first hash of this
+        # subtree, instead of a copy of the remaining hashes at every level
+        if index == len(finalized) or not(deposits):
             # empty tree
             return Zero(level)
         if deposits == 2**level:
-            return Finalized(deposits, finalized[0])
+            return Finalized(deposits, finalized[index])
         left_subtree = 2**(level - 1)
         if deposits <= left_subtree:
-            left = MerkleTree.from_snapshot_parts(finalized, deposits, level - 1)
+            left = MerkleTree.from_snapshot_parts(finalized, deposits, level - 1, index)
             right = Zero(level - 1)
             return Node(left, right)
         else:
-            left = Finalized(left_subtree, finalized[0])
-            right = MerkleTree.from_snapshot_parts(finalized[1:], deposits - left_subtree, level - 1)
+            left = Finalized(left_subtree, finalized[index])
+            right = MerkleTree.from_snapshot_parts(
+                finalized, deposits - left_subtree, level - 1, index + 1)
             return Node(left, right)
     def generate_proof(self, index: uint, depth: uint) -> Tuple[Hash32, List[Hash32]]:
         proof = []
@@ -126,9 +560,22 @@ class MerkleTree():
             depth -= 1
         proof.reverse()
         return node.get_root(), proof
+    def get_range_nodes(self, start: uint, end: uint, level: uint, position: uint,
+                        nodes: Dict[Tuple[uint, uint], Hash32]):
+        # collects the roots of the leaves in [start, end) and of the subtrees
+        # bordering the range below this node, keyed by (level, position)
+        first = position << level
+        if level == 0 or first >= end or first + 2**level <= start:
+            nodes[(level, position)] = self.get_root()
+            return
+        # only a Node can partially overlap the range
+        assert(isinstance(self, Node))
+        self.left.get_range_nodes(start, end, level - 1, position * 2, nodes)
+        self.right.get_range_nodes(start, end, level - 1, position * 2 + 1, nodes)
 
 @dataclass
 class Finalized(MerkleTree):
+    __slots__ = ("deposit_count", "hash")
     deposit_count: uint
     hash: Hash32
     def get_root(self) -> Hash32:
@@ -143,6 +590,7 @@ class Finalized(MerkleTree):
 
 @dataclass
 class Leaf(MerkleTree):
+    __slots__ = ("hash",)
     hash: Hash32
     def get_root(self) -> Hash32:
         return self.hash
@@ -155,18 +603,34 @@ class Leaf(MerkleTree):
 
 @dataclass
 class Node(MerkleTree):
+    # the root is cached until a leaf is pushed below the node; finalizing
+    # replaces subtrees with Finalized nodes of the same root so it keeps
+    # the cached roots valid
+    __slots__ = ("left", "right", "root")
     left: MerkleTree
     right: MerkleTree
+    def __post_init__(self):
+        self.root = None
     def get_root(self) -> Hash32:
-        return sha256(self.left.get_root() + self.right.get_root())
+        if self.root is None:
+            self.root = sha256(self.left.get_root() + self.right.get_root())
+        return self.root
     def is_full(self) -> bool:
         return self.right.is_full()
     def push_leaf(self, leaf: Hash32, level: uint) -> MerkleTree:
+        self.root = None
         if not(self.left.is_full()):
             self.left = self.left.push_leaf(leaf, level - 1)
         else:
             self.right = self.right.push_leaf(leaf, level - 1)
         return self
+    def push_subtree(self, subtree: MerkleTree, height: uint, level: uint) -> MerkleTree:
+        self.root = None
+        if not(self.left.is_full()):
+            self.left = self.left.push_subtree(subtree, height, level - 1)
+        else:
+            self.right = self.right.push_subtree(subtree, height, level - 1)
+        return self
     def finalize(self, deposits_to_finalize: uint, level: uint) -> MerkleTree:
         deposits = 2**level
         if deposits <= deposits_to_finalize:
@@ -181,6 +645,7 @@ class Node(MerkleTree):
 
 @dataclass
 class Zero(MerkleTree):
+    __slots__ = ("n",)
     n: uint64
     def get_root(self) -> Hash32:
         if self.n == DEPOSIT_CONTRACT_DEPTH:
@@ -193,6 +658,11 @@ class Zero(MerkleTree):
         return False
     def push_leaf(self, leaf: Hash32, level: uint) -> MerkleTree:
         return MerkleTree.create([leaf], level)
+    def push_subtree(self, subtree: MerkleTree, height: uint, level: uint) -> MerkleTree:
+        if level == height:
+            return subtree
+        left = Zero(level - 1).push_subtree(subtree, height, level - 1)
+        return Node(left, Zero(level - 1))
     def get_finalized(self, result: List[Hash32]) -> uint:
         return 0
 
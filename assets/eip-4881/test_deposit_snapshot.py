@@ -1,9 +1,11 @@
 #!/usr/bin/env python3
+import mmap
+import os
 import pytest
-import yaml
+import tempfile
 from dataclasses import dataclass
-from deposit_snapshot import DepositTree,DepositTreeSnapshot
-from eip_4881 import DepositData,Eth1Data,Hash32,sha256,uint64,zerohashes
+from deposit_snapshot import DepositRootHistory,DepositStore,DepositTree,DepositTreeSnapshot,IncrementalDepositTree
+from eip_4881 import DEPOSIT_CONTRACT_DEPTH,DepositData,Eth1Data,Hash32,sha256,uint64,zerohashes
 
 @dataclass
 class DepositTestCase:
@@ -19,7 +21,9 @@ def get_hex(some_bytes) -> str:
 def get_bytes(hexstr) -> bytes:
     return bytes.fromhex(hexstr.replace("0x",""))
 
-def read_test_cases(filename):
+def parse_test_cases(filename):
+    # only needed to (re)build the cache of read_test_cases
+    import yaml
     with open(filename, "r") as file:
         try:
             test_cases = yaml.safe_load(file)
@@ -58,6 +62,102 @@ def read_test_cases(filename):
             print(exc)
             assert(False)
 
+# Test cases are cached as fixed-width records behind a header holding the
+# format version, the modification time and size of the yaml file they
+# were converted from and the sha256 of the records. A record is the
+# deposit data, its root, the eth1 data, the block height and the
+# snapshot, whose finalized hashes are padded to the maximum count after a
+# byte giving their number. Integers are 8 bytes little endian.
+# CACHE_VERSION has to be increased whenever the layout changes.
+CACHE_VERSION = 2
+CACHE_HEADER_SIZE = 8 + 8 + 8 + 32
+CACHE_RECORD_SIZE = 48 + 32 + 8 + 96 + 32 + 32 + 8 + 32 + 8 + 1 + 32 * DEPOSIT_CONTRACT_DEPTH + 32 + 8 + 32 + 8
+
+def default_cache_filename(filename) -> str:
+    path_hash = sha256(os.path.abspath(filename).encode()).hex()[:16]
+    return os.path.join(tempfile.gettempdir(),
+                        "eip4881-test-cases-v{}-{}.bin".format(CACHE_VERSION, path_hash))
+
+def encode_test_case(test_case) -> bytes:
+    deposit_data = test_case.deposit_data
+    eth1_data = test_case.eth1_data
+    snapshot = test_case.snapshot
+    record = b"".join([
+        deposit_data.pubkey,
+        deposit_data.withdrawal_credentials,
+        deposit_data.amount.to_bytes(8, "little"),
+        deposit_data.signature,
+        test_case.deposit_data_root,
+        eth1_data.deposit_root,
+        eth1_data.deposit_count.to_bytes(8, "little"),
+        eth1_data.block_hash,
+        test_case.block_height.to_bytes(8, "little"),
+        len(snapshot.finalized).to_bytes(1, "little"),
+        b"".join(snapshot.finalized).ljust(32 * DEPOSIT_CONTRACT_DEPTH, b"\x00"),
+        snapshot.deposit_root,
+        snapshot.deposit_count.to_bytes(8, "little"),
+        snapshot.execution_block_hash,
+        snapshot.execution_block_height.to_bytes(8, "little"),
+    ])
+    assert(len(record) == CACHE_RECORD_SIZE)
+    return record
+
+def decode_test_case(data, offset) -> DepositTestCase:
+    def take(size) -> bytes:
+        nonlocal offset
+        offset += size
+        return data[offset - size:offset]
+    def take_int() -> int:
+        return int.from_bytes(take(8), "little")
+    deposit_data = DepositData(take(48), take(32), take_int(), take(96))
+    deposit_data_root = take(32)
+    eth1_data = Eth1Data(take(32), take_int(), take(32))
+    block_height = take_int()
+    finalized_count = take(1)[0]
+    finalized_data = take(32 * DEPOSIT_CONTRACT_DEPTH)
+    finalized = [finalized_data[32 * i:32 * (i + 1)] for i in range(finalized_count)]
+    snapshot = DepositTreeSnapshot(finalized, take(32), take_int(), take(32), take_int())
+    return DepositTestCase(deposit_data, deposit_data_root, eth1_data, block_height, snapshot)
+
+def read_cache(cache_filename, key):
+    # returns None if the cache is missing, stale, truncated or corrupt
+    try:
+        file = open(cache_filename, "rb")
+    except FileNotFoundError:
+        return None
+    with file:
+        if os.fstat(file.fileno()).st_size < CACHE_HEADER_SIZE:
+            return None
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            with memoryview(data) as view:
+                records = view[CACHE_HEADER_SIZE:]
+                valid = (data[:len(key)] == key and len(records) % CACHE_RECORD_SIZE == 0
+                         and data[len(key):CACHE_HEADER_SIZE] == sha256(records))
+                records.release()
+            if not(valid):
+                return None
+            return [decode_test_case(data, offset)
+                    for offset in range(CACHE_HEADER_SIZE, len(data), CACHE_RECORD_SIZE)]
+
+def read_test_cases(filename, cache_filename=None):
+    # converts the yaml file once, later reads map the cache until the
+    # yaml file or the cache format changes; an invalid cache is rebuilt
+    if cache_filename is None:
+        cache_filename = default_cache_filename(filename)
+    stat = os.stat(filename)
+    key = b"".join(value.to_bytes(8, "little")
+                   for value in [CACHE_VERSION, stat.st_mtime_ns, stat.st_size])
+    test_cases = read_cache(cache_filename, key)
+    if test_cases is None:
+        test_cases = parse_test_cases(filename)
+        records = b"".join(encode_test_case(test_case) for test_case in test_cases)
+        # written aside and renamed so concurrent readers never see a partial cache
+        temporary = "{}.{}".format(cache_filename, os.getpid())
+        with open(temporary, "wb") as file:
+            file.write(key + sha256(records) + records)
+        os.replace(temporary, cache_filename)
+    return test_cases
+
 def merkle_root_from_branch(leaf, branch, index) -> Hash32:
     root = leaf
     for (i, leaf) in enumerate(branch):
@@ -68,6 +168,17 @@ def merkle_root_from_branch(leaf, branch, index) -> Hash32:
             root = sha256(root + leaf)
     return root
 
+def merkle_root_from_range(leaves, branch, start) -> Hash32:
+    siblings = iter(branch)
+    nodes = leaves
+    for level in range(DEPOSIT_CONTRACT_DEPTH):
+        if (start >> level) & 1 == 1:
+            nodes = [next(siblings)] + nodes
+        if len(nodes) & 1 == 1:
+            nodes = nodes + [next(siblings)]
+        nodes = [sha256(nodes[i] + nodes[i + 1]) for i in range(0, len(nodes), 2)]
+    return sha256(nodes[0] + next(siblings))
+
 def check_proof(tree, index):
     leaf, proof = tree.get_proof(index)
     calc_root = merkle_root_from_branch(leaf, proof, index)
@@ -158,3 +269,208 @@ def test_invalid_snapshot():
         invalid_snapshot = DepositTreeSnapshot([], zerohashes[0], 0, zerohashes[0], 0)
         tree = DepositTree.from_snapshot(invalid_snapshot)
 
+
+def test_incremental_deposit_cases():
+    tree = IncrementalDepositTree.new()
+    assert(tree.get_root() == DepositTree.new().get_root())
+    test_cases = read_test_cases("test_cases.yaml")
+    for case in test_cases:
+        tree.push_leaf(case.deposit_data_root)
+        assert(tree.get_root() == case.eth1_data.deposit_root)
+
+def test_incremental_finalization():
+    tree = IncrementalDepositTree.new()
+    reference = DepositTree.new()
+    test_cases = read_test_cases("test_cases.yaml")[:128]
+    for case in test_cases:
+        tree.push_leaf(case.deposit_data_root)
+        reference.push_leaf(case.deposit_data_root)
+    original_root = tree.get_root()
+    tree.finalize(test_cases[100].eth1_data, test_cases[100].block_height)
+    reference.finalize(test_cases[100].eth1_data, test_cases[100].block_height)
+    assert(tree.get_root() == original_root)
+    assert(tree.get_snapshot() == test_cases[100].snapshot)
+    copy = IncrementalDepositTree.from_snapshot(tree.get_snapshot())
+    for case in test_cases[101:128]:
+        copy.push_leaf(case.deposit_data_root)
+    tree.finalize(test_cases[105].eth1_data, test_cases[105].block_height)
+    reference.finalize(test_cases[105].eth1_data, test_cases[105].block_height)
+    assert(tree.get_snapshot() == test_cases[105].snapshot)
+    for index in range(106, 128):
+        assert(tree.get_proof(index) == reference.get_proof(index))
+        compare_proof(tree, copy, index)
+
+def test_incremental_proofs():
+    # proofs with the head at every position of the complete subtrees
+    tree = IncrementalDepositTree.new()
+    reference = DepositTree.new()
+    test_cases = read_test_cases("test_cases.yaml")[:70]
+    for count, case in enumerate(test_cases, 1):
+        tree.push_leaf(case.deposit_data_root)
+        reference.push_leaf(case.deposit_data_root)
+        if count % 9 == 0:
+            tree.finalize(case.eth1_data, case.block_height)
+            reference.finalize(case.eth1_data, case.block_height)
+        for index in range(tree.finalized_count, count):
+            assert(tree.get_proof(index) == reference.get_proof(index))
+
+def test_incremental_snapshot_cases():
+    tree = IncrementalDepositTree.new()
+    test_cases = read_test_cases("test_cases.yaml")
+    for case in test_cases:
+        tree.push_leaf(case.deposit_data_root)
+    for case in test_cases:
+        tree.finalize(case.eth1_data, case.block_height)
+        assert(tree.get_snapshot() == case.snapshot)
+        assert(tree.get_root() == test_cases[-1].eth1_data.deposit_root)
+
+def test_range_proofs():
+    test_cases = read_test_cases("test_cases.yaml")
+    tree = DepositTree.new()
+    for case in test_cases:
+        tree.push_leaf(case.deposit_data_root)
+    tree.finalize(test_cases[4].eth1_data, test_cases[4].block_height)
+    for start, count in [(5, 1), (5, 16), (6, 3), (7, len(test_cases) - 7), (10, 6)]:
+        proofs = tree.get_proofs(start, count)
+        assert(len(proofs) == count)
+        for index, proof in enumerate(proofs, start):
+            assert(proof == tree.get_proof(index))
+        leaves, branch = tree.get_range_proof(start, count)
+        assert(leaves == [proof[0] for proof in proofs])
+        assert(len(branch) <= DEPOSIT_CONTRACT_DEPTH + count)
+        assert(merkle_root_from_range(leaves, branch, start) == tree.get_root())
+    # finalized deposits have no proofs
+    with pytest.raises(AssertionError):
+        tree.get_proofs(4, 2)
+    with pytest.raises(AssertionError):
+        tree.get_proofs(len(test_cases) - 1, 2)
+
+def test_push_leaves():
+    test_cases = read_test_cases("test_cases.yaml")
+    leaves = [case.deposit_data_root for case in test_cases]
+    tree = DepositTree.new()
+    bulk = DepositTree.new()
+    # batches of various sizes starting at unaligned indices
+    start = 0
+    for count in [1, 2, 5, 8, 16, 1, 30, 64, 100]:
+        for leaf in leaves[start:start + count]:
+            tree.push_leaf(leaf)
+        bulk.push_leaves(iter(leaves[start:start + count]))
+        start += count
+        assert(bulk.mix_in_length == start)
+        assert(bulk.get_root() == tree.get_root())
+        compare_proof(tree, bulk, start - 1)
+    tree.finalize(test_cases[start - 1].eth1_data, test_cases[start - 1].block_height)
+    bulk.finalize(test_cases[start - 1].eth1_data, test_cases[start - 1].block_height)
+    assert(bulk.get_snapshot() == tree.get_snapshot())
+    bulk.push_leaves(leaves[start:])
+    assert(bulk.get_root() == test_cases[-1].eth1_data.deposit_root)
+
+def test_deposit_store(tmp_path):
+    test_cases = read_test_cases("test_cases.yaml")
+    path = str(tmp_path / "deposits.bin")
+    tree = DepositTree.new()
+    tree.store = DepositStore.open(path)
+    for count in [5, 6, 7, 20, 21, 64, 100]:
+        tree.push_leaves([case.deposit_data_root for case in test_cases[tree.mix_in_length:count]])
+        tree.push_leaf(test_cases[count].deposit_data_root)
+        assert(tree.store.get_root() == tree.get_root())
+        case = test_cases[count - 1]
+        tree.finalize(case.eth1_data, case.block_height)
+        assert(tree.get_snapshot() == case.snapshot)
+    tree.push_leaves([case.deposit_data_root for case in test_cases[101:110]])
+    tree.store.close()
+    # the file alone restores the tree at the head
+    store = DepositStore.open(path)
+    assert(store.mix_in_length == 110)
+    assert(store.get_root() == test_cases[109].eth1_data.deposit_root)
+    assert(store.get_snapshot() == test_cases[99].snapshot)
+    copy = DepositTree.from_store(store)
+    assert(copy.get_root() == test_cases[109].eth1_data.deposit_root)
+    assert(copy.get_snapshot() == test_cases[99].snapshot)
+    # the deposits after the finalized ones can still be proven
+    for index in [100, 105, 109]:
+        check_proof(copy, index)
+    for case in test_cases[110:]:
+        copy.push_leaf(case.deposit_data_root)
+    assert(copy.get_root() == test_cases[-1].eth1_data.deposit_root)
+    assert(store.get_root() == copy.get_root())
+    last = len(test_cases) - 1
+    check_proof(copy, last)
+    copy.finalize(test_cases[104].eth1_data, test_cases[104].block_height)
+    assert(copy.get_snapshot() == test_cases[104].snapshot)
+    store.close()
+    # the finalized leaves are dropped from the file, the pending ones kept
+    store = DepositStore.open(path)
+    assert(len(store.pending) == len(test_cases) - 105)
+    copy = DepositTree.from_store(store)
+    assert(copy.get_root() == test_cases[-1].eth1_data.deposit_root)
+    check_proof(copy, 105)
+    copy.finalize(test_cases[last - 1].eth1_data, test_cases[last - 1].block_height)
+    assert(copy.get_snapshot() == test_cases[last - 1].snapshot)
+    store.close()
+    store = DepositStore.open(path)
+    assert(store.get_snapshot() == test_cases[last - 1].snapshot)
+    assert(store.get_root() == test_cases[-1].eth1_data.deposit_root)
+    store.close()
+    # a store that has never been finalized
+    path = str(tmp_path / "unfinalized.bin")
+    tree = DepositTree.new()
+    tree.store = DepositStore.open(path)
+    tree.push_leaves([case.deposit_data_root for case in test_cases[:30]])
+    tree.store.close()
+    copy = DepositTree.from_store(DepositStore.open(path))
+    assert(copy.finalized_execution_block is None)
+    assert(copy.get_root() == test_cases[29].eth1_data.deposit_root)
+    check_proof(copy, 0)
+    copy.push_leaf(test_cases[30].deposit_data_root)
+    copy.finalize(test_cases[30].eth1_data, test_cases[30].block_height)
+    assert(copy.get_snapshot() == test_cases[30].snapshot)
+    copy.store.close()
+
+def test_test_case_cache(tmp_path):
+    filename = str(tmp_path / "test_cases.yaml")
+    cache_filename = str(tmp_path / "test_cases.bin")
+    with open("test_cases.yaml", "rb") as source, open(filename, "wb") as file:
+        file.write(source.read())
+    expected = parse_test_cases(filename)
+    assert(read_test_cases(filename, cache_filename) == expected)
+    cache_mtime = os.stat(cache_filename).st_mtime_ns
+    assert(read_test_cases(filename, cache_filename) == expected)
+    assert(os.stat(cache_filename).st_mtime_ns == cache_mtime)
+    # a truncated or corrupt cache is rebuilt
+    with open(cache_filename, "r+b") as file:
+        file.truncate(os.path.getsize(cache_filename) - CACHE_RECORD_SIZE)
+    assert(read_test_cases(filename, cache_filename) == expected)
+    with open(cache_filename, "r+b") as file:
+        file.seek(CACHE_HEADER_SIZE + 100)
+        file.write(b"\xff")
+    assert(read_test_cases(filename, cache_filename) == expected)
+    with open(cache_filename, "rb") as file:
+        key = file.read(24)
+    assert(read_cache(cache_filename, key) == expected)
+    # a changed yaml file invalidates the cache
+    with open(filename, "w") as file:
+        file.write("[]\n")
+    assert(read_test_cases(filename, cache_filename) == [])
+
+def test_root_at():
+    test_cases = read_test_cases("test_cases.yaml")
+    tree = DepositTree.new()
+    tree.history = DepositRootHistory.new()
+    empty_root = tree.get_root()
+    tree.push_leaves([case.deposit_data_root for case in test_cases[:100]])
+    for case in test_cases[100:]:
+        tree.push_leaf(case.deposit_data_root)
+    assert(tree.root_at(0) == empty_root)
+    for case in test_cases:
+        assert(tree.root_at(case.eth1_data.deposit_count) == case.eth1_data.deposit_root)
+    # a history restored from a snapshot starts at its deposit count
+    snapshot = test_cases[99].snapshot
+    copy = DepositTree.from_snapshot(snapshot)
+    copy.history = DepositRootHistory.from_snapshot(snapshot)
+    copy.push_leaves([case.deposit_data_root for case in test_cases[100:]])
+    for case in test_cases[99:]:
+        assert(copy.root_at(case.eth1_data.deposit_count) == case.eth1_data.deposit_root)
+    with pytest.raises(AssertionError):
+        copy.root_at(snapshot.deposit_count - 1)
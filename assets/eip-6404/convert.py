@@ -2,161 +2,188 @@ from rlp import decode
 from rlp_types import *
 from ssz_types import *
 
-def upgrade_rlp_transaction_to_ssz(tx_bytes: bytes):
-    type_ = tx_bytes[0]
+def upgrade_access_list(access_list) -> list[AccessTuple]:
+    return [AccessTuple(
+        address=access_tuple[0],
+        storage_keys=access_tuple[1]
+    ) for access_tuple in access_list]
 
-    if type_ == 0x04:  # EIP-7702
-        tx = decode(tx_bytes[1:], SetCodeRlpTransaction)
-
-        def upgrade_authorization(auth: SetCodeRlpAuthorization):
-            if auth.chain_id != 0:
-                return RlpSetCodeAuthorization(
-                    payload=RlpSetCodeAuthorizationPayload(
-                        selector=0x02,
-                        data=RlpBasicAuthorizationPayload(
-                            magic=RlpTxType.SET_CODE_MAGIC,
-                            chain_id=auth.chain_id,
-                            address=ExecutionAddress(auth.address),
-                            nonce=auth.nonce,
-                        ),
-                    ),
-                    signature=secp256k1_pack(auth.r, auth.s, auth.y_parity),
-                )
+def upgrade_set_code_rlp_transaction(tx: SetCodeRlpTransaction) -> Transaction:  # EIP-7702
+    def upgrade_authorization(auth: SetCodeRlpAuthorization):
+        if auth.chain_id != 0:
             return RlpSetCodeAuthorization(
                 payload=RlpSetCodeAuthorizationPayload(
-                    selector=0x01,
-                    data=RlpReplayableBasicAuthorizationPayload(
+                    selector=0x02,
+                    data=RlpBasicAuthorizationPayload(
                         magic=RlpTxType.SET_CODE_MAGIC,
+                        chain_id=auth.chain_id,
                         address=ExecutionAddress(auth.address),
                         nonce=auth.nonce,
                     ),
                 ),
                 signature=secp256k1_pack(auth.r, auth.s, auth.y_parity),
             )
+        return RlpSetCodeAuthorization(
+            payload=RlpSetCodeAuthorizationPayload(
+                selector=0x01,
+                data=RlpReplayableBasicAuthorizationPayload(
+                    magic=RlpTxType.SET_CODE_MAGIC,
+                    address=ExecutionAddress(auth.address),
+                    nonce=auth.nonce,
+                ),
+            ),
+            signature=secp256k1_pack(auth.r, auth.s, auth.y_parity),
+        )
 
+    return Transaction(
+        payload=TransactionPayload(
+            selector=0x0a,
+            data=RlpSetCodeTransactionPayload(
+                type_=RlpTxType.SET_CODE,
+                chain_id=tx.chain_id,
+                nonce=tx.nonce,
+                max_fees_per_gas=BasicFeesPerGas(
+                    regular=tx.max_fee_per_gas,
+                ),
+                gas=tx.gas,
+                to=ExecutionAddress(tx.to),
+                value=tx.value,
+                input_=tx.data,
+                access_list=upgrade_access_list(tx.access_list),
+                max_priority_fees_per_gas=BasicFeesPerGas(
+                    regular=tx.max_priority_fee_per_gas,
+                ),
+                authorization_list=[
+                    upgrade_authorization(auth)
+                    for auth in tx.authorization_list
+                ],
+            ),
+        ),
+        signature=secp256k1_pack(tx.r, tx.s, tx.y_parity),
+    )
+
+def upgrade_blob_rlp_transaction(tx: BlobRlpTransaction) -> Transaction:  # EIP-4844
+    return Transaction(
+        payload=TransactionPayload(
+            selector=0x09,
+            data=RlpBlobTransactionPayload(
+                type_=RlpTxType.BLOB,
+                chain_id=tx.chain_id,
+                nonce=tx.nonce,
+                max_fees_per_gas=BlobFeesPerGas(
+                    regular=tx.max_fee_per_gas,
+                    blob=tx.max_fee_per_blob_gas,
+                ),
+                gas=tx.gas,
+                to=ExecutionAddress(tx.to),
+                value=tx.value,
+                input_=tx.data,
+                access_list=upgrade_access_list(tx.access_list),
+                max_priority_fees_per_gas=BlobFeesPerGas(
+                    regular=tx.max_priority_fee_per_gas,
+                    blob=FeePerGas(0),
+                ),
+                blob_versioned_hashes=tx.blob_versioned_hashes,
+            ),
+        ),
+        signature=secp256k1_pack(tx.r, tx.s, tx.y_parity),
+    )
+
+def upgrade_fee_market_rlp_transaction(tx: FeeMarketRlpTransaction) -> Transaction:  # EIP-1559
+    if len(tx.to) == 0:
         return Transaction(
             payload=TransactionPayload(
-                selector=0x0a,
-                data=RlpSetCodeTransactionPayload(
-                    type_=RlpTxType.SET_CODE,
+                selector=0x08,
+                data=RlpCreateTransactionPayload(
+                    type_=RlpTxType.FEE_MARKET,
                     chain_id=tx.chain_id,
                     nonce=tx.nonce,
                     max_fees_per_gas=BasicFeesPerGas(
                         regular=tx.max_fee_per_gas,
                     ),
                     gas=tx.gas,
-                    to=ExecutionAddress(tx.to),
                     value=tx.value,
                     input_=tx.data,
-                    access_list=[AccessTuple(
-                        address=access_tuple[0],
-                        storage_keys=access_tuple[1]
-                    ) for access_tuple in tx.access_list],
+                    access_list=upgrade_access_list(tx.access_list),
                     max_priority_fees_per_gas=BasicFeesPerGas(
                         regular=tx.max_priority_fee_per_gas,
                     ),
-                    authorization_list=[
-                        upgrade_authorization(auth)
-                        for auth in tx.authorization_list
-                    ],
                 ),
             ),
             signature=secp256k1_pack(tx.r, tx.s, tx.y_parity),
         )
-
-    if type_ == 0x03:  # EIP-4844
-        tx = decode(tx_bytes[1:], BlobRlpTransaction)
-        return Transaction(
-            payload=TransactionPayload(
-                selector=0x09,
-                data=RlpBlobTransactionPayload(
-                    type_=RlpTxType.BLOB,
-                    chain_id=tx.chain_id,
-                    nonce=tx.nonce,
-                    max_fees_per_gas=BlobFeesPerGas(
-                        regular=tx.max_fee_per_gas,
-                        blob=tx.max_fee_per_blob_gas,
-                    ),
-                    gas=tx.gas,
-                    to=ExecutionAddress(tx.to),
-                    value=tx.value,
-                    input_=tx.data,
-                    access_list=[AccessTuple(
-                        address=access_tuple[0],
-                        storage_keys=access_tuple[1]
-                    ) for access_tuple in tx.access_list],
-                    max_priority_fees_per_gas=BlobFeesPerGas(
-                        regular=tx.max_priority_fee_per_gas,
-                        blob=FeePerGas(0),
-                    ),
-                    blob_versioned_hashes=tx.blob_versioned_hashes,
+    return Transaction(
+        payload=TransactionPayload(
+            selector=0x07,
+            data=RlpBasicTransactionPayload(
+                type_=RlpTxType.FEE_MARKET,
+                chain_id=tx.chain_id,
+                nonce=tx.nonce,
+                max_fees_per_gas=BasicFeesPerGas(
+                    regular=tx.max_fee_per_gas,
+                ),
+                gas=tx.gas,
+                to=ExecutionAddress(tx.to),
+                value=tx.value,
+                input_=tx.data,
+                access_list=upgrade_access_list(tx.access_list),
+                max_priority_fees_per_gas=BasicFeesPerGas(
+                    regular=tx.max_priority_fee_per_gas,
                 ),
             ),
-            signature=secp256k1_pack(tx.r, tx.s, tx.y_parity),
-        )
+        ),
+        signature=secp256k1_pack(tx.r, tx.s, tx.y_parity),
+    )
 
-    if type_ == 0x02:  # EIP-1559
-        tx = decode(tx_bytes[1:], FeeMarketRlpTransaction)
-        if len(tx.to) == 0:
-            return Transaction(
-                payload=TransactionPayload(
-                    selector=0x08,
-                    data=RlpCreateTransactionPayload(
-                        type_=RlpTxType.FEE_MARKET,
-                        chain_id=tx.chain_id,
-                        nonce=tx.nonce,
-                        max_fees_per_gas=BasicFeesPerGas(
-                            regular=tx.max_fee_per_gas,
-                        ),
-                        gas=tx.gas,
-                        value=tx.value,
-                        input_=tx.data,
-                        access_list=[AccessTuple(
-                            address=access_tuple[0],
-                            storage_keys=access_tuple[1]
-                        ) for access_tuple in tx.access_list],
-                        max_priority_fees_per_gas=BasicFeesPerGas(
-                            regular=tx.max_priority_fee_per_gas,
-                        ),
-                    ),
-                ),
-                signature=secp256k1_pack(tx.r, tx.s, tx.y_parity),
-            )
+def upgrade_access_list_rlp_transaction(tx: AccessListRlpTransaction) -> Transaction:  # EIP-2930
+    if len(tx.to) == 0:
         return Transaction(
             payload=TransactionPayload(
-                selector=0x07,
-                data=RlpBasicTransactionPayload(
-                    type_=RlpTxType.FEE_MARKET,
+                selector=0x06,
+                data=RlpAccessListCreateTransactionPayload(
+                    type_=RlpTxType.ACCESS_LIST,
                     chain_id=tx.chain_id,
                     nonce=tx.nonce,
                     max_fees_per_gas=BasicFeesPerGas(
-                        regular=tx.max_fee_per_gas,
+                        regular=tx.gas_price,
                     ),
                     gas=tx.gas,
-                    to=ExecutionAddress(tx.to),
                     value=tx.value,
                     input_=tx.data,
-                    access_list=[AccessTuple(
-                        address=access_tuple[0],
-                        storage_keys=access_tuple[1]
-                    ) for access_tuple in tx.access_list],
-                    max_priority_fees_per_gas=BasicFeesPerGas(
-                        regular=tx.max_priority_fee_per_gas,
-                    ),
+                    access_list=upgrade_access_list(tx.access_list),
                 ),
             ),
             signature=secp256k1_pack(tx.r, tx.s, tx.y_parity),
         )
+    return Transaction(
+        payload=TransactionPayload(
+            selector=0x05,
+            data=RlpAccessListBasicTransactionPayload(
+                type_=RlpTxType.ACCESS_LIST,
+                chain_id=tx.chain_id,
+                nonce=tx.nonce,
+                max_fees_per_gas=BasicFeesPerGas(
+                    regular=tx.gas_price,
+                ),
+                gas=tx.gas,
+                to=ExecutionAddress(tx.to),
+                value=tx.value,
+                input_=tx.data,
+                access_list=upgrade_access_list(tx.access_list),
+            ),
+        ),
+        signature=secp256k1_pack(tx.r, tx.s, tx.y_parity),
+    )
 
-    if type_ == 0x01:  # EIP-2930
-        tx = decode(tx_bytes[1:], AccessListRlpTransaction)
+def upgrade_legacy_rlp_transaction(tx: LegacyRlpTransaction) -> Transaction:  # Legacy
+    if tx.v not in (27, 28):
         if len(tx.to) == 0:
             return Transaction(
                 payload=TransactionPayload(
-                    selector=0x06,
-                    data=RlpAccessListCreateTransactionPayload(
-                        type_=RlpTxType.ACCESS_LIST,
-                        chain_id=tx.chain_id,
+                    selector=0x04,
+                    data=RlpLegacyCreateTransactionPayload(
+                        type_=RlpTxType.LEGACY,
+                        chain_id=(tx.v - 35) >> 1,
                         nonce=tx.nonce,
                         max_fees_per_gas=BasicFeesPerGas(
                             regular=tx.gas_price,
@@ -164,20 +191,16 @@ def upgrade_rlp_transaction_to_ssz(tx_bytes: bytes):
                         gas=tx.gas,
                         value=tx.value,
                         input_=tx.data,
-                        access_list=[AccessTuple(
-                            address=access_tuple[0],
-                            storage_keys=access_tuple[1]
-                        ) for access_tuple in tx.access_list],
                     ),
                 ),
-                signature=secp256k1_pack(tx.r, tx.s, tx.y_parity),
+                signature=secp256k1_pack(tx.r, tx.s, y_parity=(tx.v & 0x1) == 0),
             )
         return Transaction(
             payload=TransactionPayload(
-                selector=0x05,
-                data=RlpAccessListBasicTransactionPayload(
-                    type_=RlpTxType.ACCESS_LIST,
-                    chain_id=tx.chain_id,
+                selector=0x03,
+                data=RlpLegacyBasicTransactionPayload(
+                    type_=RlpTxType.LEGACY,
+                    chain_id=(tx.v - 35) >> 1,
                     nonce=tx.nonce,
                     max_fees_per_gas=BasicFeesPerGas(
                         regular=tx.gas_price,
@@ -186,87 +209,76 @@ def upgrade_rlp_transaction_to_ssz(tx_bytes: bytes):
                     to=ExecutionAddress(tx.to),
                     value=tx.value,
                     input_=tx.data,
-                    access_list=[AccessTuple(
-                        address=access_tuple[0],
-                        storage_keys=access_tuple[1]
-                    ) for access_tuple in tx.access_list],
                 ),
             ),
-            signature=secp256k1_pack(tx.r, tx.s, tx.y_parity),
+            signature=secp256k1_pack(tx.r, tx.s, y_parity=(tx.v & 0x1) == 0),
         )
-
-    if 0xc0 <= type_ <= 0xfe:  # Legacy
-        tx = decode(tx_bytes, LegacyRlpTransaction)
-        if tx.v not in (27, 28):
-            if len(tx.to) == 0:
-                return Transaction(
-                    payload=TransactionPayload(
-                        selector=0x04,
-                        data=RlpLegacyCreateTransactionPayload(
-                            type_=RlpTxType.LEGACY,
-                            chain_id=(tx.v - 35) >> 1,
-                            nonce=tx.nonce,
-                            max_fees_per_gas=BasicFeesPerGas(
-                                regular=tx.gas_price,
-                            ),
-                            gas=tx.gas,
-                            value=tx.value,
-                            input_=tx.data,
-                        ),
-                    ),
-                    signature=secp256k1_pack(tx.r, tx.s, y_parity=(tx.v & 0x1) == 0),
-                )
-            return Transaction(
-                payload=TransactionPayload(
-                    selector=0x03,
-                    data=RlpLegacyBasicTransactionPayload(
-                        type_=RlpTxType.LEGACY,
-                        chain_id=(tx.v - 35) >> 1,
-                        nonce=tx.nonce,
-                        max_fees_per_gas=BasicFeesPerGas(
-                            regular=tx.gas_price,
-                        ),
-                        gas=tx.gas,
-                        to=ExecutionAddress(tx.to),
-                        value=tx.value,
-                        input_=tx.data,
-                    ),
-                ),
-                signature=secp256k1_pack(tx.r, tx.s, y_parity=(tx.v & 0x1) == 0),
-            )
-        if len(tx.to) == 0:
-            return Transaction(
-                payload=TransactionPayload(
-                    selector=0x02,
-                    data=RlpLegacyReplayableCreateTransactionPayload(
-                        type_=RlpTxType.LEGACY,
-                        nonce=tx.nonce,
-                        max_fees_per_gas=BasicFeesPerGas(
-                            regular=tx.gas_price,
-                        ),
-                        gas=tx.gas,
-                        value=tx.value,
-                        input_=tx.data,
-                    ),
-                ),
-                signature=secp256k1_pack(tx.r, tx.s, y_parity=(tx.v & 0x1) == 0),
-            )
+    if len(tx.to) == 0:
         return Transaction(
             payload=TransactionPayload(
-                selector=0x01,
-                data=RlpLegacyReplayableBasicTransactionPayload(
+                selector=0x02,
+                data=RlpLegacyReplayableCreateTransactionPayload(
                     type_=RlpTxType.LEGACY,
                     nonce=tx.nonce,
                     max_fees_per_gas=BasicFeesPerGas(
                         regular=tx.gas_price,
                     ),
                     gas=tx.gas,
-                    to=ExecutionAddress(tx.to),
                     value=tx.value,
                     input_=tx.data,
                 ),
             ),
             signature=secp256k1_pack(tx.r, tx.s, y_parity=(tx.v & 0x1) == 0),
         )
+    return Transaction(
+        payload=TransactionPayload(
+            selector=0x01,
+            data=RlpLegacyReplayableBasicTransactionPayload(
+                type_=RlpTxType.LEGACY,
+                nonce=tx.nonce,
+                max_fees_per_gas=BasicFeesPerGas(
+                    regular=tx.gas_price,
+                ),
+                gas=tx.gas,
+                to=ExecutionAddress(tx.to),
+                value=tx.value,
+                input_=tx.data,
+            ),
+        ),
+        signature=secp256k1_pack(tx.r, tx.s, y_parity=(tx.v & 0x1) == 0),
+    )
+
+RLP_TRANSACTION_TYPES = {
+    RlpTxType.LEGACY: (LegacyRlpTransaction, upgrade_legacy_rlp_transaction),
+    RlpTxType.ACCESS_LIST: (AccessListRlpTransaction, upgrade_access_list_rlp_transaction),
+    RlpTxType.FEE_MARKET: (FeeMarketRlpTransaction, upgrade_fee_market_rlp_transaction),
+    RlpTxType.BLOB: (BlobRlpTransaction, upgrade_blob_rlp_transaction),
+    RlpTxType.SET_CODE: (SetCodeRlpTransaction, upgrade_set_code_rlp_transaction),
+}
+
+def get_rlp_transaction_type(tx_bytes: bytes) -> RlpTxType:
+    if 0xc0 <= tx_bytes[0] <= 0xfe:  # Legacy
+        return RlpTxType.LEGACY
+    # Typed transactions use a type byte in [0x01, 0x7f), 0x00 is not a type
+    assert 0 < tx_bytes[0] < 0x7f and tx_bytes[0] in RLP_TRANSACTION_TYPES
+    return RlpTxType(tx_bytes[0])
+
+def get_rlp_transaction_payload(tx_bytes: bytes) -> bytes:
+    if 0xc0 <= tx_bytes[0] <= 0xfe:  # Legacy
+        return tx_bytes
+    return tx_bytes[1:]
+
+def upgrade_rlp_transaction_to_ssz(tx_bytes: bytes) -> Transaction:
+    sedes, upgrade = RLP_TRANSACTION_TYPES[get_rlp_transaction_type(tx_bytes)]
+    return upgrade(decode(get_rlp_transaction_payload(tx_bytes), sedes))
 
-    assert False
+def upgrade_rlp_transactions_to_ssz(
+    txs_bytes: list[bytes],
+) -> tuple[ProgressiveList[Transaction], Hash32]:
+    # Decoding the transactions of one type as a single RLP list is not
+    # faster: the time goes into building the decoded objects, not into the
+    # per-call overhead of decode
+    transactions = ProgressiveList[Transaction](*[
+        upgrade_rlp_transaction_to_ssz(tx_bytes) for tx_bytes in txs_bytes
+    ])
+    return transactions, Hash32(transactions.hash_tree_root())
@@ -115,3 +115,17 @@ for test in tests:
         recover_execution_signer(auth.signature, compute_auth_hash(auth))
         for auth in getattr(tx.payload.data(), 'authorization_list', [])
     ] == test.authorities
+
+transactions, transactions_root = upgrade_rlp_transactions_to_ssz(
+    [test.rlp_tx_bytes for test in tests])
+assert [tx.encode_bytes() for tx in transactions] == [test.ssz_tx_bytes for test in tests]
+assert transactions_root == ProgressiveList[Transaction](*[
+    upgrade_rlp_transaction_to_ssz(test.rlp_tx_bytes) for test in tests
+]).hash_tree_root()
+
+for tx_bytes in (b'\x00' + tests[0].rlp_tx_bytes, b'\x7f' + tests[0].rlp_tx_bytes):
+    try:
+        get_rlp_transaction_type(tx_bytes)
+    except AssertionError:
+        continue
+    assert False, 'invalid transaction type accepted'
@@ -0,0 +1,213 @@
+"""Benchmarks for the EIP-7745 log index (log_index.py).
+
+Measures the cost of adding synthetic blocks to the log index in the
+situations where the tree does the most work:
+
+  1. insertion          steady state, filling the first filter map
+  2. map rollover       crossing a filter map boundary: the rows of the
+                        completed map are flushed and collapsed and the
+                        next map is initialized
+  3. epoch rollover     crossing an epoch boundary: the last map of the
+                        epoch is completed and the whole epoch subtree
+                        collapses into a single node
+  4. root every block   insertion with log_index_root called after each
+                        block, as a block producer or validator would
+  5. node storage       the index entries of a filter map kept in memory
+                        uncollapsed, stored in the default dictionary and in
+                        a DenseNodeStore, comparing time and memory held
+
+Each run reports entries per second, tree hash calls per entry, the time
+of a final root computation and the peak memory allocated (measured in a
+second, traced run so that tracing does not distort the timings).
+
+Blocks are generated by synthetic_chain with configurable transaction,
+log, topic and data sizes.  Rollover runs start from a state positioned
+shortly before the boundary (see positioned_state) instead of replaying
+the whole history before it.
+
+Run as a module of the package containing log_index.py, for example
+python -m <package>.bench_log_index.
+"""
+import random
+import time
+import tracemalloc
+from dataclasses import dataclass
+
+from ethereum_types.numeric import U256, Uint
+
+from ethereum.crypto.hash import Hash32
+
+from .base_types import Address, Bytes
+from .binary_tree import (
+    GTI_ROOT,
+    DenseNodeStore,
+    btree_get,
+    btree_set,
+    dense_store_add_subtree,
+)
+from .blocks import Log
+from .log_index import (
+    LOG2_VALUES_PER_MAP,
+    MAPS_PER_EPOCH,
+    VALUES_PER_MAP,
+    LogIndexState,
+    index_entry_gti,
+    initialize_map,
+    log_index_add_block,
+    log_index_root,
+    map_index_entries_gti,
+)
+
+
+@dataclass
+class SyntheticHeader:
+    """Only the number, the timestamp and the RLP encoding (for the block
+    hash) of a header are used by the log index."""
+
+    number: Uint
+    timestamp: U256
+    parent_hash: Hash32
+
+
+def synthetic_chain(first_block=1, blocks=50, txs=4, logs=3, topics=3,
+                    data_size=64, addresses=64, seed=7745):
+    """Blocks of txs transactions with logs logs each, every log having
+    topics topics and data_size bytes of data.  Addresses and topics are
+    drawn from small pools so that rows are shared like on a real chain.
+    Yields (header, [(tx_hash, receipt_hash, logs), ...]) tuples."""
+    rng = random.Random(seed)
+
+    def rand_bytes(n):
+        return bytes(rng.getrandbits(8) for _ in range(n))
+
+    address_pool = [Address(rand_bytes(20)) for _ in range(addresses)]
+    topic_pool = [Hash32(rand_bytes(32)) for _ in range(4 * addresses)]
+    parent_hash = Hash32(bytes(32))
+    for number in range(first_block, first_block + blocks):
+        transactions = []
+        for _ in range(txs):
+            tx_logs = tuple(
+                Log(
+                    address=rng.choice(address_pool),
+                    topics=tuple(rng.choice(topic_pool)
+                                 for _ in range(topics)),
+                    data=Bytes(rand_bytes(data_size)),
+                )
+                for _ in range(logs)
+            )
+            transactions.append(
+                (Hash32(rand_bytes(32)), Hash32(rand_bytes(32)), tx_logs)
+            )
+        yield SyntheticHeader(Uint(number), U256(12 * number),
+                              parent_hash), transactions
+        parent_hash = Hash32(rand_bytes(32))
+
+
+def entries_per_block(txs=4, logs=3, topics=3):
+    """Index entries added by a synthetic block (ignoring map padding)."""
+    return txs * (1 + logs * (1 + topics)) + 1
+
+
+def positioned_state(next_entry):
+    """A log index starting at the given entry.  The skipped history is
+    treated as empty; the current map is initialized explicitly when the
+    state does not start on a map boundary."""
+    log_index = LogIndexState(next_entry=Uint(next_entry))
+    if next_entry % VALUES_PER_MAP:
+        initialize_map(log_index, Uint(next_entry) // VALUES_PER_MAP)
+    return log_index
+
+
+def run(log_index, chain, root_every_block=False):
+    """Adds the chain and returns (seconds, entries, hash calls)."""
+    hash_calls = 0
+    binary_hash = log_index.tree.binary_hash
+
+    def counting_hash(left, right):
+        nonlocal hash_calls
+        hash_calls += 1
+        return binary_hash(left, right)
+
+    log_index.tree.binary_hash = counting_hash
+    first_entry = log_index.next_entry
+    start = time.perf_counter()
+    for header, transactions in chain:
+        log_index_add_block(log_index, header, transactions)
+        if root_every_block:
+            log_index_root(log_index)
+    seconds = time.perf_counter() - start
+    log_index.tree.binary_hash = binary_hash
+    return seconds, int(log_index.next_entry - first_entry), hash_calls
+
+
+def bench(name, start_entry, root_every_block=False, **sizes):
+    """Times a run, a final root computation and then a traced run."""
+    blocks = sizes.get("blocks", 50)
+    log_index = positioned_state(start_entry)
+    seconds, entries, hashes = run(
+        log_index, synthetic_chain(**sizes), root_every_block)
+    start = time.perf_counter()
+    log_index_root(log_index)
+    root_ms = (time.perf_counter() - start) * 1000
+    tracemalloc.start()
+    run(positioned_state(start_entry), synthetic_chain(**sizes),
+        root_every_block)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    print(f"{name:20s} {blocks:5d} blocks {entries:7d} entries"
+          f" {entries / seconds:9.0f} entries/s"
+          f" {hashes / entries:6.1f} hashes/entry"
+          f" {root_ms:8.1f} ms root {peak / 1024:9.0f} KiB peak")
+
+
+def fill_entries(dense, entries, seed=7745):
+    """Sets the roots of the first entries index entries of filter map 0
+    without collapsing them, like a long-lived densely populated region,
+    and calculates the root.  Returns the log index."""
+    rng = random.Random(seed)
+    log_index = LogIndexState()
+    if dense:
+        log_index.tree._data = DenseNodeStore()
+        dense_store_add_subtree(log_index.tree._data,
+                                map_index_entries_gti(Uint(0)),
+                                LOG2_VALUES_PER_MAP)
+    for entry in range(entries):
+        btree_set(log_index.tree, index_entry_gti(Uint(entry)),
+                  U256(rng.getrandbits(256)))
+    btree_get(log_index.tree, GTI_ROOT)
+    return log_index
+
+
+def bench_storage(entries):
+    """Compares the dictionary and the DenseNodeStore backends: time of
+    fill_entries and the memory held by the tree afterwards."""
+    for name, dense in (("dict", False), ("DenseNodeStore", True)):
+        start = time.perf_counter()
+        log_index = fill_entries(dense, entries)
+        seconds = time.perf_counter() - start
+        nodes = len(log_index.tree._data)
+        del log_index
+        tracemalloc.start()
+        log_index = fill_entries(dense, entries)
+        held = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        print(f"node storage {name:15s} {entries:7d} entries"
+              f" {nodes:8d} nodes {seconds * 1000:9.1f} ms"
+              f" {held / 1024:9.0f} KiB held")
+
+
+SIZES = dict(blocks=50, txs=4, logs=3, topics=3, data_size=64)
+HALF = SIZES["blocks"] * entries_per_block(
+    SIZES["txs"], SIZES["logs"], SIZES["topics"]) // 2
+
+BENCHES = [
+    ("insertion",        0),
+    ("map rollover",     VALUES_PER_MAP - HALF),
+    ("epoch rollover",   MAPS_PER_EPOCH * VALUES_PER_MAP - HALF),
+]
+
+if __name__ == "__main__":
+    for name, start_entry in BENCHES:
+        bench(name, start_entry, **SIZES)
+    bench("root every block", 0, root_every_block=True, **SIZES)
+    bench_storage(VALUES_PER_MAP // 4)
@@ -7,11 +7,33 @@ Binary Merkle Tree.
 
 """
 
+from concurrent.futures import Executor
 from dataclasses import dataclass, field
-from typing import Callable, Dict
+from itertools import repeat
+from typing import (
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    MutableMapping,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+)
 
 from ethereum_types.numeric import U256, Uint
 
+from .node_store import (
+    NodeStore,
+    node_store_checkpoint,
+    node_store_finalize,
+    node_store_get,
+    node_store_put_subtree,
+    node_store_revert,
+)
+
 
 @dataclass
 class BinaryTree:
@@ -21,12 +43,42 @@ class BinaryTree:
 
     binary_hash: Callable[[U256, U256], U256]
     empty_node: Callable[[U256], U256]
-    _data: Dict[U256, U256] = field(default_factory=dict)
+    _data: MutableMapping[U256, U256] = field(default_factory=dict)
+    node_store: Optional[NodeStore] = None
+    _journal: Optional[List[Tuple[U256, Optional[U256]]]] = None
+    _journal_offset: int = 0
+    stats: Optional["BinaryTreeStats"] = None
+    _deferred_collapses: Optional[List[U256]] = None
+
+
+@dataclass
+class BinaryTreeStats:
+    """
+    Instrumentation counters of a BinaryTree (see btree_enable_stats). Each
+    counter is kept separately for every tree region, as classified by the
+    region callback function.
+    """
+
+    region: Callable[[U256], str]
+    counts: Dict[Tuple[str, str], int] = field(default_factory=dict)
+
+
+@dataclass
+class BinaryTreeCheckpoint:
+    """
+    Position in the undo journal of a BinaryTree and the state of its node
+    store at the time the checkpoint was created (see btree_checkpoint).
+    """
+
+    position: int
+    node_store: Optional[Tuple[int, int]] = None
 
 
 GTI_ROOT = U256(1)
 GTI_MAX_LEVEL = U256(1) << 255
 
+DENSE_PAGE_SIZE = 64
+
 
 def btree_get(tree: BinaryTree, index: U256) -> U256:
     """
@@ -42,10 +94,117 @@ def btree_get(tree: BinaryTree, index: U256) -> U256:
             raise AssertionError("Trying to get non-existent node")
         left = btree_get(tree, index * 2)
         right = btree_get(tree, index * 2 + 1)
-        tree._data[index] = tree.binary_hash(left, right)
+        if tree.stats is not None:
+            _count(tree, "get_miss", index)
+            _count(tree, "hash", index)
+        _write_node(tree, index, tree.binary_hash(left, right))
+    elif tree.stats is not None:
+        _count(tree, "get_hit", index)
     return tree._data[index]
 
 
+def btree_get_parallel(
+    tree: BinaryTree, executor: Executor, split_depth: Uint, tasks: int
+) -> U256:
+    """
+    Returns the root of the tree like btree_get(tree, GTI_ROOT) but hands the
+    invalidated subtrees rooted at the given depth below the root to an
+    executor (typically a process pool) so that independent subtrees are
+    hashed in parallel. The subtrees are distributed among at most the given
+    number of tasks. The recalculated nodes are stored in the tree and the
+    remaining invalidated nodes above the split depth are hashed serially.
+
+    Note that with a process pool the binary_hash function of the tree has to
+    be picklable and each task only receives the nodes required to
+    recalculate the invalidated nodes of its subtrees. Collapsed subtrees are
+    hashed by btree_collapse itself, so the collapses of the updated parts
+    should be deferred until the root is calculated (see
+    btree_defer_collapses).
+    """
+    roots: List[U256] = []
+    _invalidated_subtrees(tree, GTI_ROOT, split_depth, roots)
+    groups = [roots[task::tasks] for task in range(min(tasks, len(roots)))]
+    if len(groups) > 1:
+        subtrees = []
+        for group in groups:
+            nodes: Dict[U256, U256] = {}
+            for root in group:
+                _collect_subtree(tree, root, nodes)
+            subtrees.append(nodes)
+        results = executor.map(
+            _hash_subtrees, repeat(tree.binary_hash), groups, subtrees
+        )
+        for hashed in results:
+            for index, value in hashed.items():
+                if tree.stats is not None:
+                    _count(tree, "hash", index)
+                _write_node(tree, index, value)
+    return btree_get(tree, GTI_ROOT)
+
+
+def _invalidated_subtrees(
+    tree: BinaryTree, index: U256, depth: Uint, roots: List[U256]
+) -> None:
+    """
+    Collects the invalidated nodes at the given depth below the given node.
+    """
+    if index in tree._data:
+        return
+    if depth == 0:
+        roots.append(index)
+        return
+    _invalidated_subtrees(tree, index * 2, depth - 1, roots)
+    _invalidated_subtrees(tree, index * 2 + 1, depth - 1, roots)
+
+
+def _collect_subtree(
+    tree: BinaryTree, index: U256, nodes: Dict[U256, U256]
+) -> None:
+    """
+    Collects the nodes required for recalculating the given invalidated node:
+    the stored children of all invalidated nodes in its subtree.
+    """
+    if index in tree._data:
+        nodes[index] = tree._data[index]
+        return
+    if index >= GTI_MAX_LEVEL:
+        raise AssertionError("Trying to get non-existent node")
+    _collect_subtree(tree, index * 2, nodes)
+    _collect_subtree(tree, index * 2 + 1, nodes)
+
+
+def _hash_subtrees(
+    binary_hash: Callable[[U256, U256], U256],
+    roots: List[U256],
+    nodes: Dict[U256, U256],
+) -> Dict[U256, U256]:
+    """
+    Recalculates the given subtrees from the collected nodes and returns the
+    recalculated nodes. This is the task executed by btree_get_parallel.
+    """
+    hashed: Dict[U256, U256] = {}
+    for root in roots:
+        _hash_node(binary_hash, root, nodes, hashed)
+    return hashed
+
+
+def _hash_node(
+    binary_hash: Callable[[U256, U256], U256],
+    index: U256,
+    nodes: Dict[U256, U256],
+    hashed: Dict[U256, U256],
+) -> U256:
+    """
+    Recursively recalculates a node of a subtree task.
+    """
+    if index in nodes:
+        return nodes[index]
+    left = _hash_node(binary_hash, index * 2, nodes, hashed)
+    right = _hash_node(binary_hash, index * 2 + 1, nodes, hashed)
+    hashed[index] = binary_hash(left, right)
+    return hashed[index]
+
+
 def btree_set(tree: BinaryTree, index, value: U256) -> None:
     """
     Sets the leaf node value at the given generalized tree index and
@@ -55,7 +214,7 @@ def btree_set(tree: BinaryTree, index, value: U256) -> None:
     """
     if index not in tree._data:
         btree_expand(tree, index)
-    tree._data[index] = value
+    _write_node(tree, index, value)
     _invalidate_ancestors(tree, index)
 
 
@@ -69,7 +228,9 @@ def _invalidate_ancestors(tree: BinaryTree, index: U256) -> None:
         index //= 2
         if index not in tree._data:
             return
-        del tree._data[index]
+        if tree.stats is not None:
+            _count(tree, "invalidate", index)
+        _delete_node(tree, index)
 
 
 def btree_expand(tree: BinaryTree, index: U256) -> None:
@@ -89,29 +250,590 @@ def btree_expand(tree: BinaryTree, index: U256) -> None:
         if tree._data[index] != tree.empty_node(index):
             raise AssertionError("Trying to expand non-empty subtree")
         return
-    tree._data[index] = tree.empty_node(index)
+    if tree.stats is not None:
+        _count(tree, "expand", index)
+    _write_node(tree, index, tree.empty_node(index))
     if index == GTI_ROOT:
         return
     parent = index // 2
     sibling = parent * 4 + 1 - index
     btree_expand(tree, parent)
-    tree._data[sibling] = tree.empty_node(sibling)
+    _write_node(tree, sibling, tree.empty_node(sibling))
     _invalidate_ancestors(tree, index)
 
 
 def btree_collapse(tree: BinaryTree, index: U256) -> None:
     """
-    Collapses the descendants of the given node into a single hash node.
+    Collapses the descendants of the given node into a single hash node. If
+    the tree has a node store then the removed nodes are saved to it. While
+    collapses are deferred (see btree_defer_collapses) the node is only
+    queued for collapsing.
 
     Note that a collapsed subtree should not be expanded again.
     """
+    if tree._deferred_collapses is not None:
+        tree._deferred_collapses.append(index)
+        return
+    _collapse(tree, index)
+
+
+def btree_defer_collapses(tree: BinaryTree, enabled: bool) -> None:
+    """
+    Starts or stops deferring btree_collapse calls. Deferred collapses keep
+    the updated subtrees in memory so that btree_get_parallel can hash them
+    in parallel; btree_apply_collapses then performs the queued collapses in
+    their original order, reusing the already calculated hashes. Stopping
+    applies the queued collapses.
+
+    Note that checkpoints cannot be created or reverted to while collapses
+    are queued.
+    """
+    if enabled:
+        if tree._deferred_collapses is None:
+            tree._deferred_collapses = []
+        return
+    btree_apply_collapses(tree)
+    tree._deferred_collapses = None
+
+
+def btree_apply_collapses(tree: BinaryTree) -> None:
+    """
+    Performs the collapses queued since collapses have been deferred (or
+    since the last call), see btree_defer_collapses.
+    """
+    deferred = tree._deferred_collapses
+    if not deferred:
+        return
+    tree._deferred_collapses = []
+    for index in deferred:
+        _collapse(tree, index)
+
+
+def _collapse(tree: BinaryTree, index: U256) -> None:
+    """
+    Collapses the descendants of the given node (see btree_collapse).
+    """
     btree_get(tree, index)
-    if index * 2 in tree._data:
-        btree_collapse(tree, index * 2)
-        del tree._data[index * 2]
-    if index * 2 + 1 in tree._data:
-        btree_collapse(tree, index * 2 + 1)
-        del tree._data[index * 2 + 1]
+    if tree.stats is not None:
+        _count(tree, "collapse", index)
+    removed: Dict[U256, U256] = {}
+    _remove_descendants(tree, index, removed)
+    if tree.node_store is not None and removed:
+        removed[index] = tree._data[index]
+        node_store_put_subtree(tree.node_store, index, removed)
+
+
+def _remove_descendants(
+    tree: BinaryTree, index: U256, removed: Dict[U256, U256]
+) -> None:
+    """
+    Removes all descendants of the given node from memory, collecting the
+    removed nodes if the tree has a node store.
+    """
+    for child in (index * 2, index * 2 + 1):
+        if child in tree._data:
+            _remove_descendants(tree, child, removed)
+            if tree.node_store is not None:
+                removed[child] = tree._data[child]
+            _delete_node(tree, child)
+
+
+def btree_read(tree: BinaryTree, index: U256) -> Optional[U256]:
+    """
+    Returns the node value at the given generalized tree index, also looking
+    up collapsed nodes in the node store of the tree. Returns None if the node
+    is neither in memory nor in the node store.
+
+    Note that the node store is only consulted below a node that is in
+    memory, in a collapsed subtree or an untouched region. A node without
+    any ancestor in memory is invalidated; it is recalculated with btree_get
+    which raises an AssertionError if that is not possible, instead of
+    falling back to a possibly stale node store value.
+    """
+    if index in tree._data or (
+        index < GTI_MAX_LEVEL
+        and (index * 2 in tree._data or index * 2 + 1 in tree._data)
+    ):
+        return btree_get(tree, index)
+    ancestor = index
+    while ancestor != GTI_ROOT:
+        ancestor //= 2
+        if ancestor in tree._data:
+            if tree.node_store is None:
+                return None
+            return node_store_get(tree.node_store, index)
+    if not tree._data:
+        return None
+    return btree_get(tree, index)
+
+
+def btree_resolve(tree: BinaryTree, index: U256) -> Optional[U256]:
+    """
+    Returns the node value at the given generalized tree index like btree_read
+    but also resolves nodes of previously untouched empty regions. If the node
+    is not available then its lowest available ancestor is checked; if that
+    ancestor has an empty node value then the node is empty too. Returns None
+    if the node value cannot be determined.
+
+    Note that invalidated ancestors are not recognized as available nodes so
+    the root should be recalculated with btree_get before resolving nodes.
+    """
+    value = btree_read(tree, index)
+    if value is not None:
+        return value
+    ancestor = index
+    while ancestor != GTI_ROOT:
+        ancestor //= 2
+        value = btree_read(tree, ancestor)
+        if value is not None:
+            if value != tree.empty_node(ancestor):
+                return None
+            return tree.empty_node(index)
+    return None
+
+
+def btree_prove(tree: BinaryTree, indices: Sequence[U256]) -> List[U256]:
+    """
+    Creates a multiproof of the given nodes and returns the proof nodes: the
+    siblings of the proven nodes and their ancestors that are neither proven
+    nor ancestors of a proven node, in depth-first, left to right order.
+    Siblings shared by multiple proven nodes are only included once. A proven
+    node may also be an ancestor of other proven nodes; the proof then also
+    covers the siblings below it so that its value can be recalculated.
+
+    Note that only invalidated nodes are recalculated; collapsed nodes are read
+    from the node store so proof nodes below the collapse boundary can only be
+    provided if the tree has a node store.
+    """
+    btree_get(tree, GTI_ROOT)
+    proof: List[U256] = []
+    for index in _proof_node_indices(indices):
+        value = btree_resolve(tree, index)
+        if value is None:
+            raise AssertionError("Proof node not available")
+        proof.append(value)
+    return proof
+
+
+def btree_verify_multiproof(
+    binary_hash: Callable[[U256, U256], U256],
+    root: U256,
+    nodes: Dict[U256, U256],
+    proof: Sequence[U256],
+) -> bool:
+    """
+    Verifies a multiproof created by btree_prove, proving the given node
+    values against the expected tree root.
+
+    Note that a proven node that is an ancestor of other proven nodes is
+    recalculated from its descendants and its given value has to match the
+    recalculated one; otherwise the descendants could be replaced freely.
+    """
+    proof_nodes = iter(proof)
+    try:
+        value = _multiproof_node(
+            binary_hash, GTI_ROOT, nodes, _proof_path(nodes), proof_nodes
+        )
+    except (StopIteration, AssertionError):
+        return False
+    return value == root and next(proof_nodes, None) is None
+
+
+def _proof_path(indices: Iterable[U256]) -> Set[U256]:
+    """
+    Returns the given nodes and all of their ancestors.
+    """
+    path: Set[U256] = set()
+    for index in indices:
+        while index not in path:
+            path.add(index)
+            if index == GTI_ROOT:
+                break
+            index //= 2
+    return path
+
+
+def _proof_node_indices(indices: Sequence[U256]) -> List[U256]:
+    """
+    Returns the generalized tree indices of the proof nodes of a multiproof
+    in depth-first, left to right order.
+    """
+    path = _proof_path(indices)
+    proven = set(indices)
+    proof_indices: List[U256] = []
+    stack = [GTI_ROOT]
+    while stack:
+        index = stack.pop()
+        if index not in path:
+            proof_indices.append(index)
+        elif index not in proven or _has_proven_descendants(index, path):
+            stack.append(index * 2 + 1)
+            stack.append(index * 2)
+    return proof_indices
+
+
+def _has_proven_descendants(index: U256, path: Set[U256]) -> bool:
+    """
+    Returns True if a child of the given node is on the path of a proven node.
+    """
+    return index * 2 in path or index * 2 + 1 in path
+
+
+def _multiproof_node(
+    binary_hash: Callable[[U256, U256], U256],
+    index: U256,
+    nodes: Dict[U256, U256],
+    path: Set[U256],
+    proof_nodes: Iterator[U256],
+) -> U256:
+    """
+    Calculates a node value of a multiproof, consuming the proof nodes in the
+    same order as _proof_node_indices lists them. Raises an AssertionError if
+    a proven node does not match the value calculated from its descendants.
+    """
+    if index not in path:
+        return next(proof_nodes)
+    if index in nodes and not _has_proven_descendants(index, path):
+        return nodes[index]
+    left = _multiproof_node(binary_hash, index * 2, nodes, path, proof_nodes)
+    right = _multiproof_node(
+        binary_hash, index * 2 + 1, nodes, path, proof_nodes
+    )
+    value = binary_hash(left, right)
+    if index in nodes and nodes[index] != value:
+        raise AssertionError("Proven node does not match its descendants")
+    return value
+
+
+def btree_enable_stats(
+    tree: BinaryTree, region: Optional[Callable[[U256], str]] = None
+) -> None:
+    """
+    Starts counting hash calls, btree_get cache hits and misses, expanded and
+    invalidated nodes and collapses, broken down by the tree regions returned
+    by the given callback function (a single "tree" region by default).
+    Counting can be stopped by setting tree.stats to None.
+
+    Note that a cache miss is counted for every node recalculated by btree_get
+    while hash calls are also counted for nodes recalculated by
+    btree_get_parallel.
+    """
+    if region is None:
+        region = _single_region
+    tree.stats = BinaryTreeStats(region)
+
+
+def btree_stats_snapshot(tree: BinaryTree) -> Dict[str, Dict[str, int]]:
+    """
+    Returns a copy of the current instrumentation counters of the tree, keyed
+    by region and counter name. Counters that are still zero are omitted.
+    """
+    snapshot: Dict[str, Dict[str, int]] = {}
+    if tree.stats is not None:
+        for (region, counter), count in tree.stats.counts.items():
+            snapshot.setdefault(region, {})[counter] = count
+    return snapshot
+
+
+def _count(tree: BinaryTree, counter: str, index: U256) -> None:
+    """
+    Increments an instrumentation counter of the region of the given node.
+    """
+    stats = tree.stats
+    key = (stats.region(index), counter)
+    stats.counts[key] = stats.counts.get(key, 0) + 1
+
+
+def _single_region(index: U256) -> str:
+    """
+    Default region callback of btree_enable_stats.
+    """
+    return "tree"
+
+
+def btree_checkpoint(tree: BinaryTree) -> BinaryTreeCheckpoint:
+    """
+    Creates a checkpoint that the tree can later be reverted to with
+    btree_revert. The first checkpoint starts recording every change of the
+    stored nodes in an undo journal, including the nodes removed by
+    btree_collapse.
+
+    Note that the journal is kept until btree_finalize is called so the memory
+    used by the journal grows with the number of changes since the oldest
+    checkpoint that has not been finalized.
+    """
+    if tree._deferred_collapses:
+        raise AssertionError("Collapses are pending")
+    if tree._journal is None:
+        tree._journal = []
+    node_store = None
+    if tree.node_store is not None:
+        node_store = node_store_checkpoint(tree.node_store)
+    position = tree._journal_offset + len(tree._journal)
+    return BinaryTreeCheckpoint(position, node_store)
+
+
+def btree_revert(tree: BinaryTree, checkpoint: BinaryTreeCheckpoint) -> None:
+    """
+    Reverts the tree to the state of the given checkpoint by undoing the
+    journaled changes in reverse order. Blocks appended to the node store
+    since the checkpoint are removed too.
+
+    Note that checkpoints created after the given one become invalid.
+    """
+    if tree._deferred_collapses:
+        raise AssertionError("Collapses are pending")
+    position = checkpoint.position - tree._journal_offset
+    if tree._journal is None or position < 0:
+        raise AssertionError("Checkpoint has been finalized")
+    while len(tree._journal) > position:
+        index, value = tree._journal.pop()
+        if value is not None:
+            tree._data[index] = value
+        elif index in tree._data:
+            del tree._data[index]
+    if tree.node_store is not None and checkpoint.node_store is not None:
+        node_store_revert(tree.node_store, checkpoint.node_store)
+
+
+def btree_finalize(tree: BinaryTree, checkpoint: BinaryTreeCheckpoint) -> None:
+    """
+    Discards the journaled changes made before the given checkpoint. The tree
+    cannot be reverted to earlier checkpoints anymore.
+    """
+    position = checkpoint.position - tree._journal_offset
+    if tree._journal is not None and position > 0:
+        del tree._journal[:position]
+        tree._journal_offset = checkpoint.position
+    if tree.node_store is not None and checkpoint.node_store is not None:
+        node_store_finalize(tree.node_store, checkpoint.node_store)
+
+
+def _write_node(tree: BinaryTree, index: U256, value: U256) -> None:
+    """
+    Stores a node value, recording the previous value in the undo journal if
+    there is one.
+    """
+    if tree._journal is not None:
+        tree._journal.append((index, tree._data.get(index)))
+    tree._data[index] = value
+
+
+def _delete_node(tree: BinaryTree, index: U256) -> None:
+    """
+    Removes a node, recording its value in the undo journal if there is one.
+    """
+    if tree._journal is not None:
+        tree._journal.append((index, tree._data[index]))
+    del tree._data[index]
+
+
+@dataclass
+class DenseSubtree:
+    """
+    A complete subtree of a BinaryTree stored in fixed size pages of
+    contiguous buffers. Node values are stored as 32 byte little endian
+    values in heap order, the node at relative generalized tree index i being
+    stored at position i - 1. A page holds DENSE_PAGE_SIZE consecutive
+    positions and is only allocated when the first node is stored in it.
+    """
+
+    root: U256
+    height: Uint
+    values: Dict[int, bytearray] = field(default_factory=dict)
+    present: Dict[int, bytearray] = field(default_factory=dict)
+    page_counts: Dict[int, int] = field(default_factory=dict)
+    count: int = 0
+
+
+@dataclass
+class DenseNodeStore(MutableMapping):
+    """
+    Node storage backend of BinaryTree that keeps registered dense subtrees in
+    pages of contiguous byte buffers, addressed by level and offset, instead
+    of individual dictionary entries. Nodes outside of these subtrees are
+    stored in a regular dictionary.
+
+    Note that a page only costs less memory than the dictionary entries of
+    its nodes if most of its positions are used, so dense subtrees should
+    only be registered for densely populated regions that stay in memory for
+    a long time, and that node access is slower than with a dictionary (see
+    bench_log_index.py). A dense subtree is released as soon as only its
+    root node is left, which is what happens when the subtree is collapsed.
+    """
+
+    _nodes: Dict[U256, U256] = field(default_factory=dict)
+    _subtrees: Dict[U256, DenseSubtree] = field(default_factory=dict)
+    _root_heights: Dict[int, int] = field(default_factory=dict)
+
+    def __getitem__(self, index: U256) -> U256:
+        location = _dense_locate(self, index)
+        if location is None:
+            return self._nodes[index]
+        subtree, position = location
+        page, slot = divmod(position, DENSE_PAGE_SIZE)
+        if page not in subtree.present or not subtree.present[page][slot]:
+            raise KeyError(index)
+        offset = slot * 32
+        return U256.from_le_bytes(subtree.values[page][offset : offset + 32])
+
+    def __setitem__(self, index: U256, value: U256) -> None:
+        location = _dense_locate(self, index)
+        if location is None:
+            self._nodes[index] = value
+            return
+        subtree, position = location
+        page, slot = divmod(position, DENSE_PAGE_SIZE)
+        if page not in subtree.present:
+            subtree.values[page] = bytearray(DENSE_PAGE_SIZE * 32)
+            subtree.present[page] = bytearray(DENSE_PAGE_SIZE)
+            subtree.page_counts[page] = 0
+        offset = slot * 32
+        subtree.values[page][offset : offset + 32] = value.to_le_bytes32()
+        if not subtree.present[page][slot]:
+            subtree.present[page][slot] = 1
+            subtree.page_counts[page] += 1
+            subtree.count += 1
+
+    def __delitem__(self, index: U256) -> None:
+        location = _dense_locate(self, index)
+        if location is None:
+            del self._nodes[index]
+            return
+        subtree, position = location
+        page, slot = divmod(position, DENSE_PAGE_SIZE)
+        if page not in subtree.present or not subtree.present[page][slot]:
+            raise KeyError(index)
+        subtree.present[page][slot] = 0
+        subtree.page_counts[page] -= 1
+        subtree.count -= 1
+        if subtree.page_counts[page] == 0:
+            del subtree.values[page]
+            del subtree.present[page]
+            del subtree.page_counts[page]
+        if subtree.count == 0 or (
+            subtree.count == 1 and 0 in subtree.present
+            and subtree.present[0][0]
+        ):
+            _dense_release(self, subtree)
+
+    def __contains__(self, index: object) -> bool:
+        location = _dense_locate(self, index)
+        if location is None:
+            return index in self._nodes
+        subtree, position = location
+        page, slot = divmod(position, DENSE_PAGE_SIZE)
+        return page in subtree.present and bool(subtree.present[page][slot])
+
+    def __iter__(self) -> Iterator[U256]:
+        yield from self._nodes
+        for subtree in self._subtrees.values():
+            for page, present in subtree.present.items():
+                for slot in range(DENSE_PAGE_SIZE):
+                    if present[slot]:
+                        yield _dense_index(
+                            subtree, page * DENSE_PAGE_SIZE + slot
+                        )
+
+    def __len__(self) -> int:
+        return len(self._nodes) + sum(
+            subtree.count for subtree in self._subtrees.values()
+        )
+
+
+def dense_store_add_subtree(
+    store: DenseNodeStore, root: U256, height: Uint
+) -> None:
+    """
+    Registers a complete subtree of the given height below the given root
+    whose nodes are then stored in pages of contiguous buffers. Nodes of the
+    subtree that already exist in the store are moved into the new pages.
+
+    Note that dense subtrees should not overlap each other.
+    """
+    if root in store._subtrees:
+        return
+    if _dense_locate(store, root) is not None:
+        raise AssertionError("Overlapping dense subtrees")
+    subtree = DenseSubtree(root=root, height=height)
+    moved: List[Tuple[U256, U256]] = []
+    for index, value in store._nodes.items():
+        if _dense_relative_index(subtree, index) is not None:
+            moved.append((index, value))
+    root_height = int(gti_height(root))
+    store._subtrees[root] = subtree
+    store._root_heights[root_height] = (
+        store._root_heights.get(root_height, 0) + 1
+    )
+    for index, value in moved:
+        del store._nodes[index]
+        store[index] = value
+
+
+def _dense_release(store: DenseNodeStore, subtree: DenseSubtree) -> None:
+    """
+    Removes a dense subtree from the store, moving its root node (if still
+    present) back into the dictionary of individually stored nodes.
+    """
+    del store._subtrees[subtree.root]
+    root_height = int(gti_height(subtree.root))
+    store._root_heights[root_height] -= 1
+    if store._root_heights[root_height] == 0:
+        del store._root_heights[root_height]
+    if subtree.count > 0:
+        store._nodes[subtree.root] = U256.from_le_bytes(
+            subtree.values[0][0:32]
+        )
+
+
+def _dense_locate(
+    store: DenseNodeStore, index: U256
+) -> Optional[Tuple[DenseSubtree, int]]:
+    """
+    Returns the dense subtree containing the given node and the position of
+    the node in the buffers of the subtree, or None if the node is stored
+    individually.
+    """
+    if not store._subtrees:
+        return None
+    node = int(index)
+    height = node.bit_length() - 1
+    for root_height in store._root_heights:
+        depth = height - root_height
+        if depth < 0:
+            continue
+        root = node >> depth
+        subtree = store._subtrees.get(root)
+        if subtree is None or depth > subtree.height:
+            continue
+        return subtree, node - (root << depth) + (1 << depth) - 1
+    return None
+
+
+def _dense_relative_index(
+    subtree: DenseSubtree, index: U256
+) -> Optional[U256]:
+    """
+    Returns the generalized tree index of the given node relative to the
+    root of the dense subtree, or None if the node is outside the subtree.
+    """
+    depth = gti_height(index) - gti_height(subtree.root)
+    if depth < 0 or depth > subtree.height:
+        return None
+    if index >> depth != subtree.root:
+        return None
+    gti_base = U256(1) << depth
+    return gti_base + (index & (gti_base - 1))
+
+
+def _dense_index(subtree: DenseSubtree, position: int) -> U256:
+    """
+    Returns the absolute generalized tree index of the node stored at the
+    given position of the dense subtree.
+    """
+    relative = U256(position + 1)
+    depth = gti_height(relative)
+    return (subtree.root << depth) + relative - (U256(1) << depth)
 
 
 def gti_height(index: U256) -> Uint:
@@ -119,19 +841,17 @@ def gti_height(index: U256) -> Uint:
     Returns the height of a generalized tree index. The height of the root node
     is zero, all other nodes have the height of their parent plus one.
     """
-    # TODO: more efficient implementation?
-    height = Uint(0)
-    while index > GTI_ROOT:
-        height += 1
-        index >>= 1
-    return height
+    return Uint(index.bit_length() - 1)
 
 
 def gti_vector(root: U256, index, height: Uint) -> U256:
     """
     Returns the generalized tree index of a vector item.
+
+    Note that the index is assumed to be less than 2**height so the vector
+    item index simply fills the low bits of the result.
     """
-    return root << height + index
+    return (root << height) | index
 
 
 def gti_merge(index, sub_index: U256) -> U256:
@@ -140,7 +860,7 @@ def gti_merge(index, sub_index: U256) -> U256:
     from the position index.
     """
     sub_height = gti_height(sub_index)
-    return (index - 1) << sub_height + sub_index
+    return (index << sub_height) | (sub_index ^ (GTI_ROOT << sub_height))
 
 
 def gti_split_below(index: U256, level: Uint) -> U256:
@@ -7,9 +7,22 @@ Log Index.
 
 """
 
-from dataclasses import field
+import time
+from concurrent.futures import Executor
+from dataclasses import dataclass, field
+from functools import partial
 from hashlib import sha256
-from typing import List, Tuple
+from typing import (
+    Callable,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+    Union,
+)
 
 from ethereum_rlp import rlp
 from ethereum_types.numeric import U64, U256, Uint
@@ -20,10 +33,23 @@ from .base_types import Address, Bytes
 from .binary_tree import (
     GTI_ROOT,
     BinaryTree,
+    BinaryTreeCheckpoint,
+    btree_apply_collapses,
+    btree_checkpoint,
     btree_collapse,
+    btree_defer_collapses,
+    btree_enable_stats,
     btree_expand,
+    btree_finalize,
     btree_get,
+    btree_get_parallel,
+    btree_prove,
+    btree_read,
+    btree_resolve,
+    btree_revert,
     btree_set,
+    btree_stats_snapshot,
+    btree_verify_multiproof,
     gti_height,
     gti_merge,
     gti_split_above,
@@ -32,6 +58,12 @@ from .binary_tree import (
 )
 from .blocks import Header, Log
 from .fork_types import Root
+from .node_store import NodeStore
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 LOG2_EPOCH_HISTORY = Uint(24)
 LOG2_MAPS_PER_EPOCH = Uint(10)
@@ -46,6 +78,15 @@ PROG_LIST_HEIGHT_STEP = Uint(2)
 MAPS_PER_EPOCH = Uint(1) << LOG2_MAPS_PER_EPOCH
 VALUES_PER_MAP = Uint(1) << LOG2_VALUES_PER_MAP
 MAP_HEIGHT = Uint(1) << LOG2_MAP_HEIGHT
+MAP_WIDTH = Uint(1) << LOG2_MAP_WIDTH
+
+# parallel root calculation splits the index entries of each map (and the
+# rows of the filter maps) into 2**4 subtrees hashed by 2**4 tasks
+LOG2_PARALLEL_SUBTREES = Uint(4)
+PARALLEL_SPLIT_DEPTH = (
+    LOG2_EPOCH_HISTORY + 2 + LOG2_MAPS_PER_EPOCH + LOG2_PARALLEL_SUBTREES
+)
+PARALLEL_TASKS = 1 << LOG2_PARALLEL_SUBTREES
 
 # absolute generalized tree indices
 GTI_EPOCH_HISTORY = U256(2)
@@ -73,10 +114,28 @@ GTI_ENTRY_META_FIELD_2 = U256(6)
 GTI_ENTRY_META_FIELD_3 = U256(7)
 
 
+@dataclass
 class LogIndexState:
     """
     Contains all information required to append the log index and calculate its
     root hash.
+
+    Note that _map_value_positions holds the precalculated layer 0 row and
+    column indices of upcoming map values, keyed by map value index (see
+    log_index_add_block). _row_lengths and _row_chunks cache the lengths and
+    partially filled last chunks of the rows of the current filter map,
+    keyed by map index and row index (see flush_filter_map_rows).
+
+    Filter map rows are only expanded when they are first used, the empty
+    node values of the filter maps subtree depend on initialized_maps instead
+    (see log_index_state_empty_node). _touched_rows lists the used rows of
+    each uncollapsed map while _map_dependent_nodes collects the expanded
+    empty nodes whose value still changes when the next map is initialized.
+    Once a checkpoint has been created, every row added to or removed from
+    _touched_rows, keyed by (map index, row index), and every node added to
+    or removed from _map_dependent_nodes, keyed by generalized tree index, is
+    also recorded in _journal along with a flag telling whether it has been
+    added (see log_index_revert).
     """
 
     tree: BinaryTree = field(
@@ -85,14 +144,324 @@ class LogIndexState:
             empty_node=log_index_empty_node,
         )
     )
+    next_entry: Uint = Uint(0)
+    _map_value_positions: Dict[Uint, Tuple[Hash32, Uint, Uint]] = field(
+        default_factory=dict
+    )
+    _row_lengths: Dict[Tuple[Uint, Uint], Uint] = field(default_factory=dict)
+    _row_chunks: Dict[Tuple[Uint, Uint], U256] = field(default_factory=dict)
+    initialized_maps: Uint = Uint(0)
+    _touched_rows: Dict[Uint, Set[Uint]] = field(default_factory=dict)
+    _map_dependent_nodes: Set[U256] = field(default_factory=set)
+    _journal: Optional[
+        List[Tuple[Union[Tuple[Uint, Uint], U256], bool]]
+    ] = None
+    _journal_offset: int = 0
+
+    def __post_init__(self) -> None:
+        self.tree.empty_node = partial(log_index_state_empty_node, self)
+
+
+@dataclass
+class LogIndexCheckpoint:
+    """
+    State of the log index at a checkpoint (see log_index_checkpoint).
+    """
+
+    tree: BinaryTreeCheckpoint
     next_entry: Uint
+    initialized_maps: Uint
+    journal: int
 
 
 def log_index_root(log_index: LogIndexState) -> Root:
     """
-    Returns the current root hash of the log index tree.
+    Returns the current root hash of the log index tree and performs the
+    collapses deferred by log_index_defer_collapses.
+    """
+    flush_filter_map_rows(log_index)
+    root = btree_get(log_index.tree, GTI_ROOT)
+    btree_apply_collapses(log_index.tree)
+    return Root(root)
+
+
+def log_index_root_parallel(
+    log_index: LogIndexState, executor: Executor
+) -> Root:
+    """
+    Returns the current root hash of the log index tree like log_index_root
+    but hashes the invalidated parts of the tree in parallel using the given
+    executor (see btree_get_parallel). The index entries of each map and the
+    rows of the filter maps are split into independent subtrees.
+
+    Note that completed maps and epochs are hashed when they are collapsed,
+    so this is only useful if the collapses have been deferred with
+    log_index_defer_collapses, typically when backfilling the index (see
+    log_index_backfill).
+    """
+    flush_filter_map_rows(log_index)
+    root = btree_get_parallel(
+        log_index.tree, executor, PARALLEL_SPLIT_DEPTH, PARALLEL_TASKS
+    )
+    btree_apply_collapses(log_index.tree)
+    return Root(root)
+
+
+def log_index_defer_collapses(log_index: LogIndexState, enabled: bool) -> None:
+    """
+    Starts or stops deferring the collapses of completed index entries,
+    filter map rows and epochs until the next log_index_root or
+    log_index_root_parallel call (see btree_defer_collapses).
+
+    Note that the deferred subtrees stay in memory until then and that no
+    checkpoints can be created or reverted to while collapses are pending.
+    """
+    btree_defer_collapses(log_index.tree, enabled)
+
+
+def log_index_enable_stats(log_index: LogIndexState) -> None:
+    """
+    Starts counting the tree operations of the log index, broken down by the
+    regions returned by log_index_region (see btree_enable_stats).
+    """
+    btree_enable_stats(log_index.tree, log_index_region)
+
+
+def log_index_stats(log_index: LogIndexState) -> Dict[str, Dict[str, int]]:
     """
-    return Root(btree_get(log_index.tree, GTI_ROOT))
+    Returns a snapshot of the tree operation counters of the log index, keyed
+    by region and counter name.
+    """
+    return btree_stats_snapshot(log_index.tree)
+
+
+def log_index_region(index: U256) -> str:
+    """
+    Returns the region of the log index tree containing the given node:
+    "filter_maps" or "index_entries" below the epoch roots, "epoch_history"
+    for the epoch roots and the nodes above them, "next_entry" or "root".
+    """
+    height = gti_height(index)
+    if height == 0:
+        return "root"
+    if index >> (height - 1) == GTI_NEXT_ENTRY:
+        return "next_entry"
+    if height <= LOG2_EPOCH_HISTORY + 1:
+        return "epoch_history"
+    if (index >> (height - LOG2_EPOCH_HISTORY - 2)) & 1 == 0:
+        return "filter_maps"
+    return "index_entries"
+
+
+def log_index_prove(
+    log_index: LogIndexState,
+    entry_indices: Sequence[Uint] = (),
+    rows: Sequence[Tuple[Uint, Uint]] = (),
+) -> Tuple[Dict[U256, U256], List[U256]]:
+    """
+    Creates a multiproof of the given index entries and filter map rows (the
+    latter specified as (map index, row index) pairs). Returns the proven
+    subtree roots by generalized tree index and the proof nodes.
+
+    Note that the next_entry leaf is always proven, as specified by the
+    LogIndexProof format. Entries and rows collapsed without a node store
+    cannot be proven.
+    """
+    log_index_root(log_index)
+    indices = [GTI_NEXT_ENTRY]
+    indices += [index_entry_gti(index) for index in entry_indices]
+    indices += [map_row_gti(map_index, row) for map_index, row in rows]
+    nodes = {}
+    for index in indices:
+        value = btree_resolve(log_index.tree, index)
+        if value is None:
+            raise AssertionError("Log index node not available")
+        nodes[index] = value
+    return nodes, btree_prove(log_index.tree, indices)
+
+
+def log_index_verify_proof(
+    root: Root, nodes: Dict[U256, U256], proof: Sequence[U256]
+) -> bool:
+    """
+    Verifies a multiproof created by log_index_prove against the given log
+    index root.
+    """
+    return btree_verify_multiproof(_binary_hash, U256(root), nodes, proof)
+
+
+def log_index_checkpoint(log_index: LogIndexState) -> LogIndexCheckpoint:
+    """
+    Creates a checkpoint that the log index can later be reverted to with
+    log_index_revert. Creating a checkpoint before adding each block allows
+    reverting the last N blocks by reverting to the Nth last checkpoint, at a
+    cost proportional to the changes made since then. Creating a checkpoint
+    does not copy any state; the first one starts the undo journals of the
+    state and of the tree.
+
+    Note that the row cache is written to the tree (without recalculating any
+    hashes) so that all filter map changes are recorded by the undo journal
+    of the tree.
+    """
+    flush_filter_map_rows(log_index)
+    if log_index._journal is None:
+        log_index._journal = []
+    return LogIndexCheckpoint(
+        tree=btree_checkpoint(log_index.tree),
+        next_entry=log_index.next_entry,
+        initialized_maps=log_index.initialized_maps,
+        journal=log_index._journal_offset + len(log_index._journal),
+    )
+
+
+def log_index_revert(
+    log_index: LogIndexState, checkpoint: LogIndexCheckpoint
+) -> None:
+    """
+    Reverts the log index to the state of the given checkpoint.
+
+    Note that the used rows of the uncollapsed filter maps and the map
+    dependent nodes are restored by undoing the additions and removals
+    journaled since the checkpoint, so the cost is proportional to the changes
+    made since then.
+    """
+    btree_revert(log_index.tree, checkpoint.tree)
+    log_index.next_entry = checkpoint.next_entry
+    log_index.initialized_maps = checkpoint.initialized_maps
+    log_index._map_value_positions.clear()
+    log_index._row_lengths.clear()
+    log_index._row_chunks.clear()
+    journal = log_index._journal
+    position = checkpoint.journal - log_index._journal_offset
+    if journal is None or position < 0:
+        raise AssertionError("Checkpoint has been finalized")
+    while len(journal) > position:
+        key, added = journal.pop()
+        if not isinstance(key, tuple):
+            if added:
+                log_index._map_dependent_nodes.discard(key)
+            else:
+                log_index._map_dependent_nodes.add(key)
+            continue
+        map_index, row_index = key
+        if added:
+            rows = log_index._touched_rows[map_index]
+            rows.discard(row_index)
+            if not rows:
+                del log_index._touched_rows[map_index]
+        else:
+            log_index._touched_rows.setdefault(map_index, set()).add(
+                row_index
+            )
+
+
+def log_index_finalize(
+    log_index: LogIndexState, checkpoint: LogIndexCheckpoint
+) -> None:
+    """
+    Discards the undo journal entries recorded before the given checkpoint,
+    typically when the block added after it has been finalized.
+    """
+    btree_finalize(log_index.tree, checkpoint.tree)
+    journal = log_index._journal
+    position = checkpoint.journal - log_index._journal_offset
+    if journal is not None and position > 0:
+        del journal[:position]
+        log_index._journal_offset = checkpoint.journal
+
+
+def log_index_snapshot(log_index: LogIndexState) -> bytes:
+    """
+    Serializes the uncollapsed frontier of the log index: every node held in
+    memory (the roots of collapsed subtrees and the expanded parts of the
+    current filter map and index entries) along with the pointers and the
+    bookkeeping of the current map. Similarly to the finalized branches of
+    a DepositTreeSnapshot, this is enough to continue adding entries.
+
+    The format consists of little endian integers: next_entry and
+    initialized_maps (8 bytes each), the number of nodes (8 bytes) followed
+    by the index and value of each node (32 bytes each), the number of map
+    dependent nodes (8 bytes) followed by their indices (32 bytes each) and
+    the number of maps with used rows (8 bytes) followed by the map index,
+    the number of used rows (8 bytes each) and the row indices (4 bytes each)
+    of each map.
+
+    Note that the row cache is flushed and the root is recalculated so that
+    the snapshot contains no invalidated nodes. Collapsed nodes are not
+    included and the undo journal is not preserved.
+    """
+    log_index_root(log_index)
+    tree = log_index.tree
+    data = bytearray()
+    data += log_index.next_entry.to_bytes(8, "little")
+    data += log_index.initialized_maps.to_bytes(8, "little")
+    data += len(tree._data).to_bytes(8, "little")
+    for index in sorted(tree._data):
+        data += index.to_le_bytes32()
+        data += tree._data[index].to_le_bytes32()
+    data += len(log_index._map_dependent_nodes).to_bytes(8, "little")
+    for index in sorted(log_index._map_dependent_nodes):
+        data += index.to_le_bytes32()
+    data += len(log_index._touched_rows).to_bytes(8, "little")
+    for map_index, rows in sorted(log_index._touched_rows.items()):
+        data += map_index.to_bytes(8, "little")
+        data += len(rows).to_bytes(8, "little")
+        for row_index in sorted(rows):
+            data += row_index.to_bytes(4, "little")
+    return bytes(data)
+
+
+def log_index_restore(
+    data: bytes, node_store: Optional[NodeStore] = None
+) -> LogIndexState:
+    """
+    Restores a log index from a snapshot created by log_index_snapshot. The
+    node store holding the collapsed subtrees, if any, can be attached to
+    the restored tree.
+    """
+    reader = _SnapshotReader(data)
+    log_index = LogIndexState(
+        next_entry=Uint(_snapshot_read(reader, 8)),
+        initialized_maps=Uint(_snapshot_read(reader, 8)),
+    )
+    tree = log_index.tree
+    tree.node_store = node_store
+    for _ in range(_snapshot_read(reader, 8)):
+        index = U256(_snapshot_read(reader, 32))
+        tree._data[index] = U256(_snapshot_read(reader, 32))
+    for _ in range(_snapshot_read(reader, 8)):
+        log_index._map_dependent_nodes.add(U256(_snapshot_read(reader, 32)))
+    for _ in range(_snapshot_read(reader, 8)):
+        rows = log_index._touched_rows.setdefault(
+            Uint(_snapshot_read(reader, 8)), set()
+        )
+        for _ in range(_snapshot_read(reader, 8)):
+            rows.add(Uint(_snapshot_read(reader, 4)))
+    if reader.offset != len(data):
+        raise AssertionError("Invalid log index snapshot")
+    return log_index
+
+
+@dataclass
+class _SnapshotReader:
+    """
+    Reads little endian integers from a log index snapshot.
+    """
+
+    data: bytes
+    offset: int = 0
+
+
+def _snapshot_read(reader: _SnapshotReader, length: int) -> int:
+    """
+    Reads the next integer of the given byte length from a snapshot.
+    """
+    end = reader.offset + length
+    if end > len(reader.data):
+        raise AssertionError("Invalid log index snapshot")
+    value = int.from_bytes(reader.data[reader.offset : end], "little")
+    reader.offset = end
+    return value
 
 
 def log_index_add_tx_entry(
@@ -148,8 +517,7 @@ def log_index_add_log_entries(
     Adds address and topic entries to the current filter map and a log entry to
     the index entries tree according to the given list of log events.
     """
-    log_index = Uint(0)
-    for log in logs:
+    for log_in_tx_index, log in enumerate(logs):
         prepare_index(log_index, Uint(len(log.topics) + 1))
         add_to_filter_maps(log_index, map_value_hash_address(log.address))
         add_log_entry(log_index, log)
@@ -158,7 +526,7 @@ def log_index_add_log_entries(
             U256(block_number),
             U256(tx_hash),
             U256(tx_index),
-            U256(0),
+            U256(log_in_tx_index),
         )
         advance_index(log_index, 1)
         for topic in log.topics:
@@ -166,11 +534,410 @@ def log_index_add_log_entries(
             advance_index(log_index, 1)
 
 
+def log_index_add_block(
+    log_index: LogIndexState,
+    header: Header,
+    transactions: Sequence[Tuple[Hash32, Hash32, Tuple[Log, ...]]],
+) -> None:
+    """
+    Adds the entries of an entire block to the log index: a transaction
+    delimiter and the log entries of each (transaction hash, receipt hash,
+    logs) tuple, followed by the block delimiter.
+
+    Note that the layer 0 row and column indices of all map values of the
+    block are calculated in a single batch (see get_row_indices and
+    get_column_indices) before the entries are added one by one.
+    """
+    block_hash = keccak256(rlp.encode(header))
+    groups: List[List[Hash32]] = []
+    for tx_hash, _, logs in transactions:
+        groups.append([map_value_hash_tx(tx_hash)])
+        for log in logs:
+            groups.append(
+                [map_value_hash_address(log.address)]
+                + [map_value_hash_topic(topic) for topic in log.topics]
+            )
+    groups.append([map_value_hash_block(block_hash)])
+    map_value_indices: List[Uint] = []
+    map_value_hashes: List[Hash32] = []
+    next_entry = log_index.next_entry
+    for group in groups:
+        # same padding rule as in prepare_index
+        map_remaining = VALUES_PER_MAP - next_entry % VALUES_PER_MAP
+        if map_remaining < len(group):
+            next_entry += map_remaining
+        for map_value_hash in group:
+            map_value_indices.append(next_entry)
+            map_value_hashes.append(map_value_hash)
+            next_entry += 1
+    rows = get_row_indices(map_value_indices, Uint(0), map_value_hashes)
+    columns = get_column_indices(map_value_indices, map_value_hashes)
+    for map_value_index, map_value_hash, row_index, column_index in zip(
+        map_value_indices, map_value_hashes, rows, columns
+    ):
+        log_index._map_value_positions[map_value_index] = (
+            map_value_hash,
+            row_index,
+            column_index,
+        )
+    for tx_index, (tx_hash, receipt_hash, logs) in enumerate(transactions):
+        log_index_add_tx_entry(
+            log_index, header.number, tx_hash, receipt_hash, Uint(tx_index)
+        )
+        log_index_add_log_entries(
+            log_index, header.number, tx_hash, Uint(tx_index), logs
+        )
+    log_index_add_block_entry(log_index, header)
+    log_index._map_value_positions.clear()
+
+
+@dataclass
+class LogIndexMatch:
+    """
+    A potential match found by log_index_query.
+
+    The block number is taken from the entry meta of the index entry. The
+    false_positive flag is set if the log entry is available and does not
+    actually match the query. Either field is None if the corresponding part
+    of the index entry is not available (collapsed without a node store);
+    the block number is also None if there is no index entry at the position.
+    """
+
+    entry_index: Uint
+    block_number: Optional[Uint]
+    false_positive: Optional[bool]
+
+
+@dataclass
+class LogIndexBackfillProgress:
+    """
+    Progress report of log_index_backfill.
+
+    The next_block and next_entry fields form a resume point: a log index
+    state saved at the time of the report (for example with
+    log_index_snapshot) can be backfilled further by passing the report as
+    the resume argument.
+    """
+
+    blocks: int
+    elapsed: float
+    blocks_per_second: float
+    next_block: Uint
+    next_entry: Uint
+
+
+def log_index_backfill(
+    log_index: LogIndexState,
+    blocks: Iterable[
+        Tuple[Header, Sequence[Tuple[Hash32, Hash32, Tuple[Log, ...]]]]
+    ],
+    resume: Optional[LogIndexBackfillProgress] = None,
+    report: Optional[Callable[[LogIndexBackfillProgress], None]] = None,
+    executor: Optional[Executor] = None,
+) -> LogIndexBackfillProgress:
+    """
+    Adds a stream of blocks to the log index, each one given as a header and
+    a sequence of (transaction hash, receipt hash, logs) tuples like in
+    log_index_add_block. If a resume point is given then the log index has
+    to be in the state saved along with it and the blocks numbered below
+    its next_block are skipped.
+
+    The progress is reported after the first block completing a filter map,
+    so every report is a resume point at a block boundary. The final
+    progress is reported and returned at the end.
+
+    Note that with an executor the collapses are deferred (see
+    log_index_defer_collapses) and the completed maps are hashed in parallel
+    with log_index_root_parallel before each report.
+    """
+    start = time.monotonic()
+    blocks_added = 0
+    next_block = Uint(0)
+    if resume is not None:
+        if log_index.next_entry != resume.next_entry:
+            raise AssertionError("Log index does not match the resume point")
+        next_block = resume.next_block
+    if executor is not None:
+        log_index_defer_collapses(log_index, True)
+    try:
+        for header, transactions in blocks:
+            if header.number < next_block:
+                continue
+            map_index = log_index.next_entry // VALUES_PER_MAP
+            log_index_add_block(log_index, header, transactions)
+            blocks_added += 1
+            next_block = Uint(header.number) + 1
+            if log_index.next_entry // VALUES_PER_MAP == map_index:
+                continue
+            if executor is not None:
+                log_index_root_parallel(log_index, executor)
+            if report is not None:
+                report(
+                    _backfill_progress(
+                        log_index, start, blocks_added, next_block
+                    )
+                )
+        if executor is not None:
+            log_index_root_parallel(log_index, executor)
+    finally:
+        if executor is not None:
+            log_index_defer_collapses(log_index, False)
+    progress = _backfill_progress(log_index, start, blocks_added, next_block)
+    if report is not None:
+        report(progress)
+    return progress
+
+
+def _backfill_progress(
+    log_index: LogIndexState, start: float, blocks: int, next_block: Uint
+) -> LogIndexBackfillProgress:
+    """
+    Creates a progress report of log_index_backfill.
+    """
+    elapsed = time.monotonic() - start
+    return LogIndexBackfillProgress(
+        blocks=blocks,
+        elapsed=elapsed,
+        blocks_per_second=blocks / elapsed if elapsed > 0 else 0.0,
+        next_block=next_block,
+        next_entry=log_index.next_entry,
+    )
+
+
+def log_index_query(
+    log_index: LogIndexState,
+    from_block: Uint,
+    to_block: Uint,
+    address: Optional[Address] = None,
+    topics: Sequence[Optional[Hash32]] = (),
+) -> List[LogIndexMatch]:
+    """
+    Returns the log entries in the given block range that potentially match
+    the given address and topics. A None address or topic position matches any
+    value; at least one of them has to be specified.
+
+    For each filter map of the block range the potential matches of each
+    specified map value are collected from the filter map rows and the
+    candidate log entry indices are intersected. The candidates are then
+    checked against the stored log entries and flagged if they turn out to be
+    false positives.
+
+    Note that completed filter maps and index entries are collapsed, so
+    without a node store only the current filter map can be searched. Its
+    matches are returned regardless of the block range because their block
+    numbers are not available either (see LogIndexMatch).
+    """
+    constraints: List[Tuple[Uint, Hash32]] = []
+    if address is not None:
+        constraints.append((Uint(0), map_value_hash_address(address)))
+    for position, topic in enumerate(topics):
+        if topic is not None:
+            constraints.append(
+                (Uint(position + 1), map_value_hash_topic(topic))
+            )
+    if not constraints:
+        raise AssertionError("Empty log index query")
+    if log_index.next_entry == 0:
+        return []
+    log_index_root(log_index)  # flush rows and rehash invalidated nodes
+    first_map, last_map = _query_map_range(log_index, from_block, to_block)
+    matches = []
+    for i in range(first_map, last_map + 1):
+        map_index = Uint(i)
+        candidates: Optional[Set[Uint]] = None
+        for offset, map_value_hash in constraints:
+            entries = set(
+                map_value_index - offset
+                for map_value_index in get_potential_matches(
+                    log_index, map_index, map_value_hash
+                )
+                if map_value_index >= offset
+            )
+            if candidates is None:
+                candidates = entries
+            else:
+                candidates &= entries
+            if not candidates:
+                break
+        for entry_index in sorted(candidates):
+            match = _check_query_match(log_index, entry_index, address, topics)
+            if match.block_number is not None and not (
+                from_block <= match.block_number <= to_block
+            ):
+                continue
+            matches.append(match)
+    return matches
+
+
+def get_potential_matches(
+    log_index: LogIndexState, map_index: Uint, map_value_hash: Hash32
+) -> List[Uint]:
+    """
+    Returns the map value indices of the given filter map where the given map
+    value hash has potentially been added, iterating through all mapping
+    layers that have been used for the map value.
+    """
+    matches = []
+    layer_index = Uint(0)
+    while True:
+        max_length = MAX_ROW_LENGTH[min(layer_index, len(MAX_ROW_LENGTH) - 1)]
+        row_index = get_row_index(map_index, layer_index, map_value_hash)
+        row = get_filter_row(log_index, map_index, row_index, max_length)
+        for column_index in row:
+            if is_potential_match(map_index, column_index, map_value_hash):
+                map_value_index = get_map_value_index(map_index, column_index)
+                if map_value_index not in matches:
+                    matches.append(map_value_index)
+        if len(row) < max_length:
+            return matches
+        layer_index += 1
+
+
+def get_filter_row(
+    log_index: LogIndexState,
+    map_index: Uint,
+    row_index: Uint,
+    max_length: Uint,
+) -> List[Uint]:
+    """
+    Returns the first max_length column indices of the given filter map row.
+
+    Note that rows collapsed without a node store cannot be read.
+    """
+    map_row_root = map_row_gti(map_index, row_index)
+    count_node = gti_merge(map_row_root, GTI_LIST_COUNT)
+    row_length = btree_resolve(log_index.tree, count_node)
+    if row_length is None:
+        raise AssertionError("Filter map row not available")
+    row_length = min(Uint(row_length), max_length)
+    row = []
+    for chunk_index in range((row_length + 7) // 8):
+        chunk_node = prog_list_chunk_gti(map_row_root, chunk_index)
+        chunk = btree_read(log_index.tree, chunk_node)
+        if chunk is None:
+            raise AssertionError("Filter map row not available")
+        for chunk_subindex in range(min(8, row_length - chunk_index * 8)):
+            row.append(Uint((chunk >> (32 * chunk_subindex)) & 0xFFFFFFFF))
+    return row
+
+
+def _query_map_range(
+    log_index: LogIndexState, from_block: Uint, to_block: Uint
+) -> Tuple[Uint, Uint]:
+    """
+    Returns the range of filter maps that may contain entries of the given
+    block range, based on the block numbers of the first entries of the maps.
+    Maps whose rows cannot be read anymore are left out; the returned range
+    is empty if there are no readable maps.
+
+    Note that the first position of each map always holds an index entry
+    because the entries of a log are never split between two maps.
+    """
+    last_map = (log_index.next_entry - 1) // VALUES_PER_MAP
+    if log_index.tree.node_store is not None:
+        first_available = Uint(0)
+    else:
+        # completed maps have been collapsed
+        first_available = log_index.next_entry // VALUES_PER_MAP
+    # last map whose first entry belongs to an earlier block than from_block
+    low, high = first_available, last_map
+    while low < high:
+        middle = (low + high + 1) // 2
+        block_number = _entry_block_number(log_index, middle * VALUES_PER_MAP)
+        if block_number is None:
+            low = first_available
+            break
+        if block_number < from_block:
+            low = middle
+        else:
+            high = middle - 1
+    first_map = low
+    # last map whose first entry does not belong to a later block than to_block
+    low, high = first_map, last_map
+    while low < high:
+        middle = (low + high + 1) // 2
+        block_number = _entry_block_number(log_index, middle * VALUES_PER_MAP)
+        if block_number is None:
+            high = last_map
+            break
+        if block_number <= to_block:
+            low = middle
+        else:
+            high = middle - 1
+    return first_map, high
+
+
+def _entry_block_number(
+    log_index: LogIndexState, entry_index: Uint
+) -> Optional[Uint]:
+    """
+    Returns the block number stored in the entry meta of the given index
+    entry or None if it is not available.
+    """
+    root = gti_merge(index_entry_gti(entry_index), GTI_ENTRY_META)
+    field_0 = btree_read(
+        log_index.tree, gti_merge(root, GTI_ENTRY_META_FIELD_0)
+    )
+    if field_0 is None:
+        return None
+    return Uint(field_0)
+
+
+def _check_query_match(
+    log_index: LogIndexState,
+    entry_index: Uint,
+    address: Optional[Address],
+    topics: Sequence[Optional[Hash32]],
+) -> LogIndexMatch:
+    """
+    Reads the given candidate log entry and checks whether it actually matches
+    the query. Candidates at positions without an index entry (topic values
+    and map padding) are false positives without a block number.
+
+    Note that the log entry fields are resolved (see btree_resolve) so that
+    transaction and block entries, whose log entry is empty, are recognized
+    as false positives too.
+    """
+    entry_root = btree_resolve(log_index.tree, index_entry_gti(entry_index))
+    if entry_root == U256(0):
+        return LogIndexMatch(entry_index, None, True)
+    block_number = _entry_block_number(log_index, entry_index)
+    log_entry_root = gti_merge(index_entry_gti(entry_index), GTI_LOG_ENTRY)
+    if address is not None:
+        address_node = gti_merge(log_entry_root, GTI_LOG_ADDRESS)
+        value = btree_resolve(log_index.tree, address_node)
+        if value is None:
+            return LogIndexMatch(entry_index, block_number, None)
+        if value != U256(address):
+            return LogIndexMatch(entry_index, block_number, True)
+    topics_root = gti_merge(log_entry_root, GTI_LOG_TOPICS)
+    topic_count = btree_resolve(
+        log_index.tree, gti_merge(topics_root, GTI_LIST_COUNT)
+    )
+    if topic_count is None:
+        return LogIndexMatch(entry_index, block_number, None)
+    if topic_count < len(topics):
+        return LogIndexMatch(entry_index, block_number, True)
+    list_tree_root = gti_merge(topics_root, GTI_LIST_TREE)
+    for i, topic in enumerate(topics):
+        if topic is None:
+            continue
+        value = btree_resolve(
+            log_index.tree, gti_vector(list_tree_root, i, 2)
+        )
+        if value is None:
+            return LogIndexMatch(entry_index, block_number, None)
+        if value != U256(topic):
+            return LogIndexMatch(entry_index, block_number, True)
+    return LogIndexMatch(entry_index, block_number, False)
+
+
 def prepare_index(log_index: LogIndexState, count: Uint) -> None:
     """
     Prepares the log index before adding the given number of entries by
-    expanding the rows of the next filter map if the previous one has been
-    filled.
+    initializing the next filter map if the previous one has been filled.
+    The rows of the new map are not expanded; initializing the map only
+    changes the empty node values of its rows (see initialize_map).
 
     Note that a batch of entries belonging to a single log cannot be split
     between two maps so the function also pads the end of the current map with
@@ -179,30 +946,47 @@ def prepare_index(log_index: LogIndexState, count: Uint) -> None:
     """
     map_remaining = VALUES_PER_MAP - log_index.next_entry % VALUES_PER_MAP
     if map_remaining < count:
+        expand_index_entries(log_index, map_remaining)
         advance_index(log_index, map_remaining)
         map_remaining = VALUES_PER_MAP
     if map_remaining == VALUES_PER_MAP:  # initialize new map
         map_index = log_index.next_entry // VALUES_PER_MAP
-        for row_index in range(MAP_HEIGHT):  # expand prog list of each row
-            prog_list_root = map_row_gti(map_index, row_index)
-            expand_node = gti_merge(prog_list_root, GTI_LIST_COUNT)
-            btree_expand(log_index.tree, expand_node)
+        initialize_map(log_index, map_index)
+    expand_index_entries(log_index, count)
+
+
+def expand_index_entries(log_index: LogIndexState, count: Uint) -> None:
+    """
+    Expands the given number of index entries starting from the current
+    next_entry pointer so that every entry can be collapsed, including the
+    ones that are left empty (topic entries and padding).
+
+    Note that the entries have to be expanded before anything is written to
+    them; the root of a written entry is invalidated and expanding it again
+    would overwrite its children with empty nodes.
+    """
+    for i in range(count):
+        entry_root = index_entry_gti(log_index.next_entry + i)
+        btree_expand(log_index.tree, entry_root)
 
 
 def advance_index(log_index: LogIndexState, count: Uint) -> None:
     """
     Collapses the given number of index entries starting from the current
     next_entry pointer while also advancing the pointer. If the current map is
-    filled then its rows are also collapsed.
+    filled then its cached rows are flushed and collapsed before its last
+    index entry, so that the last entry of an epoch collapses the entire
+    epoch tree after the last map.
 
     Note that this function should always be called after adding an entry to
     the current position. It may also be called without adding anything which
     results in empty collapsed index entries and no row entries added to the
     filter map.
     """
-    if log_index.next_entry % VALUES_PER_MAP == 0:
-        collapse_map(log_index.next_entry // VALUES_PER_MAP - 1)
     for _ in range(count):
+        if (log_index.next_entry + 1) % VALUES_PER_MAP == 0:
+            flush_filter_map_rows(log_index)
+            collapse_map(log_index, log_index.next_entry // VALUES_PER_MAP)
         collapse_subtree(log_index, index_entry_gti(log_index.next_entry))
         log_index.next_entry += 1
     btree_set(log_index.tree, GTI_NEXT_ENTRY, U256(log_index.next_entry))
@@ -218,8 +1002,9 @@ def collapse_subtree(log_index: LogIndexState, gti: U256) -> None:
     child is collapsed before the rightmost descendant of the right child so
     that the parent is collapsed after the subtree is completed.
 
-    A practical implementation that actually needs the generated tree structure
-    should save the collapsed subtrees to a persistent database.
+    An implementation that actually needs the generated tree structure can
+    attach a node store (see node_store.py) to the tree; collapsed subtrees
+    are then saved to it and remain readable with btree_read.
     Also a practical implementation might only collapse the parts of the index
     generated by a block that has actually been finalized, so that reverting
     a block can be realized by rolling back recent additions to the index.
@@ -229,18 +1014,52 @@ def collapse_subtree(log_index: LogIndexState, gti: U256) -> None:
     btree_collapse(log_index.tree, gti)
 
 
+def initialize_map(log_index: LogIndexState, map_index: Uint) -> None:
+    """
+    Marks the given filter map as initialized, turning its rows into empty
+    lists. Expanded empty nodes of the filter maps subtree whose value is
+    changed by this are updated, while the ones whose value cannot change
+    anymore are forgotten.
+
+    Note that only expanded nodes without expanded descendants are updated;
+    the values of internal nodes are recalculated from their children.
+    """
+    previous_maps = log_index.initialized_maps
+    log_index.initialized_maps = map_index + 1
+    tree = log_index.tree
+    for index in list(log_index._map_dependent_nodes):
+        epoch_index, height, position = _filter_maps_node_position(index)
+        previous, full = _initialized_map_count(
+            previous_maps, epoch_index, height, position
+        )
+        initialized, _ = _initialized_map_count(
+            log_index.initialized_maps, epoch_index, height, position
+        )
+        is_leaf = index in tree._data and index * 2 not in tree._data
+        if initialized != previous and is_leaf:
+            value = _filter_maps_empty_node(height, initialized)
+            btree_set(tree, index, value)
+        if initialized == full or not is_leaf:
+            log_index._map_dependent_nodes.discard(index)
+            if log_index._journal is not None:
+                log_index._journal.append((index, False))
+
+
 def collapse_map(log_index: LogIndexState, map_index: Uint) -> None:
     """
-    Collapses each row of the given filter map.
+    Collapses each used row of the given filter map.
 
     Note that the incremental collapse logic (see collapse_subtree)
     is applied here too and maps should also be collapsed in a strictly
-    increasing order. This also ensures that collapsing each map of an epoch
-    finally collapses the entire filter maps subtree. It also assumes that the
-    last index entry of the epoch is collapsed after the last map, finally
-    collapsing the entire epoch tree.
+    increasing order. Rows that have never been used are skipped; their empty
+    nodes are removed when a subtree containing them is collapsed. It is
+    assumed that the last index entry of the epoch is collapsed after the
+    last map, finally collapsing the entire epoch tree.
     """
-    for row_index in range(MAP_HEIGHT):
+    journal = log_index._journal
+    for row_index in sorted(log_index._touched_rows.pop(map_index, ())):
+        if journal is not None:
+            journal.append(((map_index, row_index), False))
         collapse_subtree(log_index, map_row_gti(map_index, row_index))
 
 
@@ -278,27 +1097,79 @@ def add_to_filter_maps(
     """
     Adds the given entry hash to the current filter map at the current
     next_entry position.
+
+    Note that precalculated layer 0 row and column indices are used if they
+    are available for the current position and map value. Row lengths and
+    the partially filled last chunks of rows are only kept in the row cache
+    of the log index state until flush_filter_map_rows is called.
     """
     map_index = log_index.next_entry // VALUES_PER_MAP
+    position = log_index._map_value_positions.pop(log_index.next_entry, None)
+    if position is not None and position[0] != map_value_hash:
+        position = None
     layer_index = Uint(0)
     while True:
-        row_index = get_row_index(map_index, layer_index, map_value_hash)
+        if layer_index == 0 and position is not None:
+            row_index = position[1]
+        else:
+            row_index = get_row_index(map_index, layer_index, map_value_hash)
+        row_key = (map_index, row_index)
         map_row_root = map_row_gti(map_index, row_index)
-        count_node = gti_merge(map_row_root, GTI_LIST_COUNT)
-        row_length = Uint(btree_get(log_index.tree, count_node))
+        row_length = log_index._row_lengths.get(row_key)
+        if row_length is None:
+            count_node = gti_merge(map_row_root, GTI_LIST_COUNT)
+            if count_node in log_index.tree._data:
+                row_length = Uint(btree_get(log_index.tree, count_node))
+            else:  # row not expanded yet
+                row_length = Uint(0)
         max_length = MAX_ROW_LENGTH[min(layer_index, len(MAX_ROW_LENGTH) - 1)]
         if row_length < max_length:
-            column = get_column_index(log_index.next_entry, map_value_hash)
+            if position is not None:
+                column = position[2]
+            else:
+                column = get_column_index(log_index.next_entry, map_value_hash)
             chunk_node = prog_list_chunk_gti(map_row_root, row_length // 8)
             chunk = U256(0)
             chunk_subindex = row_length % 8
             if chunk_subindex > 0:
-                chunk = btree_get(log_index.tree, chunk_node)
+                chunk = log_index._row_chunks.pop(row_key, None)
+                if chunk is None:
+                    chunk = btree_get(log_index.tree, chunk_node)
             chunk += U256(column) << (32 * chunk_subindex)
-            btree_set(log_index.tree, chunk_node, chunk)
-            row_length += 1
-            btree_set(log_index.tree, count_node, U256(row_length))
+            if chunk_subindex == 7:
+                btree_set(log_index.tree, chunk_node, chunk)
+            else:
+                log_index._row_chunks[row_key] = chunk
+            log_index._row_lengths[row_key] = row_length + 1
+            rows = log_index._touched_rows.setdefault(map_index, set())
+            if row_index not in rows:
+                rows.add(row_index)
+                if log_index._journal is not None:
+                    log_index._journal.append(((map_index, row_index), True))
             return
+        layer_index += 1
+
+
+def flush_filter_map_rows(log_index: LogIndexState) -> None:
+    """
+    Writes the cached row lengths and partially filled last chunks of the
+    filter map rows to the tree and clears the cache.
+
+    Note that this has to happen before the rows are collapsed or read from
+    the tree (see advance_index and log_index_root).
+    """
+    if not log_index._row_lengths:
+        return
+    for (map_index, row_index), row_length in log_index._row_lengths.items():
+        map_row_root = map_row_gti(map_index, row_index)
+        count_node = gti_merge(map_row_root, GTI_LIST_COUNT)
+        btree_set(log_index.tree, count_node, U256(row_length))
+        chunk = log_index._row_chunks.get((map_index, row_index))
+        if chunk is not None:
+            chunk_node = prog_list_chunk_gti(map_row_root, row_length // 8)
+            btree_set(log_index.tree, chunk_node, chunk)
+    log_index._row_lengths.clear()
+    log_index._row_chunks.clear()
 
 
 def add_log_entry(log_index: LogIndexState, log: Log) -> None:
@@ -326,7 +1197,7 @@ def add_log_entry(log_index: LogIndexState, log: Log) -> None:
         chunk_data = U256.from_le_bytes(log.data[i * 32 : (i + 1) * 32])
         btree_set(log_index.tree, chunk_node, chunk_data)
     count_node = gti_merge(data_root, GTI_LIST_COUNT)
-    btree_set(log_index.tree, log_index, count_node, U256(len(log.data)))
+    btree_set(log_index.tree, count_node, U256(len(log.data)))
 
 
 def add_entry_meta(
@@ -365,6 +1236,83 @@ def get_row_index(
     return Uint.from_le_bytes(row_hash[0:4]) % MAP_HEIGHT
 
 
+def get_row_indices(
+    map_value_indices: Sequence[Uint],
+    layer_index: Uint,
+    map_value_hashes: Sequence[Hash32],
+) -> List[Uint]:
+    """
+    Returns the row indices of a batch of map values on the given mapping
+    layer, each placed on the map of its own map value index. Equivalent to
+    calling get_row_index for each map value.
+
+    Note that the map and layer dependent suffix of the hash input is only
+    encoded once for each map that appears in the batch.
+    """
+    mf_index = min(layer_index, len(LOG2_MAPPING_FREQUENCY) - 1)
+    mapping_frequency = Uint(1) << LOG2_MAPPING_FREQUENCY[mf_index]
+    layer_suffix = layer_index.to_le_bytes4()
+    suffixes: Dict[Uint, bytes] = {}
+    rows = []
+    for map_value_index, map_value_hash in zip(
+        map_value_indices, map_value_hashes
+    ):
+        map_index = map_value_index // VALUES_PER_MAP
+        suffix = suffixes.get(map_index)
+        if suffix is None:
+            masked_map_index = map_index - (map_index % mapping_frequency)
+            suffix = masked_map_index.to_le_bytes4() + layer_suffix
+            suffixes[map_index] = suffix
+        row_hash = sha256(map_value_hash + suffix).digest()
+        rows.append(Uint.from_le_bytes(row_hash[0:4]) % MAP_HEIGHT)
+    return rows
+
+
+def get_column_indices(
+    map_value_indices: Sequence[Uint], map_value_hashes: Sequence[Hash32]
+) -> List[Uint]:
+    """
+    Returns the column indices of a batch of map values. Equivalent to calling
+    get_column_index for each map value.
+
+    Note that if NumPy is available then the FNV-1a hashes of the entire batch
+    are calculated in parallel with uint64 array arithmetic, processing one
+    byte position of every input in each step.
+    """
+    if np is None or len(map_value_indices) == 0:
+        return [
+            get_column_index(map_value_index, map_value_hash)
+            for map_value_index, map_value_hash in zip(
+                map_value_indices, map_value_hashes
+            )
+        ]
+    data = np.frombuffer(
+        b"".join(
+            map_value_index.to_le_bytes8() + map_value_hash
+            for map_value_index, map_value_hash in zip(
+                map_value_indices, map_value_hashes
+            )
+        ),
+        dtype=np.uint8,
+    ).reshape(len(map_value_indices), 40)
+    fnv_prime = np.uint64(0x100000001B3)
+    hash_val = np.full(
+        len(map_value_indices), 0xCBF29CE484222325, dtype=np.uint64
+    )
+    for byte_column in data.T:
+        hash_val ^= byte_column
+        hash_val *= fnv_prime  # wraps around modulo 2**64
+    folded_hash = (hash_val >> np.uint64(32)) ^ (
+        hash_val & np.uint64(0xFFFFFFFF)
+    )
+    hash_bits = LOG2_MAP_WIDTH - LOG2_VALUES_PER_MAP
+    high_bits = (folded_hash >> np.uint64(32 - hash_bits)).tolist()
+    return [
+        ((map_value_index % VALUES_PER_MAP) << hash_bits) + Uint(high)
+        for map_value_index, high in zip(map_value_indices, high_bits)
+    ]
+
+
 def get_column_index(map_value_index: Uint, map_value_hash: Hash32) -> Uint:
     """
     Returns the column index where the given entry hash is mapped at the given
@@ -373,13 +1321,31 @@ def get_column_index(map_value_index: Uint, map_value_hash: Hash32) -> Uint:
     col_hash = _fnv1a_64(map_value_index.to_le_bytes8() + map_value_hash)
     folded_hash = (col_hash >> 32) ^ (col_hash & 0xFFFFFFFF)
     hash_bits = LOG2_MAP_WIDTH - LOG2_VALUES_PER_MAP
-    return (
-        (map_value_index % VALUES_PER_MAP)
-        << hash_bits + folded_hash
-        >> (32 - hash_bits)
+    return ((map_value_index % VALUES_PER_MAP) << hash_bits) + (
+        folded_hash >> (32 - hash_bits)
     )
 
 
+def get_map_value_index(map_index, column_index: Uint) -> Uint:
+    """
+    Returns the map value index that the given column index of the given
+    filter map belongs to.
+    """
+    map_value_width = MAP_WIDTH // VALUES_PER_MAP
+    return map_index * VALUES_PER_MAP + column_index // map_value_width
+
+
+def is_potential_match(
+    map_index, column_index: Uint, map_value_hash: Hash32
+) -> bool:
+    """
+    Returns True if the given column index of the given filter map might have
+    been added by the given map value hash.
+    """
+    map_value_index = get_map_value_index(map_index, column_index)
+    return get_column_index(map_value_index, map_value_hash) == column_index
+
+
 def _binary_hash(left, right: U256) -> U256:
     """
     Returns the SHA2 binary tree hash of two given descendants.
@@ -415,6 +1381,15 @@ def index_entry_gti(map_entry_index: Uint) -> U256:
     )
 
 
+def map_index_entries_gti(map_index: Uint) -> U256:
+    """
+    Returns the generalized tree index of the index entries vector subtree
+    belonging to the given filter map.
+    """
+    first_entry_root = index_entry_gti(map_index * VALUES_PER_MAP)
+    return first_entry_root >> LOG2_VALUES_PER_MAP
+
+
 def map_row_gti(map_index, row_index: Uint) -> U256:
     """
     Returns the generalized tree index of the root of the progressive list
@@ -422,28 +1397,43 @@ def map_row_gti(map_index, row_index: Uint) -> U256:
     """
     epoch_index = map_index // MAPS_PER_EPOCH
     map_sub_index = map_index % MAPS_PER_EPOCH
-    epoch_root = gti_vector(GTI_EPOCH_HISTORY, epoch_index, LOG2_EPOCH_HISTORY)
-    filter_maps_root = gti_merge(epoch_root, GTI_FILTER_MAPS)
     return gti_vector(
-        filter_maps_root,
+        filter_maps_gti(epoch_index),
         row_index * MAPS_PER_EPOCH + map_sub_index,
         LOG2_MAP_HEIGHT + LOG2_MAPS_PER_EPOCH,
     )
 
 
+def filter_maps_gti(epoch_index: Uint) -> U256:
+    """
+    Returns the generalized tree index of the root of the filter maps vector
+    of the given epoch.
+    """
+    epoch_root = gti_vector(GTI_EPOCH_HISTORY, epoch_index, LOG2_EPOCH_HISTORY)
+    return gti_merge(epoch_root, GTI_FILTER_MAPS)
+
+
 def prog_list_chunk_gti(list_root: U256, chunk_index: Uint) -> U256:
     """
     Returns the generalized tree index for the data chunk node with the given
     chunk index.
+
+    Note that the position of the chunk relative to the list root only
+    depends on the chunk index and is memoized.
     """
-    gti = gti_merge(list_root, GTI_LIST_TREE)
-    height = PROG_LIST_HEIGHT_FIRST
-    while chunk_index >= Uint(1) << height:
-        chunk_index -= Uint(1) << height
-        gti = gti_merge(gti, GTI_PROG_LIST_NEXT_TREE)
-        height += PROG_LIST_HEIGHT_STEP
-    subtree_root = gti_merge(gti, GTI_PROG_LIST_SUBTREE)
-    return gti_vector(subtree_root, chunk_index, height)
+    sub_index = _prog_list_chunk_sub_indices.get(chunk_index)
+    if sub_index is None:
+        gti = GTI_LIST_TREE
+        height = PROG_LIST_HEIGHT_FIRST
+        vector_index = chunk_index
+        while vector_index >= Uint(1) << height:
+            vector_index -= Uint(1) << height
+            gti = gti_merge(gti, GTI_PROG_LIST_NEXT_TREE)
+            height += PROG_LIST_HEIGHT_STEP
+        subtree_root = gti_merge(gti, GTI_PROG_LIST_SUBTREE)
+        sub_index = gti_vector(subtree_root, vector_index, height)
+        _prog_list_chunk_sub_indices[chunk_index] = sub_index
+    return gti_merge(list_root, sub_index)
 
 
 def _make_empty_vector_nodes(length: Uint) -> List[U256]:
@@ -466,6 +1456,133 @@ _empty_log_index_root = _binary_hash(
 )
 
 
+@dataclass
+class _EmptyNodeVector:
+    """
+    Template of a vector (or vector subtree) region of the log index tree with
+    depth levels. Empty node values of the region only depend on the relative
+    height; nodes below the vector items are resolved by the item template.
+    Items without a template are leaves that cannot be expanded.
+    """
+
+    depth: Uint
+    item: Optional["_EmptyNodeTemplate"]
+
+
+@dataclass
+class _EmptyNodeContainer:
+    """
+    Template of a container region of the log index tree with depth levels.
+    Empty node values of the region are listed by relative generalized tree
+    index, excluding the container root which is defined by the parent
+    region. Nodes below the fields are resolved by the field templates.
+    Fields without a template are leaves that cannot be expanded.
+    """
+
+    depth: Uint
+    nodes: Dict[U256, U256]
+    fields: Dict[U256, "_EmptyNodeTemplate"]
+
+
+_EmptyNodeTemplate = Union[_EmptyNodeVector, _EmptyNodeContainer]
+
+
+def _make_prog_list_tree_template(level: Uint) -> _EmptyNodeContainer:
+    """
+    Builds the template of the given tree level of a progressive list (and
+    all levels after it), relative to the level root.
+    """
+    max_height = PROG_LIST_HEIGHT_FIRST + PROG_LIST_HEIGHT_STEP * level
+    next_level = None
+    if max_height + PROG_LIST_HEIGHT_STEP < 256:
+        next_level = _make_prog_list_tree_template(level + 1)
+    return _EmptyNodeContainer(
+        depth=Uint(1),
+        nodes={
+            GTI_PROG_LIST_SUBTREE: _empty_vector_nodes[max_height],
+            GTI_PROG_LIST_NEXT_TREE: U256(0),
+        },
+        fields={
+            GTI_PROG_LIST_SUBTREE: _EmptyNodeVector(max_height, None),
+            GTI_PROG_LIST_NEXT_TREE: next_level,
+        },
+    )
+
+
+def _make_log_index_template() -> _EmptyNodeContainer:
+    """
+    Builds the structural template of the entire log index tree that
+    log_index_empty_node resolves empty node values from.
+    """
+    prog_list = _EmptyNodeContainer(
+        depth=Uint(1),
+        nodes={GTI_LIST_TREE: U256(0), GTI_LIST_COUNT: U256(0)},
+        fields={GTI_LIST_TREE: _make_prog_list_tree_template(Uint(0))},
+    )
+    log_topics_list = _EmptyNodeContainer(
+        depth=Uint(1),
+        nodes={
+            GTI_LIST_TREE: _empty_vector_nodes[2],
+            GTI_LIST_COUNT: U256(0),
+        },
+        fields={GTI_LIST_TREE: _EmptyNodeVector(Uint(2), None)},
+    )
+    log_entry = _EmptyNodeContainer(
+        depth=Uint(2),
+        nodes={
+            U256(2): _empty_vector_nodes[1],
+            U256(3): _empty_vector_nodes[1],
+            GTI_LOG_ADDRESS: U256(0),
+            GTI_LOG_TOPICS: U256(0),
+            GTI_LOG_DATA: U256(0),
+            U256(7): U256(0),
+        },
+        fields={GTI_LOG_TOPICS: log_topics_list, GTI_LOG_DATA: prog_list},
+    )
+    index_entry = _EmptyNodeContainer(
+        depth=Uint(1),
+        nodes={
+            GTI_LOG_ENTRY: U256(0),
+            GTI_ENTRY_META: _empty_vector_nodes[2],
+        },
+        fields={
+            GTI_LOG_ENTRY: log_entry,
+            # meta fields (log/block/tx, always 4 fields)
+            GTI_ENTRY_META: _EmptyNodeVector(Uint(2), None),
+        },
+    )
+    filter_maps_height = LOG2_MAP_HEIGHT + LOG2_MAPS_PER_EPOCH
+    index_entries_height = LOG2_MAPS_PER_EPOCH + LOG2_VALUES_PER_MAP
+    epoch_tree = _EmptyNodeContainer(
+        depth=Uint(1),
+        nodes={
+            GTI_FILTER_MAPS: _empty_vector_nodes[filter_maps_height],
+            GTI_INDEX_ENTRIES: _empty_vector_nodes[index_entries_height],
+        },
+        fields={
+            GTI_FILTER_MAPS: _EmptyNodeVector(filter_maps_height, prog_list),
+            GTI_INDEX_ENTRIES: _EmptyNodeVector(
+                index_entries_height, index_entry
+            ),
+        },
+    )
+    return _EmptyNodeContainer(
+        depth=Uint(1),
+        nodes={
+            GTI_EPOCH_HISTORY: _empty_vector_nodes[LOG2_EPOCH_HISTORY],
+            GTI_NEXT_ENTRY: U256(0),
+        },
+        fields={
+            GTI_EPOCH_HISTORY: _EmptyNodeVector(
+                LOG2_EPOCH_HISTORY, epoch_tree
+            ),
+        },
+    )
+
+
+_log_index_template = _make_log_index_template()
+
+
 def log_index_empty_node(index: U256) -> U256:
     """
     Returns the default empty node value of the log index tree at the given
@@ -473,8 +1590,12 @@ def log_index_empty_node(index: U256) -> U256:
     initializing an empty tree and expanding previously untouched regions of
     the tree.
 
+    The value is resolved from a precompiled structural template of the tree,
+    consuming the bits of the generalized tree index one region at a time.
+    Inside vector regions the value only depends on the relative height.
+
     Note that certain containers have a default zero value until expanded.
-    This function returns the zero value for the root index of each of these
+    The template returns the zero value for the root index of each of these
     structures. For descendants of the container root it returns the
     appropriate node values of the expanded container.
 
@@ -487,155 +1608,129 @@ def log_index_empty_node(index: U256) -> U256:
     """
     if index == GTI_ROOT:
         return _empty_log_index_root
-    side = gti_split_below(index, 1)
-    index = gti_split_above(index, 1)
-    height = gti_height(index)
-    if side == GTI_EPOCH_HISTORY:
-        if height <= LOG2_EPOCH_HISTORY:
-            return _empty_vector_nodes[LOG2_EPOCH_HISTORY - height]
-        index = gti_split_above(index, LOG2_EPOCH_HISTORY)
-        return epoch_tree_empty_node(index)
-    if side == GTI_NEXT_ENTRY:
-        if height != 0:
-            raise AssertionError("Invalid log index tree node")
-        return U256(0)
-    raise AssertionError("Invalid log index tree node")
-
-
-def epoch_tree_empty_node(index: U256) -> U256:
-    """
-    Returns the default empty node value of a single epoch tree at the given
-    generalized tree index (relative to the epoch root).
-
-    Note that the node values returned apply to an expanded container.
-    Non-expanded epoch trees have a zero default value at their root and
-    therefore this function should not be called with index == GTI_ROOT.
-    """
-    side = gti_split_below(index, 1)
-    index = gti_split_above(index, 1)
     height = gti_height(index)
-    if side == GTI_FILTER_MAPS:
-        tree_height = LOG2_MAP_HEIGHT + LOG2_MAPS_PER_EPOCH
-        if height <= tree_height:
-            return _empty_vector_nodes[tree_height - height]
-        index = gti_split_above(index, tree_height)
-        return prog_list_empty_node(index)
-    if side == GTI_INDEX_ENTRIES:
-        tree_height = LOG2_MAPS_PER_EPOCH + LOG2_VALUES_PER_MAP
-        if height <= tree_height:
-            return _empty_vector_nodes[tree_height - height]
-        index = gti_split_above(index, tree_height)
-        return index_entry_empty_node(index)
+    base_height = Uint(0)
+    region: Optional[_EmptyNodeTemplate] = _log_index_template
+    while region is not None:
+        relative_height = height - base_height
+        if isinstance(region, _EmptyNodeVector):
+            if relative_height <= region.depth:
+                return _empty_vector_nodes[region.depth - relative_height]
+            next_region = region.item
+        else:
+            relative_index = gti_split_above(index, base_height)
+            if relative_height <= region.depth:
+                if relative_index not in region.nodes:
+                    break
+                return region.nodes[relative_index]
+            field_index = gti_split_below(relative_index, region.depth)
+            next_region = region.fields.get(field_index)
+        base_height += region.depth
+        region = next_region
     raise AssertionError("Invalid log index tree node")
 
 
-def prog_list_empty_node(index: U256) -> U256:
+def log_index_state_empty_node(
+    log_index: LogIndexState, index: U256
+) -> U256:
     """
-    Returns the default empty node value of a progressive list at the given
-    generalized tree index (relative to the list root).
-
-    Note that the node values returned apply to an expanded list.
-    Non-expanded progressive lists have a zero default value at their root and
-    therefore this function should not be called with index == GTI_ROOT.
-    """
-    side = gti_split_below(index, 1)
-    index = gti_split_above(index, 1)
-    height = gti_height(index)
-    if side == GTI_LIST_TREE:
-        if height == 0:
-            return U256(0)
-        return prog_list_tree_empty_node(0, index)
-    if side == GTI_LIST_COUNT:
-        if height != 0:
-            raise AssertionError("Invalid log index tree node")
-        return U256(0)
-    raise AssertionError("Invalid log index tree node")
-
-
-def prog_list_tree_empty_node(level: Uint, index: U256) -> U256:
+    Returns the empty node value of the log index tree at the given
+    generalized tree index, taking into account which filter maps have been
+    initialized. This is the empty_node function of the tree of a log index
+    state.
+
+    Note that the rows of initialized maps are empty lists while the rows of
+    maps not initialized yet have a zero value, so the empty values of the
+    filter maps subtree depend on the state. Expanded nodes whose value may
+    still change are collected so that initialize_map can update them.
     """
-    Returns the default empty node value of a single tree level of a
-    progressive list at the given generalized tree index (relative to the list
-    tree root).
-    """
-    side = gti_split_below(index, 1)
-    index = gti_split_above(index, 1)
-    height = gti_height(index)
-    if side == GTI_PROG_LIST_SUBTREE:
-        max_height = PROG_LIST_HEIGHT_FIRST + PROG_LIST_HEIGHT_STEP * level
-        if height <= max_height:
-            return _empty_vector_nodes[max_height - height]
-        raise AssertionError("Invalid log index tree node")
-    if side == GTI_PROG_LIST_NEXT_TREE:
-        if height == 0:
-            return U256(0)
-        return prog_list_tree_empty_node(level + 1, index)
-    raise AssertionError("Invalid log index tree node")
+    position = _filter_maps_node_position(index)
+    if position is None:
+        return log_index_empty_node(index)
+    initialized, full = _initialized_map_count(
+        log_index.initialized_maps, *position
+    )
+    if initialized < full and index not in log_index._map_dependent_nodes:
+        log_index._map_dependent_nodes.add(index)
+        if log_index._journal is not None:
+            log_index._journal.append((index, True))
+    return _filter_maps_empty_node(position[1], initialized)
 
 
-def index_entry_empty_node(index: U256) -> U256:
+def _filter_maps_node_position(
+    index: U256,
+) -> Optional[Tuple[Uint, Uint, Uint]]:
     """
-    Returns the default empty node value of a single index entry at the given
-    generalized tree index (relative to the index entry root).
-
-    Note that the node values returned apply to an expanded container.
-    Non-expanded index entries have a zero default value at their root and
-    therefore this function should not be called with index == GTI_ROOT.
+    Returns the epoch index, the height above the row roots and the position
+    within its level of a node of a filter maps vector (from the row roots up
+    to the vector root) or None if the node is not part of one.
     """
-    side = gti_split_below(index, 1)
-    index = gti_split_above(index, 1)
     height = gti_height(index)
-    if side == GTI_LOG_ENTRY:
-        if height == 0:
-            return U256(0)
-        return log_entry_empty_node(index)
-    if side == GTI_ENTRY_META:  # meta fields (log/block/tx, always 4 fields)
-        if height > 2:
-            raise AssertionError("Invalid log index tree node")
-        return _empty_vector_nodes[2 - height]
-    raise AssertionError("Invalid log index tree node")
-
-
-def log_entry_empty_node(index: U256) -> U256:
+    if height < _filter_maps_root_height:
+        return None
+    depth = height - _filter_maps_root_height
+    if depth > _filter_maps_height:
+        return None
+    root = index >> depth
+    epoch_root = gti_split_below(
+        root, _filter_maps_root_height - gti_height(GTI_FILTER_MAPS)
+    )
+    if epoch_root >> LOG2_EPOCH_HISTORY != GTI_EPOCH_HISTORY:
+        return None
+    epoch_index = Uint(epoch_root - (GTI_EPOCH_HISTORY << LOG2_EPOCH_HISTORY))
+    if filter_maps_gti(epoch_index) != root:
+        return None
+    position = Uint(index - (root << depth))
+    return epoch_index, _filter_maps_height - depth, position
+
+
+def _initialized_map_count(
+    initialized_maps: Uint, epoch_index: Uint, height: Uint, position: Uint
+) -> Tuple[Uint, Uint]:
     """
-    Returns the default empty node value of a single log entry at the given
-    generalized tree index (relative to the epoch root).
-
-    Note that the node values returned apply to an expanded container.
-    Non-expanded log entries have a zero default value at their root and
-    therefore this function should not be called with index == GTI_ROOT.
+    Returns the number of initialized maps among the maps covered by the rows
+    below the given filter maps vector node, counted in each row, and the
+    number of maps covered.
     """
-    height = gti_height(index)
-    if height <= 2:
-        return _empty_vector_nodes[2 - height]
-    field = gti_split_below(index, 2)
-    sub_index = gti_split_above(index, 2)
-    if field == GTI_LOG_ADDRESS:
-        raise AssertionError("Invalid log index tree node")
-    if field == GTI_LOG_TOPICS:
-        return log_topics_list_empty_node(index)
-    if field == GTI_LOG_DATA:
-        return prog_list_empty_node(sub_index)
-    raise AssertionError("Invalid log index tree node")
-
-
-def log_topics_list_empty_node(index: U256) -> U256:
+    first_map = epoch_index * MAPS_PER_EPOCH
+    if height <= LOG2_MAPS_PER_EPOCH:
+        first_map += (position << height) % MAPS_PER_EPOCH
+        map_count = Uint(1) << height
+    else:
+        map_count = MAPS_PER_EPOCH
+    if initialized_maps <= first_map:
+        return Uint(0), map_count
+    return min(initialized_maps - first_map, map_count), map_count
+
+
+def _filter_maps_empty_node(height: Uint, initialized: Uint) -> U256:
     """
-    Returns the default empty node value of a single log topics list at the
-    given generalized tree index (relative to the topics field node).
-
-    Note that the node values returned apply to an expanded container.
-    Non-expanded lists have a zero default value at their root and
-    therefore this function should not be called with index == GTI_ROOT.
+    Returns the value of a filter maps vector node at the given height above
+    the row roots that has only empty rows below, the first given number of
+    maps being initialized in each row.
     """
-    side = gti_split_below(index, 1)
-    index = gti_split_above(index, 1)
-    height = gti_height(index)
-    if side == GTI_LIST_TREE:
-        if height > 2:
-            raise AssertionError("Invalid log index tree node")
-        return _empty_vector_nodes[2 - height]
-    if side == GTI_LIST_COUNT:
-        if height == 0:
-            return U256(0)
-    raise AssertionError("Invalid log index tree node")
+    key = (height, initialized)
+    if key not in _filter_maps_empty_nodes:
+        if initialized == 0:
+            value = _empty_vector_nodes[height]
+        elif height == 0:
+            value = _initialized_row_root
+        elif height > LOG2_MAPS_PER_EPOCH:
+            child = _filter_maps_empty_node(height - 1, initialized)
+            value = _binary_hash(child, child)
+        else:
+            left = min(initialized, Uint(1) << (height - 1))
+            value = _binary_hash(
+                _filter_maps_empty_node(height - 1, left),
+                _filter_maps_empty_node(height - 1, initialized - left),
+            )
+        _filter_maps_empty_nodes[key] = value
+    return _filter_maps_empty_nodes[key]
+
+
+_filter_maps_root_height = gti_height(filter_maps_gti(Uint(0)))
+_filter_maps_height = LOG2_MAP_HEIGHT + LOG2_MAPS_PER_EPOCH
+# empty progressive list: zero list tree root and zero count
+_initialized_row_root = _binary_hash(U256(0), U256(0))
+_filter_maps_empty_nodes: Dict[Tuple[Uint, Uint], U256] = {}
+_prog_list_chunk_sub_indices: Dict[Uint, U256] = {}
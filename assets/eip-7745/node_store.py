@@ -0,0 +1,242 @@
+"""
+Persistent Node Store.
+
+.. contents:: Table of Contents
+    :backlinks: none
+    :local:
+
+"""
+
+import mmap
+import os
+from dataclasses import dataclass, field
+from typing import BinaryIO, Dict, List, Optional, Tuple
+
+from ethereum_types.numeric import U256
+
+# block header: root index (32 bytes) + entry count (4 bytes)
+BLOCK_HEADER_SIZE = 36
+# block entry: node index (32 bytes) + value (32 bytes) + child block (8 bytes)
+BLOCK_ENTRY_SIZE = 72
+NO_CHILD_BLOCK = 0xFFFFFFFFFFFFFFFF
+
+
+@dataclass
+class NodeStore:
+    """
+    Append-only, memory-mapped file of collapsed BinaryTree subtrees.
+
+    Each collapse writes a single block containing every node that has been
+    removed from memory, sorted by generalized tree index. Nodes that were
+    collapsed subtree roots themselves point to the block of their own
+    subtree. Only the blocks of the topmost collapsed roots are kept in the
+    offset index so its size is bounded by the number of collapse roots
+    present in memory, not by the amount of history stored.
+
+    Once a checkpoint has been created, every change of the offset index is
+    recorded in an undo journal as the root index and its previous offset
+    (None if it was not in the index), see node_store_revert.
+    """
+
+    file: BinaryIO
+    size: int
+    _map: Optional[mmap.mmap] = None
+    _roots: Dict[U256, int] = field(default_factory=dict)
+    _journal: Optional[List[Tuple[U256, Optional[int]]]] = None
+    _journal_offset: int = 0
+
+
+def node_store_open(path: str) -> NodeStore:
+    """
+    Opens (or creates) a node store file and rebuilds the offset index of
+    collapsed subtree roots by scanning the block headers.
+    """
+    mode = "r+b" if os.path.exists(path) else "w+b"
+    file = open(path, mode)
+    store = NodeStore(file=file, size=os.path.getsize(path))
+    offset = 0
+    while offset < store.size:
+        root, count = _read_block_header(store, offset)
+        for position in range(count):
+            child = _read_block_entry(store, offset, position)[2]
+            if child != NO_CHILD_BLOCK:
+                store._roots.pop(_read_block_header(store, child)[0], None)
+        store._roots[root] = offset
+        offset += BLOCK_HEADER_SIZE + count * BLOCK_ENTRY_SIZE
+    return store
+
+
+def node_store_close(store: NodeStore) -> None:
+    """
+    Closes the underlying file of the node store.
+    """
+    if store._map is not None:
+        store._map.close()
+        store._map = None
+    store.file.close()
+
+
+def node_store_put_subtree(
+    store: NodeStore, root: U256, nodes: Dict[U256, U256]
+) -> None:
+    """
+    Appends a block containing the given nodes of a collapsed subtree
+    (including the subtree root) to the store.
+
+    Note that nodes which are roots of previously stored subtrees are linked
+    to their blocks and removed from the offset index, since they are now
+    reachable through the block of the new root.
+    """
+    entries = bytearray()
+    for index in sorted(nodes):
+        child = NO_CHILD_BLOCK
+        if index != root and index in store._roots:
+            child = store._roots.pop(index)
+            if store._journal is not None:
+                store._journal.append((index, child))
+        entries += index.to_le_bytes32()
+        entries += nodes[index].to_le_bytes32()
+        entries += child.to_bytes(8, "little")
+    store.file.seek(store.size)
+    store.file.write(root.to_le_bytes32())
+    store.file.write(len(nodes).to_bytes(4, "little"))
+    store.file.write(entries)
+    store.file.flush()
+    if store._journal is not None:
+        store._journal.append((root, store._roots.get(root)))
+    store._roots[root] = store.size
+    store.size += BLOCK_HEADER_SIZE + len(entries)
+
+
+def node_store_checkpoint(store: NodeStore) -> Tuple[int, int]:
+    """
+    Returns the current size of the store and the position of its undo
+    journal so that the blocks appended later can be removed with
+    node_store_revert. The first checkpoint starts the journal.
+    """
+    if store._journal is None:
+        store._journal = []
+    return store.size, store._journal_offset + len(store._journal)
+
+
+def node_store_revert(store: NodeStore, checkpoint: Tuple[int, int]) -> None:
+    """
+    Truncates the store to the size it had at the given checkpoint and
+    restores its offset index by undoing the journaled changes in reverse
+    order.
+    """
+    size, position = checkpoint
+    position -= store._journal_offset
+    if store._journal is None or position < 0:
+        raise AssertionError("Checkpoint has been finalized")
+    while len(store._journal) > position:
+        root, offset = store._journal.pop()
+        if offset is not None:
+            store._roots[root] = offset
+        else:
+            store._roots.pop(root, None)
+    if store._map is not None:
+        store._map.close()
+        store._map = None
+    store.file.truncate(size)
+    store.size = size
+
+
+def node_store_finalize(store: NodeStore, checkpoint: Tuple[int, int]) -> None:
+    """
+    Discards the journaled changes made before the given checkpoint.
+    """
+    position = checkpoint[1] - store._journal_offset
+    if store._journal is not None and position > 0:
+        del store._journal[:position]
+        store._journal_offset = checkpoint[1]
+
+
+def node_store_get(store: NodeStore, index: U256) -> Optional[U256]:
+    """
+    Returns the value of a collapsed node from the store or None if the node
+    is not stored.
+    """
+    ancestors: List[U256] = []
+    node = index
+    while node not in store._roots:
+        if node <= 1:
+            return None
+        ancestors.append(node)
+        node //= 2
+    offset = store._roots[node]
+    ancestors.append(node)
+    while True:
+        # search for the deepest ancestor (or the node itself) in the block
+        for candidate in ancestors:
+            entry = _find_block_entry(store, offset, candidate)
+            if entry is not None:
+                break
+        else:
+            return None
+        value, child = entry
+        if candidate == index:
+            return value
+        if child == NO_CHILD_BLOCK:
+            return None
+        offset = child
+        ancestors = ancestors[: ancestors.index(candidate)]
+
+
+def _find_block_entry(
+    store: NodeStore, offset: int, index: U256
+) -> Optional[Tuple[U256, int]]:
+    """
+    Binary searches the block at the given offset for a node and returns its
+    value and child block offset.
+    """
+    low, high = 0, _read_block_header(store, offset)[1]
+    while low < high:
+        middle = (low + high) // 2
+        node, value, child = _read_block_entry(store, offset, middle)
+        if node == index:
+            return value, child
+        if node < index:
+            low = middle + 1
+        else:
+            high = middle
+    return None
+
+
+def _read_block_header(store: NodeStore, offset: int) -> Tuple[U256, int]:
+    """
+    Reads the root index and entry count of the block at the given offset.
+    """
+    data = _read(store, offset, BLOCK_HEADER_SIZE)
+    count = int.from_bytes(data[32:36], "little")
+    return U256.from_le_bytes(data[0:32]), count
+
+
+def _read_block_entry(
+    store: NodeStore, offset: int, position: int
+) -> Tuple[U256, U256, int]:
+    """
+    Reads the node index, value and child block offset of the given entry of
+    the block at the given offset.
+    """
+    start = offset + BLOCK_HEADER_SIZE + position * BLOCK_ENTRY_SIZE
+    data = _read(store, start, BLOCK_ENTRY_SIZE)
+    return (
+        U256.from_le_bytes(data[0:32]),
+        U256.from_le_bytes(data[32:64]),
+        int.from_bytes(data[64:72], "little"),
+    )
+
+
+def _read(store: NodeStore, offset: int, length: int) -> bytes:
+    """
+    Reads from the memory-mapped file, remapping it if it has grown since it
+    was last mapped.
+    """
+    if store._map is None or len(store._map) < store.size:
+        if store._map is not None:
+            store._map.close()
+        store._map = mmap.mmap(
+            store.file.fileno(), store.size, access=mmap.ACCESS_READ
+        )
+    return store._map[offset : offset + length]
@@ -0,0 +1,300 @@
+"""
+Tests for the BinaryTree (binary_tree.py) and its node storage backends.
+
+The generalized tree index helpers are compared with straightforward bit by
+bit definitions on random inputs and the root of a tree updated by plain
+btree_set calls is compared with the level by level merkleization of all of
+its leaves. Every other tree update strategy (checkpoints, dense node
+storage, collapsing into a node store) is compared with such a plain tree.
+
+The modules use relative imports, like in the execution-specs fork that they
+are taken from, so the tests run inside a package of that fork. Copy the
+assets/eip-7745 directory into the fork package next to the base_types,
+blocks and fork_types modules and run ``python -m pytest`` on the copied
+test files.
+"""
+import random
+from hashlib import sha256
+from typing import Dict
+
+import pytest
+from ethereum_types.numeric import U256, Uint
+
+from . import binary_tree
+from .binary_tree import (
+    GTI_ROOT,
+    BinaryTree,
+    DenseNodeStore,
+    btree_checkpoint,
+    btree_collapse,
+    btree_finalize,
+    btree_get,
+    btree_prove,
+    btree_read,
+    btree_revert,
+    btree_set,
+    btree_verify_multiproof,
+    dense_store_add_subtree,
+    gti_height,
+    gti_merge,
+    gti_split_above,
+    gti_split_below,
+    gti_vector,
+)
+from .node_store import node_store_close, node_store_open
+
+TREE_HEIGHT = 10
+
+
+def binary_hash(left: U256, right: U256) -> U256:
+    """
+    SHA-256 of the concatenated little endian child values.
+    """
+    data = left.to_le_bytes32() + right.to_le_bytes32()
+    return U256.from_le_bytes(sha256(data).digest())
+
+
+def empty_node(index: U256) -> U256:
+    """
+    Empty node values of a tree of zero leaves at height TREE_HEIGHT.
+    """
+    value = U256(0)
+    for _ in range(TREE_HEIGHT - gti_height(index)):
+        value = binary_hash(value, value)
+    return value
+
+
+def new_tree() -> BinaryTree:
+    """
+    Returns an empty tree of height TREE_HEIGHT.
+    """
+    return BinaryTree(binary_hash=binary_hash, empty_node=empty_node)
+
+
+def random_leaf(rng: random.Random) -> U256:
+    """
+    Returns the generalized tree index of a random leaf.
+    """
+    return U256((1 << TREE_HEIGHT) + rng.randrange(1 << TREE_HEIGHT))
+
+
+def reference_height(index: int) -> int:
+    """
+    Counts the steps from a node up to the root.
+    """
+    height = 0
+    while index > 1:
+        index //= 2
+        height += 1
+    return height
+
+
+def reference_vector(root: int, index: int, height: int) -> int:
+    """
+    Walks down from the vector root along the bits of the item index.
+    """
+    for bit in reversed(range(height)):
+        root = root * 2 + (index >> bit) % 2
+    return root
+
+
+def reference_merge(index: int, sub_index: int) -> int:
+    """
+    Walks down from the given node along the path of the relative index.
+    """
+    height = reference_height(sub_index)
+    return reference_vector(index, sub_index - (1 << height), height)
+
+
+def reference_split_below(index: int, level: int) -> int:
+    """
+    Walks up from the given node to the given height.
+    """
+    while reference_height(index) > level:
+        index //= 2
+    return index
+
+
+def reference_split_above(index: int, level: int) -> int:
+    """
+    Collects the path from the given height down to the given node.
+    """
+    bits = []
+    while reference_height(index) > level:
+        bits.append(index % 2)
+        index //= 2
+    sub_index = 1
+    for bit in reversed(bits):
+        sub_index = sub_index * 2 + bit
+    return sub_index
+
+
+def test_gti_helpers() -> None:
+    rng = random.Random(7745)
+    for _ in range(2000):
+        index = rng.getrandbits(rng.randrange(1, 120)) | 1
+        height = rng.randrange(0, 60)
+        item = rng.getrandbits(height)
+        sub_height = rng.randrange(0, 60)
+        sub_index = (1 << sub_height) | rng.getrandbits(sub_height)
+        level = rng.randrange(0, 130)
+        assert gti_height(U256(index)) == reference_height(index)
+        assert gti_vector(U256(index), U256(item), Uint(height)) == (
+            reference_vector(index, item, height)
+        )
+        assert gti_merge(U256(index), U256(sub_index)) == (
+            reference_merge(index, sub_index)
+        )
+        assert gti_split_below(U256(index), Uint(level)) == (
+            reference_split_below(index, level)
+        )
+        assert gti_split_above(U256(index), Uint(level)) == (
+            reference_split_above(index, level)
+        )
+
+
+def reference_root(leaves: Dict[U256, U256]) -> U256:
+    """
+    Merkleizes the list of all 2 ** TREE_HEIGHT leaf values level by level,
+    unset leaves being zero.
+    """
+    first_leaf = 1 << TREE_HEIGHT
+    level = [
+        leaves.get(U256(first_leaf + position), U256(0))
+        for position in range(first_leaf)
+    ]
+    while len(level) > 1:
+        level = [
+            binary_hash(level[position], level[position + 1])
+            for position in range(0, len(level), 2)
+        ]
+    return level[0]
+
+
+def test_root_matches_reference() -> None:
+    rng = random.Random(1)
+    tree = new_tree()
+    leaves: Dict[U256, U256] = {}
+    for _ in range(10):
+        for _ in range(rng.randrange(1, 30)):
+            leaf, value = random_leaf(rng), U256(rng.getrandbits(256))
+            leaves[leaf] = value
+            btree_set(tree, leaf, value)
+        assert btree_get(tree, GTI_ROOT) == reference_root(leaves)
+
+
+def test_dense_node_store(monkeypatch: pytest.MonkeyPatch) -> None:
+    # small pages so that pages are allocated and released during the test
+    monkeypatch.setattr(binary_tree, "DENSE_PAGE_SIZE", 4)
+    rng = random.Random(4)
+    for _ in range(5):
+        plain = new_tree()
+        dense = BinaryTree(
+            binary_hash=binary_hash,
+            empty_node=empty_node,
+            _data=DenseNodeStore(),
+        )
+        dense_store_add_subtree(dense._data, U256(5), Uint(TREE_HEIGHT - 2))
+        dense_store_add_subtree(dense._data, U256(24), Uint(4))
+        for _ in range(200):
+            leaf, value = random_leaf(rng), U256(rng.getrandbits(256))
+            btree_set(plain, leaf, value)
+            btree_set(dense, leaf, value)
+        assert btree_get(dense, GTI_ROOT) == btree_get(plain, GTI_ROOT)
+        assert dict(dense._data) == dict(plain._data)
+        btree_collapse(plain, U256(5))
+        btree_collapse(dense, U256(5))
+        assert dict(dense._data) == dict(plain._data)
+        assert U256(5) not in dense._data._subtrees
+
+
+def test_collapse_into_node_store(tmp_path) -> None:
+    rng = random.Random(5)
+    plain = new_tree()
+    stored = new_tree()
+    stored.node_store = node_store_open(str(tmp_path / "nodes.bin"))
+    leaves = {}
+    for _ in range(100):
+        leaf, value = random_leaf(rng), U256(rng.getrandbits(256))
+        leaves[leaf] = value
+        btree_set(plain, leaf, value)
+        btree_set(stored, leaf, value)
+    for index in (U256(4), U256(5), U256(3)):
+        btree_collapse(stored, index)
+    assert btree_get(stored, GTI_ROOT) == btree_get(plain, GTI_ROOT)
+    for leaf, value in leaves.items():
+        assert btree_read(stored, leaf) == value
+    node_store_close(stored.node_store)
+
+
+def test_multiproof() -> None:
+    rng = random.Random(3)
+    tree = new_tree()
+    leaves = {}
+    for _ in range(50):
+        leaf, value = random_leaf(rng), U256(rng.getrandbits(256))
+        leaves[leaf] = value
+        btree_set(tree, leaf, value)
+    root = btree_get(tree, GTI_ROOT)
+    nodes = dict(rng.sample(sorted(leaves.items()), 5))
+    proof = btree_prove(tree, list(nodes))
+    assert btree_verify_multiproof(binary_hash, root, nodes, proof)
+    assert not btree_verify_multiproof(binary_hash, root, nodes, proof[1:])
+    tampered = dict(nodes)
+    index = next(iter(tampered))
+    tampered[index] = U256(tampered[index] ^ 1)
+    assert not btree_verify_multiproof(binary_hash, root, tampered, proof)
+
+
+def test_read_invalidated() -> None:
+    rng = random.Random(6)
+    tree = new_tree()
+    reference = new_tree()
+    for _ in range(30):
+        leaf, value = random_leaf(rng), U256(rng.getrandbits(256))
+        btree_set(tree, leaf, value)
+        btree_set(reference, leaf, value)
+    btree_get(reference, GTI_ROOT)
+    # both children of the invalidated nodes near the root are invalidated
+    indices = [U256(5), U256(3), U256(2), GTI_ROOT]
+    assert not any(index in tree._data for index in indices + [U256(4)])
+    for index in indices:
+        assert btree_read(tree, index) == btree_get(reference, index)
+    assert btree_read(new_tree(), U256(2)) is None
+
+
+def test_multiproof_nested() -> None:
+    rng = random.Random(7)
+    tree = new_tree()
+    for _ in range(50):
+        btree_set(tree, random_leaf(rng), U256(rng.getrandbits(256)))
+    root = btree_get(tree, GTI_ROOT)
+    # node 9 is a descendant of the also proven node 2
+    for indices in ([U256(2), U256(9)], [U256(4), U256(9), U256(37)]):
+        nodes = {index: btree_get(tree, index) for index in indices}
+        proof = btree_prove(tree, indices)
+        assert btree_verify_multiproof(binary_hash, root, nodes, proof)
+        for index in indices:
+            tampered = dict(nodes)
+            tampered[index] = U256(tampered[index] ^ 1)
+            assert not btree_verify_multiproof(
+                binary_hash, root, tampered, proof
+            )
+
+
+def test_checkpoint_revert() -> None:
+    rng = random.Random(2)
+    tree = new_tree()
+    checkpoints, states = [], []
+    for _ in range(10):
+        checkpoints.append(btree_checkpoint(tree))
+        states.append(dict(tree._data))
+        for _ in range(rng.randrange(1, 20)):
+            btree_set(tree, random_leaf(rng), U256(rng.getrandbits(256)))
+        btree_get(tree, GTI_ROOT)
+    for position in (8, 5, 2):
+        btree_revert(tree, checkpoints[position])
+        assert dict(tree._data) == states[position]
+    btree_finalize(tree, checkpoints[1])
+    with pytest.raises(AssertionError):
+        btree_revert(tree, checkpoints[0])
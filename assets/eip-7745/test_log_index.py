@@ -0,0 +1,633 @@
+"""
+Tests for the log index (log_index.py).
+
+The log index parameters are reduced so that a short synthetic chain
+(see bench_log_index.py) fills several filter maps and crosses an epoch
+boundary. The root of the log index built block by block is compared with
+a reference root calculated from the whole chain the way the EIP defines
+the LogIndex container, merkleizing every vector, list and container in
+full. Every optimized code path is in turn compared with the log index
+built block by block: the resulting roots have to be equal.
+
+See test_binary_tree.py for running the tests.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import sha256
+from typing import Dict, List, Optional, Tuple
+
+import pytest
+from ethereum_rlp import rlp
+from ethereum_types.numeric import U256, Uint
+
+from ethereum.crypto.hash import Hash32, keccak256
+
+from . import log_index as log_index_module
+from .bench_log_index import synthetic_chain
+from .binary_tree import DenseNodeStore, dense_store_add_subtree
+from .blocks import Log
+from .log_index import (
+    LogIndexState,
+    filter_maps_gti,
+    get_column_index,
+    get_row_index,
+    log_index_add_block,
+    log_index_add_block_entry,
+    log_index_add_log_entries,
+    log_index_add_tx_entry,
+    log_index_backfill,
+    log_index_checkpoint,
+    log_index_defer_collapses,
+    log_index_enable_stats,
+    log_index_finalize,
+    log_index_prove,
+    log_index_query,
+    log_index_restore,
+    log_index_revert,
+    log_index_root,
+    log_index_root_parallel,
+    log_index_snapshot,
+    log_index_stats,
+    log_index_verify_proof,
+    map_index_entries_gti,
+    map_value_hash_address,
+    map_value_hash_block,
+    map_value_hash_topic,
+    map_value_hash_tx,
+)
+from .node_store import node_store_close, node_store_open
+
+SMALL_PARAMETERS = {
+    "LOG2_MAPS_PER_EPOCH": Uint(2),
+    "LOG2_VALUES_PER_MAP": Uint(6),
+    "LOG2_MAP_WIDTH": Uint(12),
+    "LOG2_MAP_HEIGHT": Uint(4),
+    "LOG2_MAPPING_FREQUENCY": [Uint(2), Uint(1), Uint(1), Uint(0)],
+}
+
+# 15 entries per block, 450 entries in total: seven filter maps of 64
+# entries, crossing the boundary of the first epoch of 4 maps
+CHAIN = dict(blocks=30, txs=2, logs=2, topics=2, data_size=40, addresses=8)
+
+
+@pytest.fixture(autouse=True)
+def small_parameters(monkeypatch: pytest.MonkeyPatch) -> None:
+    """
+    Reduces the log index parameters and recalculates the values derived
+    from them.
+    """
+    for name, value in SMALL_PARAMETERS.items():
+        monkeypatch.setattr(log_index_module, name, value)
+    derived = {
+        "MAPS_PER_EPOCH": Uint(1) << SMALL_PARAMETERS["LOG2_MAPS_PER_EPOCH"],
+        "VALUES_PER_MAP": Uint(1) << SMALL_PARAMETERS["LOG2_VALUES_PER_MAP"],
+        "MAP_HEIGHT": Uint(1) << SMALL_PARAMETERS["LOG2_MAP_HEIGHT"],
+        "MAP_WIDTH": Uint(1) << SMALL_PARAMETERS["LOG2_MAP_WIDTH"],
+        "_filter_maps_height": SMALL_PARAMETERS["LOG2_MAP_HEIGHT"]
+        + SMALL_PARAMETERS["LOG2_MAPS_PER_EPOCH"],
+        "PARALLEL_SPLIT_DEPTH": log_index_module.LOG2_EPOCH_HISTORY
+        + 2
+        + SMALL_PARAMETERS["LOG2_MAPS_PER_EPOCH"]
+        + log_index_module.LOG2_PARALLEL_SUBTREES,
+        "_filter_maps_empty_nodes": {},
+    }
+    for name, value in derived.items():
+        monkeypatch.setattr(log_index_module, name, value)
+    monkeypatch.setattr(
+        log_index_module,
+        "_log_index_template",
+        log_index_module._make_log_index_template(),
+    )
+
+
+def build(chain, log_index=None) -> LogIndexState:
+    """
+    Adds the blocks of the chain to a new (or the given) log index one by
+    one with log_index_add_block.
+    """
+    if log_index is None:
+        log_index = LogIndexState()
+    for header, transactions in chain:
+        log_index_add_block(log_index, header, transactions)
+    return log_index
+
+
+def reference_hash(left: U256, right: U256) -> U256:
+    """
+    SHA-256 of the concatenated little endian child values.
+    """
+    data = left.to_le_bytes32() + right.to_le_bytes32()
+    return U256.from_le_bytes(sha256(data).digest())
+
+
+def reference_vector_root(items: Dict[int, U256], height: int) -> U256:
+    """
+    Merkleizes a vector of 2 ** height items given by position, missing
+    items being zero.
+    """
+    zero = U256(0)
+    level = items
+    for _ in range(height):
+        parents = {}
+        for position in {position // 2 for position in level}:
+            left = level.get(position * 2, zero)
+            right = level.get(position * 2 + 1, zero)
+            parents[position] = reference_hash(left, right)
+        level = parents
+        zero = reference_hash(zero, zero)
+    return level.get(0, zero)
+
+
+def reference_prog_list_root(chunks: List[U256], length: int) -> U256:
+    """
+    Merkleizes a progressive list (EIP-7916) of the given chunks: the first
+    level holds one chunk and each further level four times as many.
+    """
+
+    def levels_root(chunks: List[U256], height: int) -> U256:
+        if not chunks:
+            return U256(0)
+        size = 1 << height
+        subtree = reference_vector_root(dict(enumerate(chunks[:size])), height)
+        return reference_hash(subtree, levels_root(chunks[size:], height + 2))
+
+    return reference_hash(levels_root(chunks, 0), U256(length))
+
+
+def reference_entry_root(log: Optional[Log], meta: Tuple) -> U256:
+    """
+    Merkleizes an initialized IndexEntry container; the log entry is zero
+    for transaction and block entries.
+    """
+    meta_root = reference_vector_root(
+        {position: U256(value) for position, value in enumerate(meta)}, 2
+    )
+    if log is None:
+        return reference_hash(U256(0), meta_root)
+    topics = {
+        position: U256(topic) for position, topic in enumerate(log.topics)
+    }
+    topics_root = reference_hash(
+        reference_vector_root(topics, 2), U256(len(log.topics))
+    )
+    data_chunks = [
+        U256.from_le_bytes(log.data[start : start + 32])
+        for start in range(0, len(log.data), 32)
+    ]
+    data_root = reference_prog_list_root(data_chunks, len(log.data))
+    log_root = reference_hash(
+        reference_hash(U256(log.address), topics_root),
+        reference_hash(data_root, U256(0)),
+    )
+    return reference_hash(log_root, meta_root)
+
+
+def reference_layout(
+    chain,
+) -> Tuple[
+    Dict[int, U256], List[Tuple[int, Hash32]], List[Tuple[int, int, Log]], int
+]:
+    """
+    Assigns map entry indices to the index entries of the chain. Returns the
+    index entry roots by map entry index, the (map value index, map value
+    hash) pair of every map value, the (map entry index, block number, log)
+    tuple of every log entry and the next entry index.
+    """
+    values_per_map = int(log_index_module.VALUES_PER_MAP)
+    entries: Dict[int, U256] = {}
+    values: List[Tuple[int, Hash32]] = []
+    log_entries: List[Tuple[int, int, Log]] = []
+    next_entry = 0
+
+    def add(hashes: List[Hash32], log: Optional[Log], meta: Tuple) -> None:
+        nonlocal next_entry
+        # the map values of an index entry never cross a map boundary
+        map_remaining = values_per_map - next_entry % values_per_map
+        if map_remaining < len(hashes):
+            next_entry += map_remaining
+        entries[next_entry] = reference_entry_root(log, meta)
+        if log is not None:
+            log_entries.append((next_entry, int(meta[0]), log))
+        for map_value_hash in hashes:
+            values.append((next_entry, map_value_hash))
+            next_entry += 1
+
+    for header, transactions in chain:
+        number = header.number
+        for tx_index, (tx_hash, receipt_hash, logs) in enumerate(transactions):
+            add(
+                [map_value_hash_tx(tx_hash)],
+                None,
+                (number, tx_hash, tx_index, receipt_hash),
+            )
+            for log_in_tx_index, log in enumerate(logs):
+                add(
+                    [map_value_hash_address(log.address)]
+                    + [map_value_hash_topic(topic) for topic in log.topics],
+                    log,
+                    (number, tx_hash, tx_index, log_in_tx_index),
+                )
+        block_hash = keccak256(rlp.encode(header))
+        add(
+            [map_value_hash_block(block_hash)],
+            None,
+            (number, block_hash, header.timestamp, 0),
+        )
+    return entries, values, log_entries, next_entry
+
+
+def reference_rows(
+    values: List[Tuple[int, Hash32]],
+) -> Dict[Tuple[int, int], List[int]]:
+    """
+    Places the map values on the filter maps, moving to the next mapping
+    layer whenever a row reaches the length limit of the current layer.
+    Returns the column indices of each used (map index, row index) row.
+    """
+    max_row_length = log_index_module.MAX_ROW_LENGTH
+    rows: Dict[Tuple[int, int], List[int]] = {}
+    for map_value_index, map_value_hash in values:
+        map_index = map_value_index // int(log_index_module.VALUES_PER_MAP)
+        layer_index = 0
+        while True:
+            row_index = get_row_index(
+                Uint(map_index), Uint(layer_index), map_value_hash
+            )
+            columns = rows.setdefault((map_index, int(row_index)), [])
+            limit = max_row_length[min(layer_index, len(max_row_length) - 1)]
+            if len(columns) < limit:
+                column_index = get_column_index(
+                    Uint(map_value_index), map_value_hash
+                )
+                columns.append(int(column_index))
+                break
+            layer_index += 1
+    return rows
+
+
+def reference_root(chain) -> U256:
+    """
+    Merkleizes the LogIndex container after adding the whole chain: epochs
+    and the rows of maps without entries are zero, rows of maps with entries
+    are progressive lists of 32 bit column indices packed into chunks.
+    """
+    log2_maps_per_epoch = int(log_index_module.LOG2_MAPS_PER_EPOCH)
+    log2_values_per_map = int(log_index_module.LOG2_VALUES_PER_MAP)
+    maps_per_epoch = 1 << log2_maps_per_epoch
+    values_per_map = 1 << log2_values_per_map
+    epoch_entries = maps_per_epoch * values_per_map
+    entries, values, _, next_entry = reference_layout(chain)
+    rows = reference_rows(values)
+    maps = -(-next_entry // values_per_map)
+    epochs: Dict[int, U256] = {}
+    for epoch_index in range(-(-maps // maps_per_epoch)):
+        filter_rows: Dict[int, U256] = {}
+        first_map = epoch_index * maps_per_epoch
+        last_map = min(maps, first_map + maps_per_epoch)
+        for map_index in range(first_map, last_map):
+            for row_index in range(int(log_index_module.MAP_HEIGHT)):
+                columns = rows.get((map_index, row_index), [])
+                chunks = [
+                    U256(
+                        sum(
+                            column << (32 * position)
+                            for position, column in enumerate(
+                                columns[start : start + 8]
+                            )
+                        )
+                    )
+                    for start in range(0, len(columns), 8)
+                ]
+                position = row_index * maps_per_epoch + map_index - first_map
+                filter_rows[position] = reference_prog_list_root(
+                    chunks, len(columns)
+                )
+        first_entry = epoch_index * epoch_entries
+        epoch_entries_roots = {
+            entry_index - first_entry: root
+            for entry_index, root in entries.items()
+            if first_entry <= entry_index < first_entry + epoch_entries
+        }
+        epochs[epoch_index] = reference_hash(
+            reference_vector_root(
+                filter_rows,
+                int(log_index_module.LOG2_MAP_HEIGHT) + log2_maps_per_epoch,
+            ),
+            reference_vector_root(
+                epoch_entries_roots, log2_maps_per_epoch + log2_values_per_map
+            ),
+        )
+    epochs_root = reference_vector_root(
+        epochs, int(log_index_module.LOG2_EPOCH_HISTORY)
+    )
+    return reference_hash(epochs_root, U256(next_entry))
+
+
+def test_root_matches_reference() -> None:
+    chain = list(synthetic_chain(**CHAIN))
+    log_index = LogIndexState()
+    for count, (header, transactions) in enumerate(chain, 1):
+        log_index_add_block(log_index, header, transactions)
+        if count % 3 == 0 or count == len(chain):
+            assert log_index_root(log_index) == reference_root(chain[:count])
+    epoch_entries = (
+        log_index_module.MAPS_PER_EPOCH * log_index_module.VALUES_PER_MAP
+    )
+    assert log_index.next_entry > epoch_entries
+
+
+class CountingExecutor(ThreadPoolExecutor):
+    """
+    Thread pool that counts the submitted tasks and the nodes hashed by them.
+    """
+
+    def __init__(self) -> None:
+        super().__init__(max_workers=2)
+        self.futures: List = []
+
+    def submit(self, *args, **kwargs):
+        future = super().submit(*args, **kwargs)
+        self.futures.append(future)
+        return future
+
+    def hashed(self) -> int:
+        return sum(len(future.result()) for future in self.futures)
+
+
+def hash_count(log_index: LogIndexState) -> int:
+    """
+    Returns the number of hashes counted by the log index stats.
+    """
+    stats = log_index_stats(log_index)
+    return sum(region.get("hash", 0) for region in stats.values())
+
+
+def test_root_parallel() -> None:
+    chain = list(synthetic_chain(**CHAIN))
+    log_index = build(chain)
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        root = log_index_root_parallel(log_index, executor)
+    assert root == log_index_root(build(chain))
+
+
+def test_root_parallel_deferred() -> None:
+    chain = list(synthetic_chain(**CHAIN))
+    plain = LogIndexState()
+    log_index = LogIndexState()
+    log_index_enable_stats(log_index)
+    log_index_defer_collapses(log_index, True)
+    for count, (header, transactions) in enumerate(chain, 1):
+        log_index_add_block(plain, header, transactions)
+        hashes = hash_count(log_index)
+        log_index_add_block(log_index, header, transactions)
+        # completed entries, rows and maps are not hashed when added
+        assert hash_count(log_index) == hashes
+        if count % 10 == 0:
+            with CountingExecutor() as executor:
+                root = log_index_root_parallel(log_index, executor)
+            assert len(executor.futures) > 1
+            # most of the hashing is done by the tasks
+            assert executor.hashed() * 2 > hash_count(log_index) - hashes
+            assert root == log_index_root(plain)
+            assert dict(log_index.tree._data) == dict(plain.tree._data)
+    assert root == reference_root(chain)
+
+
+def test_dense_node_store() -> None:
+    chain = list(synthetic_chain(**CHAIN))
+    log_index = LogIndexState()
+    store = DenseNodeStore()
+    log_index.tree._data = store
+    dense_store_add_subtree(
+        store,
+        map_index_entries_gti(Uint(0)),
+        SMALL_PARAMETERS["LOG2_VALUES_PER_MAP"],
+    )
+    dense_store_add_subtree(
+        store, filter_maps_gti(Uint(0)), SMALL_PARAMETERS["LOG2_MAP_HEIGHT"]
+    )
+    build(chain, log_index)
+    assert log_index_root(log_index) == log_index_root(build(chain))
+
+
+def test_add_block_matches_entries() -> None:
+    chain = list(synthetic_chain(**CHAIN))
+    by_block, by_entry = LogIndexState(), LogIndexState()
+    for header, transactions in chain:
+        log_index_add_block(by_block, header, transactions)
+        for tx_index, (tx_hash, receipt_hash, logs) in enumerate(
+            transactions
+        ):
+            log_index_add_tx_entry(
+                by_entry, header.number, tx_hash, receipt_hash, Uint(tx_index)
+            )
+            log_index_add_log_entries(
+                by_entry, header.number, tx_hash, Uint(tx_index), logs
+            )
+        log_index_add_block_entry(by_entry, header)
+        assert log_index_root(by_block) == log_index_root(by_entry)
+    epoch_entries = (
+        log_index_module.MAPS_PER_EPOCH * log_index_module.VALUES_PER_MAP
+    )
+    assert by_block.next_entry > epoch_entries
+    assert log_index_root(build(chain)) == log_index_root(by_block)
+
+
+def test_snapshot_restore() -> None:
+    chain = list(synthetic_chain(**CHAIN))
+    reference = build(chain)
+    for split in (1, 13, 25):
+        restored = log_index_restore(
+            log_index_snapshot(build(chain[:split]))
+        )
+        build(chain[split:], restored)
+        assert log_index_root(restored) == log_index_root(reference)
+
+
+class Interrupted(Exception):
+    """
+    Raised by the progress callback to interrupt a backfill.
+    """
+
+
+def test_backfill_resume() -> None:
+    chain = list(synthetic_chain(**CHAIN))
+    reports: List = []
+    log_index = LogIndexState()
+    progress = log_index_backfill(log_index, chain, report=reports.append)
+    assert len(reports) > 3 and reports[-1] == progress
+    assert progress.blocks == len(chain) and progress.blocks_per_second > 0
+    assert progress.next_entry == log_index.next_entry
+    assert log_index_root(log_index) == reference_root(chain)
+    # save the state at each report and interrupt the backfill at the third
+    saved: List = []
+
+    def interrupt(progress) -> None:
+        saved.append((log_index_snapshot(log_index), progress))
+        if len(saved) == 3:
+            raise Interrupted
+
+    log_index = LogIndexState()
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        with pytest.raises(Interrupted):
+            log_index_backfill(
+                log_index, chain, report=interrupt, executor=executor
+            )
+    snapshot, resume = saved[-1]
+    assert resume.next_block == reports[2].next_block
+    assert resume.next_entry == reports[2].next_entry
+    log_index = log_index_restore(snapshot)
+    progress = log_index_backfill(log_index, iter(chain), resume=resume)
+    # the chain starts at block 1
+    assert progress.blocks == len(chain) + 1 - resume.next_block
+    assert log_index_root(log_index) == reference_root(chain)
+    with pytest.raises(AssertionError):
+        log_index_backfill(LogIndexState(), chain, resume=resume)
+
+
+def test_prove(tmp_path) -> None:
+    chain = list(synthetic_chain(**CHAIN))
+    log_index = LogIndexState()
+    log_index.tree.node_store = node_store_open(str(tmp_path / "nodes.bin"))
+    collapsed_rows = []
+    for header, transactions in chain:
+        log_index_add_block(log_index, header, transactions)
+        if not collapsed_rows and Uint(0) in log_index._touched_rows:
+            collapsed_rows = [
+                (Uint(0), row) for row in log_index._touched_rows[Uint(0)]
+            ]
+    current_map = log_index.next_entry // log_index_module.VALUES_PER_MAP
+    rows = collapsed_rows[:3] + [
+        (current_map, row)
+        for row in sorted(log_index._touched_rows[current_map])[:3]
+    ]
+    entries = [Uint(0), Uint(300), log_index.next_entry - Uint(1)]
+    nodes, proof = log_index_prove(log_index, entries, rows)
+    root = log_index_root(log_index)
+    assert log_index_verify_proof(root, nodes, proof)
+    index = next(iter(nodes))
+    tampered = dict(nodes)
+    tampered[index] = U256(tampered[index] ^ 1)
+    assert not log_index_verify_proof(root, tampered, proof)
+    assert root == log_index_root(build(chain))
+    node_store_close(log_index.tree.node_store)
+
+
+def reference_query(
+    chain, from_block: int, to_block: int, address, topics
+) -> List[int]:
+    """
+    Scans every log of the chain and returns the map entry indices of the
+    log entries in the block range that match the query.
+    """
+    _, _, log_entries, _ = reference_layout(chain)
+    return [
+        entry_index
+        for entry_index, block_number, log in log_entries
+        if from_block <= block_number <= to_block
+        and (address is None or log.address == address)
+        and len(log.topics) >= len(topics)
+        and all(
+            topic is None or log.topics[position] == topic
+            for position, topic in enumerate(topics)
+        )
+    ]
+
+
+def test_query(tmp_path) -> None:
+    chain = list(synthetic_chain(**CHAIN))
+    stored = LogIndexState()
+    stored.tree.node_store = node_store_open(str(tmp_path / "nodes.bin"))
+    build(chain, stored)
+    plain = build(chain)
+    values_per_map = log_index_module.VALUES_PER_MAP
+    current_map_entry = plain.next_entry // values_per_map * values_per_map
+    first_log = chain[0][1][0][2][0]
+    last_log = chain[-1][1][-1][2][-1]
+    queries = [
+        (first_log.address, ()),
+        (None, (first_log.topics[0],)),
+        (None, (None, last_log.topics[1])),
+        (last_log.address, (last_log.topics[0], last_log.topics[1])),
+    ]
+    for from_block, to_block in ((0, 9), (8, 22), (17, 40)):
+        for address, topics in queries:
+            expected = reference_query(
+                chain, from_block, to_block, address, topics
+            )
+            matches = log_index_query(
+                stored, Uint(from_block), Uint(to_block), address, topics
+            )
+            for match in matches:
+                if match.block_number is None:
+                    assert match.false_positive
+                else:
+                    assert from_block <= match.block_number <= to_block
+                    assert match.false_positive is not None
+            assert [
+                match.entry_index
+                for match in matches
+                if not match.false_positive
+            ] == expected
+            # without a node store only the current map can be searched
+            matches = log_index_query(
+                plain, Uint(from_block), Uint(to_block), address, topics
+            )
+            assert all(
+                match.entry_index >= current_map_entry
+                and match.block_number is None
+                and match.false_positive is not False
+                for match in matches
+            )
+            found = [match.entry_index for match in matches]
+            assert all(
+                entry_index in found
+                for entry_index in expected
+                if entry_index >= current_map_entry
+            )
+    assert reference_query(chain, 17, 40, last_log.address, ())
+    node_store_close(stored.tree.node_store)
+
+
+@pytest.mark.parametrize("stored", [False, True])
+def test_checkpoint_revert(tmp_path, stored: bool) -> None:
+    def new_log_index(name: str) -> LogIndexState:
+        log_index = LogIndexState()
+        if stored:
+            path = str(tmp_path / name)
+            log_index.tree.node_store = node_store_open(path)
+        return log_index
+
+    chain = list(synthetic_chain(**CHAIN))
+    log_index = new_log_index("nodes.bin")
+    checkpoints, map_dependent_nodes = [], []
+    for header, transactions in chain:
+        checkpoints.append(log_index_checkpoint(log_index))
+        map_dependent_nodes.append(set(log_index._map_dependent_nodes))
+        log_index_add_block(log_index, header, transactions)
+    for depth in (1, 4, 12):
+        del chain[len(chain) - depth :]
+        log_index_revert(log_index, checkpoints[len(chain)])
+        del checkpoints[len(chain) :]
+        reference = build(chain, new_log_index(f"reference-{depth}.bin"))
+        assert log_index.next_entry == reference.next_entry
+        assert log_index._touched_rows == reference._touched_rows
+        assert log_index._map_dependent_nodes == (
+            map_dependent_nodes[len(chain)]
+        )
+        if stored:
+            store = log_index.tree.node_store
+            reference_store = reference.tree.node_store
+            assert store.size == reference_store.size
+            assert store._roots == reference_store._roots
+            node_store_close(reference_store)
+        assert log_index_root(log_index) == log_index_root(reference)
+    fork = list(
+        synthetic_chain(first_block=len(chain) + 1, blocks=8, seed=1)
+    )
+    build(fork, log_index)
+    assert log_index_root(log_index) == log_index_root(build(chain + fork))
+    log_index_finalize(log_index, checkpoints[2])
+    with pytest.raises(AssertionError):
+        log_index_revert(log_index, checkpoints[1])
+    if stored:
+        node_store_close(log_index.tree.node_store)